@@ -13,7 +13,7 @@ setup(
     install_requires=['colorama','lxml'],
     zip_safe=False,
     entry_points={
-        'console_scripts': ['s=taskshell.cli:main'],
+        'console_scripts': ['s=taskshell.daemon:main'],
         'tasker_commands': 
             ['checklist = taskshell.plugins.checklist:checklistparser',
              'quotidia = taskshell.plugins.quotidia:quotidiaparser'   ],
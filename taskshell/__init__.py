@@ -1,9 +1,37 @@
 import logging
 logging.getLogger(__name__).addHandler(logging.NullHandler)
 
-from .lib import Task, TaskLib
-from .lib import DEFAULT_CONFIG as config
-from .lib import TASK_OK, TASK_ERROR, TASK_EXTENSION_ERROR
-from .lib import make_uid
-
 __version__ = '1.0.0'
+
+# name: module of the objects exported by the package. They are imported
+# when first used, so the thin client in taskshell.daemon can start
+# without loading the library.
+_exports = {
+    'Task': 'lib',
+    'LazyTask': 'lib',
+    'TaskLib': 'lib',
+    'config': 'lib',
+    'TASK_OK': 'lib',
+    'TASK_ERROR': 'lib',
+    'TASK_EXTENSION_ERROR': 'lib',
+    'make_uid': 'lib',
+    'compile_query': 'query',
+    'QueryError': 'query',
+}
+
+
+def __getattr__(name):
+    if name not in _exports:
+        raise AttributeError(
+            "module {!r} has no attribute {!r}".format(__name__, name))
+    import importlib
+    from .profiler import profiler
+    with profiler.phase("import taskshell." + _exports[name]):
+        module = importlib.import_module('.' + _exports[name], __name__)
+    value = getattr(module, 'DEFAULT_CONFIG' if name == 'config' else name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(list(globals()) + list(_exports))
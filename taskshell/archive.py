@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+"""
+Archive Reader
+
+Random access to done.txt without parsing all of it.
+
+done.txt only ever grows, so the byte offsets of its lines are kept in a
+sidecar index file (``done.txt.idx`` by default). The index is extended
+from where it left off when the file has grown, and rebuilt if the file
+was changed in any other way. The file itself is memory mapped, so reading
+task N only touches the bytes of that line.
+
+Lines are numbered from 1, skipping blank lines, the same as the keys of
+:meth:`TaskLib.get_tasks`.
+"""
+
+import os
+import mmap
+import struct
+import hashlib
+import logging
+
+from .cache import LineIndex
+
+INDEX_MAGIC = b"TSKX"
+INDEX_VERSION = 1
+# magic, version, indexed size, line count, digest of the indexed tail
+INDEX_HEADER = struct.Struct("<4sHQQ16s")
+# bytes before the end of the indexed region used to detect rewrites
+TAIL_SIZE = 256
+
+
+class ArchiveReader(object):
+    """ArchiveReader(path, parse [,index_path])
+
+    Reads an append-only task file through a persistent line index.
+
+    :param path: path to the task file, usually done.txt
+    :param parse: callable that turns a line of text into a task
+    :param index_path: path of the sidecar index, defaults to path + '.idx'
+    :param encoding: encoding of the task file
+    """
+
+    def __init__(self, path, parse, index_path=None, encoding="utf-8"):
+        self.log = logging.getLogger("taskerLogger")
+        self.path = path
+        self.parse = parse
+        self.index_path = index_path or path + ".idx"
+        self.encoding = encoding
+
+        # indexed_size is the end of the last newline-terminated line.
+        # A final line without a line terminator is indexed but not saved,
+        # as an append will extend it.
+        # generation counts the times the index was thrown away because
+        # the file was changed other than by appending to it
+        self.generation = 0
+        self._reset()
+        self._map = None
+        self._mapped_size = -1
+        self.refresh()
+
+    def __len__(self):
+        return len(self.lines)
+
+    def __iter__(self):
+        return self.tasks()
+
+    def __getitem__(self, linenum):
+        return self.task(linenum)
+
+    def __reversed__(self):
+        return self.newest()
+
+    def _tail_digest(self, fp, size):
+        fp.seek(max(0, size - TAIL_SIZE))
+        return hashlib.blake2b(fp.read(min(size, TAIL_SIZE)), digest_size=16).digest()
+
+    def _reset(self):
+        self.generation += 1
+        self.lines = LineIndex()
+        self.indexed_size = 0
+        self._partial = False
+        self._tail = None
+
+    def _is_prefix(self, fp, size):
+        "True if the indexed bytes are still the start of the file"
+        if self.indexed_size > size:
+            return False
+        return self._tail == self._tail_digest(fp, self.indexed_size)
+
+    def _load_index(self, fp, size):
+        """Loads the sidecar index if it still describes the start of the
+        file. Returns True if it was loaded."""
+        try:
+            with open(self.index_path, "rb") as ip:
+                header = ip.read(INDEX_HEADER.size)
+                magic, version, indexed, count, tail = INDEX_HEADER.unpack(header)
+                if magic != INDEX_MAGIC or version != INDEX_VERSION:
+                    return False
+                lines = LineIndex()
+                lines.starts.fromfile(ip, count)
+                lines.ends.fromfile(ip, count)
+        except (OSError, EOFError, struct.error):
+            return False
+        self.lines = lines
+        self.indexed_size = indexed
+        self._partial = False
+        self._tail = tail
+        if not self._is_prefix(fp, size):
+            self.log.info("%s changed, rebuilding its index", self.path)
+            self._reset()
+            return False
+        return True
+
+    def _save_index(self, fp):
+        count = len(self.lines) - (1 if self._partial else 0)
+        header = INDEX_HEADER.pack(
+            INDEX_MAGIC, INDEX_VERSION, self.indexed_size, count, self._tail
+        )
+        temp = self.index_path + ".tmp"
+        try:
+            with open(temp, "wb") as ip:
+                ip.write(header)
+                self.lines.starts[:count].tofile(ip)
+                self.lines.ends[:count].tofile(ip)
+            os.replace(temp, self.index_path)
+        except OSError as error:
+            self.log.warning("Could not save index %s: %s", self.index_path, error)
+
+    def refresh(self):
+        """refresh()
+        Brings the index up to date with the file, reading only the bytes
+        added since the last refresh when the file has simply grown.
+        """
+        if not os.path.exists(self.path):
+            self.close()
+            self._reset()
+            return
+
+        with open(self.path, "rb") as fp:
+            size = os.fstat(fp.fileno()).st_size
+            if self._mapped_size < 0:
+                if not self._load_index(fp, size):
+                    self._reset()
+            elif not self._is_prefix(fp, size):
+                self.log.info("%s changed, rebuilding its index", self.path)
+                self._reset()
+
+            if self._partial:
+                self.lines.starts.pop()
+                self.lines.ends.pop()
+                self._partial = False
+
+            indexed = self.indexed_size
+            if size > self.indexed_size:
+                self._scan(fp)
+            if self._tail is None or self.indexed_size != indexed:
+                self._tail = self._tail_digest(fp, self.indexed_size)
+                self._save_index(fp)
+            if size != self._mapped_size:
+                self._remap(fp, size)
+
+    def _scan(self, fp):
+        pos = self.indexed_size
+        fp.seek(pos)
+        for raw in fp:
+            end = pos + len(raw)
+            if raw.strip():
+                self.lines.append(pos, end)
+                self._partial = not raw.endswith(b"\n")
+            if raw.endswith(b"\n"):
+                self.indexed_size = end
+            pos = end
+
+    def _remap(self, fp, size):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if size:
+            self._map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        self._mapped_size = size
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._mapped_size = -1
+
+    def line(self, linenum):
+        """line(linenum)
+        Returns the text of a line without parsing it.
+        """
+        start, end = self.lines.span(linenum)
+        return self._map[start:end].decode(self.encoding).strip()
+
+    def task(self, linenum):
+        """task(linenum)
+        Returns the parsed task on a line.
+        """
+        return self.parse(self.line(linenum))
+
+    def tasks(self, start=1, stop=None):
+        """tasks([start, stop])
+        Yields (line number, task) pairs for lines start up to, but not
+        including, stop. Only those lines are parsed.
+        """
+        stop = len(self.lines) + 1 if stop is None else min(stop, len(self.lines) + 1)
+        for linenum in range(max(start, 1), stop):
+            yield linenum, self.task(linenum)
+
+    def newest(self, count=None):
+        """newest([count])
+        Yields (line number, task) pairs starting from the end of the
+        file, for at most *count* tasks.
+        """
+        last = len(self.lines)
+        first = 1 if count is None else max(1, last - count + 1)
+        for linenum in range(last, first - 1, -1):
+            yield linenum, self.task(linenum)
+
+    def append(self, tasks):
+        """append(tasks)
+        Appends tasks to the end of the file in a single write and
+        extends the index.
+        """
+        data = "".join("{}{}".format(task, os.linesep) for task in tasks)
+        data = data.encode(self.encoding)
+        with open(self.path, "a+b") as fp:
+            if fp.seek(0, os.SEEK_END) > 0:
+                fp.seek(-1, os.SEEK_END)
+                if fp.read(1) != b"\n":
+                    data = os.linesep.encode(self.encoding) + data
+            fp.write(data)
+        self.refresh()
@@ -0,0 +1,558 @@
+# -*- coding: utf-8 -*-
+"""
+Task Cache
+
+Keeps parsed tasks in memory (and optionally on disk) so that
+:meth:`TaskLib.get_tasks` only has to run :meth:`Task.from_text` when the
+underlying file has actually changed.
+
+Entries are keyed on the path of the file and validated against the size,
+modification time and a digest of the file contents. Like git's index, an
+entry whose modification time is too close to the moment it was cached is
+considered *racy* and is always re-validated by digest, so a same-size
+rewrite within the filesystem's timestamp resolution is never missed.
+
+Entries can also be saved as binary snapshots, by default next to the
+file they were parsed from (``todo.txt.snap``). A snapshot starts with a
+fixed header recording the size, modification time and digest of the
+source file, followed by the tasks and line offsets packed with
+:mod:`marshal`. The header is checked before the rest of the snapshot is
+read, and a snapshot that no longer describes its file is ignored and
+overwritten the next time the file is parsed. The text file is always
+the source of truth.
+
+Writes made by TaskLib itself keep their entries in step instead of
+invalidating them. As hashing the file again would make every write read
+all of it, the entry records the size and modification time taken right
+after the write and no digest, and is trusted on those alone. Tasks
+appended to the file are added to a journal at the end of the snapshot,
+and the fixed-size header is patched in place, so an append does not
+rewrite the snapshot either.
+"""
+
+import io
+import os
+import time
+import struct
+import marshal
+import hashlib
+import logging
+
+from array import array
+
+CACHE_VERSION = 7
+
+SNAPSHOT_MAGIC = b"TSKS"
+SNAPSHOT_SUFFIX = ".snap"
+# magic, version, source size, source mtime_ns, cached_ns, source digest,
+# task count, body length, journal length
+SNAPSHOT_HEADER = struct.Struct("<4sHQQQ16sQQQ")
+# length of each journal record that follows the body
+JOURNAL_RECORD = struct.Struct("<I")
+# stored in place of the digest of an entry kept in step with a write
+NO_DIGEST = bytes(16)
+
+# entries cached within this many nanoseconds of the file's mtime are
+# verified by digest instead of trusting size and mtime alone
+RACY_WINDOW = 2 * 10 ** 9
+
+
+def new_digest():
+    """Return a hash object for building a file digest incrementally"""
+    return hashlib.blake2b(digest_size=16)
+
+
+def file_digest(data):
+    """Return the hex digest used to identify file contents"""
+    digest = new_digest()
+    digest.update(data)
+    return digest.hexdigest()
+
+
+def read_digest(path):
+    """Return the digest of the file at *path*"""
+    with open(path, "rb") as fp:
+        return file_digest(fp.read())
+
+
+def iter_lines(raw_lines, encoding, digest=None):
+    """iter_lines(raw_lines, encoding [,digest])
+    Yields (start, end, text) for every non-blank line of *raw_lines*, an
+    iterable of byte strings such as a file opened in binary mode. start
+    and end are the byte offsets of the line including its line
+    terminator. If *digest* is given, every line is fed to it.
+    """
+    pos = 0
+    for raw in raw_lines:
+        if digest is not None:
+            digest.update(raw)
+        end = pos + len(raw)
+        text = raw.decode(encoding).strip()
+        if text:
+            yield pos, end, text
+        pos = end
+
+
+class LineIndex(object):
+    """LineIndex()
+
+    Byte offsets of the non-blank lines of a task file. Lines are numbered
+    from 1, the same as the keys of :meth:`TaskLib.get_tasks`.
+    """
+
+    __slots__ = ("starts", "ends")
+
+    def __init__(self):
+        self.starts = array("Q")
+        self.ends = array("Q")
+
+    @classmethod
+    def from_data(cls, data, encoding):
+        index = cls()
+        for start, end, text in iter_lines(io.BytesIO(data), encoding):
+            index.append(start, end)
+        return index
+
+    def __len__(self):
+        return len(self.starts)
+
+    def append(self, start, end):
+        self.starts.append(start)
+        self.ends.append(end)
+
+    def span(self, linenum):
+        """Returns the (start, end) byte offsets of a line"""
+        if not 0 < linenum <= len(self.starts):
+            raise IndexError("Line %s not in index" % linenum)
+        return self.starts[linenum - 1], self.ends[linenum - 1]
+
+    def resize(self, linenum, length):
+        """resize(linenum, length)
+        Records that a line is now *length* bytes long and shifts the
+        offsets of every following line.
+        """
+        start, end = self.span(linenum)
+        delta = start + length - end
+        self.ends[linenum - 1] = start + length
+        if delta:
+            for idx in range(linenum, len(self.starts)):
+                self.starts[idx] += delta
+                self.ends[idx] += delta
+
+
+class CacheEntry(object):
+    """Parsed contents of one file and the identity of that file"""
+
+    __slots__ = (
+        "path",
+        "size",
+        "mtime_ns",
+        "digest",
+        "cached_ns",
+        "tasks",
+        "lines",
+        "index",
+    )
+
+    def __init__(
+        self, path, size, mtime_ns, digest, tasks, lines=None, cached_ns=None
+    ):
+        self.path = path
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.digest = digest
+        self.tasks = tasks
+        self.lines = lines
+        # TaskIndex, built the first time it is needed
+        self.index = None
+        self.cached_ns = cached_ns if cached_ns is not None else time.time_ns()
+
+    @property
+    def racy(self):
+        "True if the file may have changed without its mtime changing"
+        return self.cached_ns - self.mtime_ns < RACY_WINDOW
+
+    @property
+    def trusted(self):
+        """True if matching size and mtime are enough to trust the entry,
+        because it is not racy or was recorded right after a write"""
+        return self.digest is None or not self.racy
+
+    def matches_stat(self, stat):
+        return (self.size, self.mtime_ns) == (stat.st_size, stat.st_mtime_ns)
+
+
+class TaskCache(object):
+    """TaskCache([task_class, persist, directory])
+
+    Cache of parsed task dictionaries keyed on file identity.
+    If *persist* is True, entries are also saved as snapshots so they
+    survive between invocations, and loaded as *task_class* instances.
+    Snapshots are written next to each file, or into *directory* if it is
+    given.
+    """
+
+    def __init__(self, task_class=None, persist=False, directory=None):
+        self.log = logging.getLogger("taskerLogger")
+        self.task_class = task_class
+        self.persist = persist and task_class is not None
+        self.directory = directory
+        self.entries = {}
+        if self.persist and directory and not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+
+    def _key(self, path):
+        return os.path.abspath(path)
+
+    def _persist_path(self, key):
+        if not self.directory:
+            return key + SNAPSHOT_SUFFIX
+        name = hashlib.sha1(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, name + SNAPSHOT_SUFFIX)
+
+    def lookup(self, path):
+        """lookup(path)
+        Returns the :class:`CacheEntry` for *path* if it still describes
+        the file on disk, otherwise None.
+        """
+        key = self._key(path)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            self.invalidate(path)
+            return None
+
+        entry = self.entries.get(key)
+        if entry is None and self.persist:
+            entry = self._load(key, stat)
+
+        if entry is None:
+            return None
+
+        if entry.matches_stat(stat) and entry.trusted:
+            return entry
+
+        if (
+            entry.digest is not None
+            and entry.size == stat.st_size
+            and entry.digest == read_digest(path)
+        ):
+            self.log.debug("Cache entry for %s verified by digest", path)
+            before = (entry.size, entry.mtime_ns)
+            entry.mtime_ns = stat.st_mtime_ns
+            entry.cached_ns = time.time_ns()
+            self.entries[key] = entry
+            if self.persist and not entry.racy:
+                # so later runs trust the size and mtime again
+                self._patch_snapshot(entry, before)
+            return entry
+
+        self.log.debug("Cache entry for %s is stale", path)
+        self.invalidate(path)
+        return None
+
+    def count(self, path):
+        """count(path)
+        Returns the number of tasks cached for *path*, or None if there is
+        no valid entry. A snapshot that is not loaded yet is counted from
+        its header, without unpacking the tasks.
+        """
+        key = self._key(path)
+        if key in self.entries or not self.persist:
+            entry = self.lookup(path)
+            return None if entry is None else len(entry.tasks)
+        try:
+            stat = os.stat(path)
+            with open(self._persist_path(key), "rb") as fp:
+                header = self._read_header(fp)
+        except OSError:
+            return None
+        if header is None or header[:2] != (stat.st_size, stat.st_mtime_ns):
+            return None
+        size, mtime_ns, cached_ns, digest, count, __, __ = header
+        if digest is not None and cached_ns - mtime_ns < RACY_WINDOW:
+            if digest != read_digest(path):
+                return None
+            entry = CacheEntry(key, size, mtime_ns, digest, {})
+            if not entry.racy:
+                self._patch_snapshot(entry, (size, mtime_ns))
+        return count
+
+    def peek(self, path):
+        """Returns the in-memory entry for *path* without validating it"""
+        return self.entries.get(self._key(path))
+
+    def store(self, path, stat, digest, tasks, lines=None):
+        """store(path, stat, digest, tasks [,lines])
+        Records *tasks* parsed from *path* while it had the given *stat*
+        result and contents with the given hex *digest*, and optionally
+        the :class:`LineIndex` of those tasks.
+        """
+        key = self._key(path)
+        entry = CacheEntry(
+            key, stat.st_size, stat.st_mtime_ns, digest, tasks, lines
+        )
+        self.entries[key] = entry
+        if self.persist:
+            self._save(entry)
+        return entry
+
+    def refresh(self, entry, stat):
+        """refresh(entry, stat)
+        Re-keys an entry whose tasks were updated in step with a write
+        to its file, so the write does not invalidate it.
+        """
+        entry.size = stat.st_size
+        entry.mtime_ns = stat.st_mtime_ns
+        entry.digest = None
+        entry.cached_ns = time.time_ns()
+        self.entries[entry.path] = entry
+        if self.persist:
+            self._save(entry)
+        return entry
+
+    def append(self, path, before, stat, count, tasks, spans):
+        """append(path, before, stat, count, tasks, spans)
+        Records *tasks* appended to *path* by a write that changed its
+        (size, mtime_ns) from *before* to the *stat* result, when it held
+        *count* tasks. *spans* are the (start, end) byte offsets of the
+        new lines. The tasks are added to the in-memory entry and to the
+        journal of the snapshot, so neither is rebuilt.
+        """
+        key = self._key(path)
+        before = tuple(before)
+        entry = self.entries.get(key)
+        if entry is not None:
+            if (entry.size, entry.mtime_ns) != before or len(entry.tasks) != count:
+                self.invalidate(path)
+                return
+            for idx, task in enumerate(tasks, count + 1):
+                entry.tasks[idx] = task
+                if entry.index is not None:
+                    entry.index.add(idx, task)
+            if entry.lines is not None:
+                for start, end in spans:
+                    entry.lines.append(start, end)
+            previous = (entry.size, entry.mtime_ns)
+            entry.size = stat.st_size
+            entry.mtime_ns = stat.st_mtime_ns
+            entry.digest = None
+            entry.cached_ns = time.time_ns()
+        else:
+            previous = before
+            entry = CacheEntry(key, stat.st_size, stat.st_mtime_ns, None, {})
+        if not self.persist:
+            return
+        keys = array("Q", range(count + 1, count + len(tasks) + 1))
+        starts = array("Q", (start for start, end in spans))
+        ends = array("Q", (end for start, end in spans))
+        data = marshal.dumps(
+            (keys.tobytes(), starts.tobytes(), ends.tobytes(),
+             [str(task) for task in tasks])
+        )
+        record = JOURNAL_RECORD.pack(len(data)) + data
+        if self._patch_snapshot(entry, previous, count, len(tasks), record):
+            return
+        if entry.tasks:
+            self._save(entry)
+        else:
+            self.invalidate(path)
+
+    def invalidate(self, path=None):
+        """invalidate([path])
+        Forgets the entry for *path*, or every entry if no path is given.
+        """
+        if path is None:
+            keys = list(self.entries)
+        else:
+            keys = [self._key(path)]
+        for key in keys:
+            self.entries.pop(key, None)
+            if self.persist:
+                try:
+                    os.remove(self._persist_path(key))
+                except FileNotFoundError:
+                    pass
+
+    def _read_header(self, fp):
+        """Returns (size, mtime_ns, cached_ns, digest, count, body length,
+        journal length) from the header of a snapshot, or None if it is
+        not a snapshot of this version"""
+        header = fp.read(SNAPSHOT_HEADER.size)
+        if len(header) < SNAPSHOT_HEADER.size:
+            return None
+        magic, version, *fields = SNAPSHOT_HEADER.unpack(header)
+        if magic != SNAPSHOT_MAGIC or version != CACHE_VERSION:
+            return None
+        if fields[3] == NO_DIGEST:
+            fields[3] = None
+        else:
+            fields[3] = fields[3].hex()
+        return tuple(fields)
+
+    def _load(self, key, stat):
+        """Reads the snapshot of *key* if its header matches the size of
+        the file, which has the given *stat* result"""
+        try:
+            with open(self._persist_path(key), "rb") as fp:
+                header = self._read_header(fp)
+                # a different size means the file changed, skip the body
+                if header is None or header[0] != stat.st_size:
+                    return None
+                size, mtime_ns, cached_ns, digest, count, body, journal = header
+                body = marshal.loads(fp.read(body))
+                journal = fp.read(journal)
+            path, keys, text, complete, priorities, decoded, starts, ends = body
+            if path != key:
+                return None
+            tasks = self._unpack_tasks(
+                keys, text, complete, priorities, decoded
+            )
+            lines = LineIndex()
+            lines.starts.frombytes(starts)
+            lines.ends.frombytes(ends)
+            if len(lines) != len(tasks):
+                lines = None
+            self._replay_journal(journal, tasks, lines)
+            if len(tasks) != count:
+                return None
+        except FileNotFoundError:
+            return None
+        except Exception as error:
+            self.log.warning("Ignoring unreadable snapshot for %s: %s", key, error)
+            return None
+        entry = CacheEntry(key, size, mtime_ns, digest, tasks, lines, cached_ns)
+        self.entries[key] = entry
+        return entry
+
+    def _replay_journal(self, journal, tasks, lines):
+        """Adds the tasks appended since the body was saved"""
+        from_text = self.task_class.from_text
+        pos = 0
+        while pos < len(journal):
+            (length,) = JOURNAL_RECORD.unpack_from(journal, pos)
+            pos += JOURNAL_RECORD.size
+            keys, starts, ends, texts = marshal.loads(journal[pos : pos + length])
+            pos += length
+            idxs = array("Q")
+            idxs.frombytes(keys)
+            for idx, text in zip(idxs, texts):
+                tasks[idx] = from_text(text)
+            if lines is not None:
+                lines.starts.frombytes(starts)
+                lines.ends.frombytes(ends)
+
+    def _patch_snapshot(self, entry, before, count=None, added=0, record=b""):
+        """Rewrites the header of the snapshot of *entry* in place with its
+        identity, and appends *record* to the journal, if the snapshot
+        still describes the file as it was when its (size, mtime_ns) was
+        *before* and held *count* tasks. Returns True if it was patched.
+        """
+        try:
+            with open(self._persist_path(entry.path), "r+b") as fp:
+                header = self._read_header(fp)
+                if header is None or header[:2] != tuple(before):
+                    return False
+                __, __, __, __, saved, body, journal = header
+                if count is not None and saved != count:
+                    return False
+                if record:
+                    fp.seek(SNAPSHOT_HEADER.size + body + journal)
+                    fp.write(record)
+                    fp.truncate()
+                fp.seek(0)
+                fp.write(
+                    SNAPSHOT_HEADER.pack(
+                        SNAPSHOT_MAGIC,
+                        CACHE_VERSION,
+                        entry.size,
+                        entry.mtime_ns,
+                        entry.cached_ns,
+                        bytes.fromhex(entry.digest) if entry.digest else NO_DIGEST,
+                        saved + added,
+                        body,
+                        journal + len(record),
+                    )
+                )
+        except FileNotFoundError:
+            return False
+        except OSError as error:
+            self.log.warning("Could not update snapshot for %s: %s", entry.path, error)
+            return False
+        return True
+
+    def _save(self, entry):
+        target = self._persist_path(entry.path)
+        temp = target + ".tmp"
+        lines = entry.lines if entry.lines is not None else LineIndex()
+        body = marshal.dumps(
+            (entry.path,)
+            + self._pack_tasks(entry.tasks)
+            + (lines.starts.tobytes(), lines.ends.tobytes())
+        )
+        header = SNAPSHOT_HEADER.pack(
+            SNAPSHOT_MAGIC,
+            CACHE_VERSION,
+            entry.size,
+            entry.mtime_ns,
+            entry.cached_ns,
+            bytes.fromhex(entry.digest) if entry.digest else NO_DIGEST,
+            len(entry.tasks),
+            len(body),
+            0,
+        )
+        try:
+            with open(temp, "wb") as fp:
+                fp.write(header)
+                fp.write(body)
+            os.replace(temp, target)
+        except (OSError, ValueError) as error:
+            self.log.warning("Could not save snapshot for %s: %s", entry.path, error)
+
+    # Tasks are stored by column. Undecoded lazy tasks are only their line
+    # and flags, so the lines are joined into one string that is split
+    # again on load, which is much faster than a tuple per task. Any other
+    # task is stored whole from Task.to_state.
+
+    def _pack_tasks(self, tasks):
+        keys = array("Q")
+        lines = []
+        complete = bytearray()
+        priorities = []
+        decoded = []
+        for pos, (idx, task) in enumerate(tasks.items()):
+            state = task.to_state()
+            keys.append(idx)
+            if state[0] is not None and len(state) == 3 and len(state[2]) < 2:
+                lines.append(state[0])
+                complete.append(state[1])
+                priorities.append(state[2] or " ")
+            else:
+                lines.append("")
+                complete.append(0)
+                priorities.append(" ")
+                decoded.append((pos, state))
+        return (
+            keys.tobytes(),
+            "\n".join(lines),
+            bytes(complete),
+            "".join(priorities),
+            decoded,
+        )
+
+    def _unpack_tasks(self, keys, text, complete, priorities, decoded):
+        from_state = self.task_class.from_state
+        idxs = array("Q")
+        idxs.frombytes(keys)
+        lines = text.split("\n")
+        from_lines = getattr(self.task_class, "from_lines", None)
+        if from_lines is not None and len(decoded) < len(idxs):
+            tasks = dict(zip(idxs, from_lines(lines, complete, priorities)))
+        else:
+            tasks = {}
+            for idx, line, done, pri in zip(idxs, lines, complete, priorities):
+                tasks[idx] = line and from_state((line, bool(done), pri.strip()))
+        # decoded tasks keep their place and are filled in here
+        for pos, state in decoded:
+            tasks[idxs[pos]] = from_state(state)
+        return tasks
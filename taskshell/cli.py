@@ -1,24 +1,34 @@
+import io
 import sys
 import argparse
-import pkg_resources
 import datetime
 import re
+import shlex
 import logging
 import logging.config
 import pathlib
+import contextlib
 
 from collections import defaultdict
 
-import colorama
+from taskshell.profiler import profiler
 
-import minioncmd
-from lister import print_list
+with profiler.phase("import cli dependencies"):
+    import colorama
+
+    import minioncmd
 
 from taskshell import TaskLib, config, TASK_OK, TASK_ERROR, __version__
+from taskshell import QueryError
+from taskshell.lib import SORT_MODES, get_registry
+from taskshell import daemon
+from taskshell.render import TaskRenderer
+from taskshell.lister import stream_list
 
 logconfigpath = pathlib.Path(__file__).parent / "logging.conf"
 
-logging.config.fileConfig(logconfigpath)
+with profiler.phase("logging config"):
+    logging.config.fileConfig(logconfigpath)
 
 logger = logging.getLogger("taskerLogger")
 
@@ -48,6 +58,40 @@ def add_subparser(subparser):
     logger.debug("Added subparser %s", name)
 
 
+# plugin commands whose real parsers have not been imported yet
+lazy_commands = {}
+
+
+def add_lazy_subparser(plugin):
+    """add_lazy_subparser(plugin)
+    Adds a placeholder for a plugin command that takes any arguments.
+    The plugin's own parser replaces it when the command is used.
+
+    :param taskshell.registry.Plugin plugin: 'tasker_commands' entry
+    """
+    stub = argparse.ArgumentParser(
+        plugin.name, description=plugin.description, add_help=False
+    )
+    stub.add_argument("args", nargs=argparse.REMAINDER)
+    add_subparser(stub)
+    lazy_commands[plugin.name] = plugin
+
+
+def load_subparser(name):
+    """load_subparser(name)
+    Imports the real parser of a plugin command added by
+    :func:`add_lazy_subparser`.
+    """
+    plugin = lazy_commands.pop(name, None)
+    if plugin is None:
+        return
+    with profiler.phase("load command " + name):
+        subparser = plugin.load()
+    subparser.prog = "%s %s" % (parser.prog, name)
+    commands.choices[name] = subparser
+    logger.debug("Loaded subparser %s", name)
+
+
 def valid_date(string):
     """Confirm dates in the arguments work as dates, and allows for
     three strings: today, yesterday, and tomorrow"""
@@ -66,6 +110,20 @@ def valid_date(string):
         raise argparse.ArgumentTypeError(msg)
 
 
+def valid_days(string):
+    """Converts a number of days or weeks, such as 7, 7d or 2w, to a
+    number of days"""
+    match = re.match(r"^(\d+)([dw]?)$", string.lower())
+    if not match:
+        msg = "Not a valid number of days: '{0}'.".format(string)
+        logger.error(msg)
+        raise argparse.ArgumentTypeError(msg)
+    days = int(match.group(1))
+    return days * 7 if match.group(2) == "w" else days
+
+
+profiler.begin("build parser")
+
 parser = argparse.ArgumentParser(
     "t",
     description="Extensible text-based todo-manager",
@@ -140,6 +198,44 @@ list_cmd.add_argument(
     help="Shows all hidden tasks",
 )
 
+list_cmd.add_argument(
+    "-l",
+    "--limit",
+    dest="limit",
+    type=int,
+    help="Lists at most this many tasks",
+)
+
+list_cmd.add_argument(
+    "--revealing",
+    dest="revealing",
+    type=valid_days,
+    help="Lists hidden tasks revealed within this many days (7, 7d or 1w)",
+)
+
+list_cmd.add_argument(
+    "--sort",
+    dest="sort",
+    choices=SORT_MODES,
+    help="Sorts the tasks by this instead of by priority or number",
+)
+
+list_cmd.add_argument(
+    "--pager",
+    dest="pager",
+    action="store_true",
+    default=False,
+    help="Pages long lists through the pager command in the configuration",
+)
+
+list_cmd.add_argument(
+    "-q",
+    "--query",
+    dest="query",
+    nargs=argparse.REMAINDER,
+    help="Only lists tasks matching the rest of the line as a query",
+)
+
 list_cmd.add_argument(
     "filters",
     nargs=argparse.REMAINDER,
@@ -200,12 +296,55 @@ archive_cmd.add_argument(
     default=[],
 )
 
+sync_cmd = commands.add_parser("sync", help="write changes held by the session")
+sync_cmd.add_argument(
+    "-f",
+    "--force",
+    action="store_true",
+    default=False,
+    help="write even if the task file changed outside the session",
+)
+
 proj_cmd = commands.add_parser("projects", help="print a project report")
-proj_cmd.add_argument("text", type=str, nargs="?", help="open or closed", default="")
+proj_cmd.add_argument(
+    "text", type=str, nargs="?", help="open, closed or archive", default=""
+)
+
+rollup_cmd = commands.add_parser("rollup", help="rebuild project and context counts")
 
-for e_point in pkg_resources.iter_entry_points("tasker_commands"):
-    new_cmd = e_point.load()
-    add_subparser(new_cmd)
+storage_cmd = commands.add_parser(
+    "storage", help="copy tasks between the text files and the database"
+)
+storage_cmd.add_argument(
+    "action",
+    choices=["import", "export"],
+    help="import todo.txt and done.txt, or export them",
+)
+
+daemon_cmd = commands.add_parser(
+    "daemon", help="keep tasks in memory and answer commands quickly"
+)
+daemon_cmd.add_argument(
+    "action",
+    choices=["start", "stop", "status"],
+    help="run the daemon in the foreground, stop it, or check on it",
+)
+
+batch_cmd = commands.add_parser(
+    "batch", help="run commands from a file and write the changes once"
+)
+batch_cmd.add_argument(
+    "file",
+    nargs="?",
+    default="-",
+    help="file of commands, one per line (default - for standard input)",
+)
+
+# commands that renumber tasks or manage files themselves
+BATCH_REFUSED = ("archive", "batch", "daemon", "storage", "sync")
+
+for plugin in get_registry(config).entries("tasker_commands"):
+    add_lazy_subparser(plugin)
 
 parser.add_argument(
     "-i",
@@ -299,40 +438,48 @@ version = parser.add_argument(
     help="List version and quit",
 )
 
-re_color = re.compile(
-    r"""
-    (?P<style>bright|dim|normal|resetall)?\s*
-    (?P<fore>black|blue|cyan|green|lightblack|magenta|red|reset|white|yellow)?
-    (\s+on\s+(?P<back>black|blue|cyan|green|lightblack|magenta|red|reset|white|yellow))?
-    """,
-    re.VERBOSE + re.IGNORECASE,
+parser.add_argument(
+    "--profile-startup",
+    action="store_true",
+    default=False,
+    help="print how long each phase of startup took",
+)
+
+parser.add_argument(
+    "--profile-json",
+    metavar="FILE",
+    help="write how long each phase of startup took to FILE as JSON",
 )
 
+profiler.end()
 
-def get_color(text):
-    """Convert a textLib theme string to a colorama color"""
-    stuff = re_color.match(text).groupdict()
-    style = stuff.get("style") or ""
-    if style.upper() == "RESETALL":
-        style = "RESET_ALL"
 
-    fore = stuff.get("fore") or ""
-    if fore.upper() == "LIGHTBLACK":
+@contextlib.contextmanager
+def restored_section(config, section):
+    """Puts the options of a configuration section back the way they were
+    before the block"""
+    saved = {key: config.get(section, key, raw=True) for key in config.options(section)}
+    try:
+        yield
+    finally:
+        for key in config.options(section):
+            if key not in saved:
+                config.remove_option(section, key)
+        for key, value in saved.items():
+            config.set(section, key, value)
 
-        fore = "LIGHTBLACK_EX"
 
-    back = stuff.get("back") or ""
-    if back.upper() == "LIGHTBLACK":
-        back = "LIGHTBLACK_EX"
+class ErrorCounter(logging.Handler):
+    """Counts the errors logged while a command runs. The library logs
+    an error whenever it refuses a change, so a command failed if any
+    were logged."""
 
-    res = []
-    if style:
-        res.append(getattr(colorama.Style, style.upper()))
-    if fore:
-        res.append(getattr(colorama.Fore, fore.upper()))
-    if back:
-        res.append(getattr(colorama.Back, back.upper()))
-    return "".join(res)
+    def __init__(self):
+        super().__init__(logging.ERROR)
+        self.count = 0
+
+    def emit(self, record):
+        self.count += 1
 
 
 class TaskCmd(minioncmd.BossCmd):
@@ -346,20 +493,225 @@ class TaskCmd(minioncmd.BossCmd):
 
         self.config = config
         self.lib = lib
+        # name: Plugin of minions that have not been imported yet
+        self.lazy_minions = {}
+
+    def load_minion(self, name):
+        """Imports and adds a minion registered by a plugin, if it has not
+        been loaded yet"""
+        plugin = self.lazy_minions.pop(name, None)
+        if plugin is None:
+            return
+        logger.debug("Loading minion %s", name)
+        with profiler.phase("load minion " + name):
+            self.add_minion(name, plugin.load()())
+        # the minion uses the library of the same name, if there is one
+        if name in self.lib.libraries:
+            self.minions[name].lib = self.lib.libraries[name]
+
+    def onecmd(self, line):
+        words = line.split(None, 1)
+        if words:
+            self.load_minion(words[0])
+        return super().onecmd(line)
+
+    def do_help(self, arg):
+        if arg:
+            self.load_minion(arg.split()[0])
+        else:
+            for name in list(self.lazy_minions):
+                self.load_minion(name)
+        return super().do_help(arg)
+
+    def postcmd(self, stop, line):
+        stop = super().postcmd(stop, line)
+        res, msg = self.lib.maybe_flush()
+        if res == TASK_ERROR:
+            print("Error:", msg, "(use sync -f to overwrite)")
+        return stop
+
+    def do_sync(self, text):
+        """Writes changes held by the session [-f]"""
+        args = commands.choices["sync"].parse_args(text.split())
+        res, msg = self.lib.flush(args.force)
+        if res == TASK_OK:
+            print(msg)
+        elif res == TASK_ERROR:
+            print("Error:", msg, "(use sync -f to overwrite)")
+
+    def do_rollup(self, text):
+        """Rebuilds the project and context counts"""
+        res, msg = self.lib.rebuild_rollups()
+        if res == TASK_OK:
+            print(msg)
+        elif res == TASK_ERROR:
+            print("Error:", msg)
+
+    def do_storage(self, text):
+        """Imports or exports todo.txt and done.txt [import|export]"""
+        args = commands.choices["storage"].parse_args(text.split())
+        if args.action == "import":
+            res, msg = self.lib.import_tasks()
+        else:
+            res, msg = self.lib.export_tasks()
+        if res == TASK_OK:
+            print(msg)
+        elif res == TASK_ERROR:
+            print("Error:", msg)
+
+    def do_daemon(self, text):
+        """Runs, stops or checks the daemon [start|stop|status]"""
+        args = commands.choices["daemon"].parse_args(text.split())
+        path = daemon.socket_path(self.config)
+        if args.action == "start":
+            if self.lib.session is not None:
+                print("Error: the daemon cannot run in an interactive session")
+                return
+            try:
+                daemon.TaskDaemon(path, self.run_captured, self.runs_locally).serve()
+            except OSError as error:
+                print("Error:", error)
+        elif args.action == "stop":
+            print("Daemon stopped" if daemon.stop(path) else "Daemon is not running")
+        else:
+            running = daemon.is_running(path)
+            print("Daemon is {}running at {}".format("" if running else "not ", path))
+
+    def runs_locally(self, argv):
+        """True for the command lines the daemon sends back to the client:
+        a minion without a command, which starts its own prompt, and the
+        minion commands listed in its ``interactive_commands``"""
+        if not argv:
+            return False
+        self.load_minion(argv[0])
+        minion = self.minions.get(argv[0])
+        if minion is None:
+            return False
+        return len(argv) == 1 or argv[1] in getattr(minion, "interactive_commands", ())
+
+    def run_captured(self, argv):
+        """Runs a command line for the daemon and returns what it printed.
+        Each command starts from the task files and the configuration, not
+        from what the previous command left behind."""
+        if self.lib.started_on != datetime.date.today():
+            self.lib.run_startup_hooks()
+        # anything that still asks for input gets an EOFError
+        stdin, sys.stdin = sys.stdin, io.StringIO()
+        try:
+            # commands such as list --showhidden change the configuration
+            with restored_section(self.config, "Tasker"):
+                output, __ = self.capture(" ".join(argv) or "list")
+        finally:
+            sys.stdin = stdin
+            self.lib.end_command()
+        buffer = io.StringIO()
+        # strip colors the way colorama.init does for the command line
+        colorama.AnsiToWin32(buffer, strip=True).stream.write(output)
+        return buffer.getvalue()
+
+    def capture(self, line):
+        """Runs a command line and returns what it printed, and False if
+        it stopped with a usage error or an error was logged"""
+        buffer = io.StringIO()
+        ok = True
+        errors = ErrorCounter()
+        logger.addHandler(errors)
+        try:
+            with contextlib.redirect_stdout(buffer), contextlib.redirect_stderr(
+                buffer
+            ):
+                try:
+                    self.onecmd(line)
+                except SystemExit:
+                    # argparse exits after printing a usage error
+                    ok = False
+        finally:
+            logger.removeHandler(errors)
+        return buffer.getvalue(), ok and not errors.count
+
+    def do_batch(self, text):
+        """Runs commands from a file, one per line, and writes the changes
+        once at the end [FILE|-]
+        Task numbers refer to the task list as it was before the batch.
+        Blank lines and lines starting with # are skipped.
+        """
+        args = commands.choices["batch"].parse_args(shlex.split(text))
+        if args.file == "-":
+            lines = sys.stdin.read().splitlines()
+        else:
+            try:
+                with open(args.file, encoding="utf-8") as fp:
+                    lines = fp.read().splitlines()
+            except OSError as error:
+                print("Error:", error)
+                return
+
+        own_session = self.lib.session is None
+        self.lib.begin_session()
+        ran = failed = 0
+        for lineno, line in enumerate(lines, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            ran += 1
+            try:
+                name = shlex.split(line)[0]
+            except ValueError as error:
+                output, ok = "Error: {}\n".format(error), False
+            else:
+                if name in BATCH_REFUSED:
+                    output = "Error: {} cannot run in a batch\n".format(name)
+                    ok = False
+                else:
+                    try:
+                        output, ok = self.capture(line)
+                    except Exception as error:
+                        logger.exception("Batch command %r failed", line)
+                        output, ok = "Error: {}\n".format(error), False
+            # the next command should start from the session
+            self.lib.end_command()
+            if not ok:
+                failed += 1
+            print("{:d}: {}".format(lineno, line))
+            for out in output.splitlines():
+                print("   ", out)
+
+        print("{:d} commands run, {:d} failed".format(ran, failed))
+        if own_session:
+            res, msg = self.lib.end_session()
+            if res == TASK_ERROR:
+                # a one-off session cannot be synced later
+                self.lib.session = None
+                msg += ", nothing was written"
+        else:
+            res, msg = self.lib.flush()
+        if res == TASK_OK:
+            print(msg)
+        else:
+            print("Error:", msg)
 
     def do_list(self, text):
-        """Lists tasks [-nayx] [-o DATE] [-c DATE] [FILTERS]
+        """Lists tasks [-nayx] [-o DATE] [-c DATE] [-l LIMIT] [--sort ORDER]
+        [--revealing DAYS] [FILTERS] [-q QUERY]
         Can use ~word to filter out tasks containing that word
+        QUERY can use AND, OR, NOT, (), +project, @context, pri:A-C,
+        ext:key=value, start<DATE and end>=DATE
         """
         args = commands.choices["list"].parse_args(text.split())
         args.filterop = any if args.filterop else all
-        if args.hidedate == datetime.date.max:
+        args.query = " ".join(args.query) if args.query else None
+        if args.hidedate == datetime.date.max or args.revealing is not None:
             self.lib.show_extension("hide")
         args = vars(args)
         showext = args.pop("showext")
-        tasks = self.lib.sort_tasks(**args)
+        pager = args.pop("pager")
+        try:
+            tasks = self.lib.sort_tasks(**args)
+        except QueryError as error:
+            print("Error:", error)
+            return
         logger.debug("do_list %d tasks", len(tasks))
-        self.print_tasks(dict(tasks), showext)
+        self.print_tasks(dict(tasks), showext, pager)
 
     def do_add(self, text):
         """Add a task"""
@@ -412,6 +764,7 @@ class TaskCmd(minioncmd.BossCmd):
         """archives a task by number"""
         args = commands.choices["archive"].parse_args(text.split())
         tasks = self.lib.get_tasks(self.config["Files"]["task-path"])
+        index = self.lib.get_index(self.config["Files"]["task-path"])
         print(args)
 
         good = []
@@ -420,16 +773,12 @@ class TaskCmd(minioncmd.BossCmd):
         tasks_to_check = args.tasknum
 
         for project in args.project:
-            victims = [
-                tasknum for tasknum, task in tasks.items() if project in task.projects
-            ]
+            victims = sorted(index.projects.get(project, ()))
             print("Project Tasks:", victims)
             tasks_to_check.extend(victims)
 
         for context in args.context:
-            victims = [
-                tasknum for tasknum, task in tasks.items() if context in task.contexts
-            ]
+            victims = sorted(index.contexts.get(context, ()))
             print("Context Tasks:", victims)
             tasks_to_check.extend(victims)
 
@@ -443,8 +792,11 @@ class TaskCmd(minioncmd.BossCmd):
                 reasons[reason].append(tasknum)
 
         if good:
-            self.lib.archive_tasks(good)
-            print(f"Archived {len(good)} tasks")
+            res, msg = self.lib.archive_tasks(good)
+            if res == TASK_ERROR:
+                print("Error:", msg)
+                return
+            print(msg)
             if bad:
                 print(f"{len(bad)} tasks not archived")
                 for reason in reasons:
@@ -454,55 +806,32 @@ class TaskCmd(minioncmd.BossCmd):
         "print a report of projects"
         closed_only = "closed" in text.lower()
         open_only = "open" in text.lower()
+        include_archive = "archive" in text.lower()
         print(closed_only, open_only)
-        stuff = []
-        for thing, counts in self.lib.get_counts("PROJECT").items():
-            append = True
-            if closed_only and counts["open"] > 0:
-                append = False
-            if open_only and counts["open"] == 0:
-                append = False
-
-            if append:
-                stuff.append((thing, counts["open"], counts["closed"]))
-
-        print_list(stuff, ["Project", "Open", "Closed"])
+        counts_by_project = self.lib.get_counts("PROJECT", include_archive)
+        stuff = (
+            (thing, counts["open"], counts["closed"])
+            for thing, counts in counts_by_project.items()
+            if not (closed_only and counts["open"] > 0)
+            and not (open_only and counts["open"] == 0)
+        )
+        # rows are printed as they are made, with widths from the first ones
+        stream_list(stuff, ["Project", "Open", "Closed"])
 
-    def print_tasks(self, taskdict, showext=False):
+    def print_tasks(self, taskdict, showext=False, pager=False):
         logger.debug("Calling cli.print_tasks")
-        if not taskdict:
-            print("No tasks found")
-            return
-        idlen = len(str(max(taskdict)))
-        logger.debug("idlen is %d", idlen)
-        self.lib.prep_extension_hiders()
         logger.debug("taskdict has %d items", len(taskdict))
-        for key, task in taskdict.items():
-            if not showext:
-                text = self.lib.hide_extensions(task)
-            else:
-                text = str(task)
-            if task.complete:
-                color = get_color(self.lib.get_color("Closed"))
-            else:
-                color = get_color(self.lib.get_color(task.priority))
-
-            print("{3}{1:{0}d} {2}".format(idlen, key, text, color))
-        print("{0}{1}".format(colorama.Fore.RESET, "_" * (idlen + 1)))
-        print(
-            "{:d} task{:s} shown".format(
-                len(taskdict), "" if len(taskdict) == 1 else "s"
-            )
-        )
+        renderer = TaskRenderer(self.lib.theme, self.lib.get_extensions_to_hide())
+        command = self.config["Tasker"].get("pager", "")
+        # a pager only makes sense on a terminal, not in the daemon
+        if pager and command and sys.stdout.isatty():
+            renderer.page(taskdict, command, showext)
+        else:
+            renderer.write(taskdict, showext)
 
     def do_uid_check(self, text):
         "Check for duplicated UIDs"
-        tasks = self.lib.get_tasks(self.config["Files"]["task-path"])
-        uid_map = defaultdict(list)
-        for num in tasks:
-            uid_map[tasks[num].extensions["uid"]].append(num)
-
-        duped_uids = [uid for uid in uid_map if len(uid_map[uid]) > 1]
+        duped_uids = self.lib.duplicate_uids()
         if duped_uids:
             print("The following UIDs are Duplicates")
             for uid in duped_uids:
@@ -511,8 +840,21 @@ class TaskCmd(minioncmd.BossCmd):
             print("No duplicated uids found")
 
 
+def report_startup(args):
+    """Prints or saves the startup profile if it was asked for"""
+    if args.profile_startup:
+        profiler.report()
+    if args.profile_json:
+        profiler.write_json(args.profile_json)
+
+
 def main():
-    args = parser.parse_args()
+    with profiler.phase("parse arguments"):
+        args = parser.parse_args()
+        if args.command in lazy_commands:
+            # parse again with the plugin's own options
+            load_subparser(args.command)
+            args = parser.parse_args()
     logger.debug(args)
 
     if args.verbose:
@@ -528,22 +870,19 @@ def main():
 
     config.set("Tasker", "theme-name", args.theme)
 
-    tasklib = TaskLib(config)
-    tasklib.set_theme(args.theme)
+    with profiler.phase("TaskLib"):
+        tasklib = TaskLib(config)
+        tasklib.set_theme(args.theme)
     # if args.showhidden:
     #    tasklib.show_extension("hide")
 
     colorama.init(strip=True, autoreset=True)
 
-    cli = TaskCmd(config=config, lib=tasklib)
-    for e_point in pkg_resources.iter_entry_points("tasker_minions"):
-        minion = e_point.load()
-        cli.add_minion(e_point.name, minion())
-        # the main library should have already loaded a library for the
-        # plugin, if one exists.
-        # the minion should now have a master
-        if e_point.name in cli.lib.libraries:
-            cli.minions[e_point.name].lib = cli.lib.libraries.get(e_point.name)
+    with profiler.phase("TaskCmd"):
+        cli = TaskCmd(config=config, lib=tasklib)
+        # minions are imported the first time their command is used
+        for plugin in get_registry(config).entries("tasker_minions"):
+            cli.lazy_minions[plugin.name] = plugin
 
     if args.directory:
         if args.command:
@@ -569,12 +908,25 @@ def main():
         cli.cmdqueue.append("poweruser")
 
     if args.interact:
-        cli.cmdloop()
-    elif not args.command:
-        cli.onecmd("list")
+        if config["Tasker"].getboolean("session-mode", False):
+            tasklib.begin_session()
+        report_startup(args)
+        try:
+            cli.cmdloop()
+        finally:
+            res, msg = tasklib.end_session()
+            if res == TASK_ERROR:
+                print("Error:", msg)
     else:
-        cidx = sys.argv.index(args.command)
-        cli.onecmd(" ".join(sys.argv[cidx:]))
+        # a single command shows whether plugins it did not use stayed
+        # unloaded, so it is reported after the command has run
+        with profiler.phase("run command"):
+            if not args.command:
+                cli.onecmd("list")
+            else:
+                cidx = sys.argv.index(args.command)
+                cli.onecmd(" ".join(sys.argv[cidx:]))
+        report_startup(args)
 
     return 0
 
@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+"""
+Tasker Daemon
+
+A long-running process that keeps a :class:`TaskLib`, its libraries and
+the parsed tasks in memory and runs commands sent to it over a Unix
+domain socket. ``s daemon start`` runs it in the foreground.
+
+The ``s`` script is a thin client: when the daemon is running it sends
+the command line to the daemon and prints what comes back, without
+importing the library, building the argument parser or loading plugins.
+When the daemon is not running, or the command line starts with an
+option, the command runs in the client as before.
+
+A request is one JSON object, ``{"argv": [...], "cwd": "..."}``, followed
+by the client closing its side of the connection. Before running it the
+daemon answers with a status line: ``run``, followed by the output of the
+command, or ``local`` for commands that must run in the client, such as
+those that prompt for input. A client that gets no status line within
+:data:`ACK_TIMEOUT` seconds runs the command itself; the daemon only runs
+a request if it could send the status line, so a command never runs in
+both places.
+
+The daemon does not hold a session, so every change is written to the
+task file when it is made. The task cache checks the size and
+modification time of a file each time it is read, so edits made to the
+files outside the daemon are picked up by the next command.
+
+This module only imports from the standard library, so the client stays
+fast.
+"""
+
+import io
+import os
+import codecs
+import sys
+import json
+import socket
+import logging
+
+from configparser import ConfigParser, ExtendedInterpolation
+
+# seconds a client may take to send its request
+REQUEST_TIMEOUT = 5
+
+# seconds the client waits to connect and for the status line
+ACK_TIMEOUT = 1.0
+
+# seconds the client waits for the output once the command is running
+REPLY_TIMEOUT = 600
+
+STATUS_RUN = b"run\n"
+STATUS_LOCAL = b"local\n"
+
+
+def read_config():
+    """Reads the configuration files the way :mod:`taskshell.lib` does,
+    without importing it"""
+    install_dir = os.path.dirname(os.path.abspath(__file__))
+    config = ConfigParser(interpolation=ExtendedInterpolation())
+    config.read(
+        [
+            os.path.join(install_dir, "defaults.ini"),
+            os.path.join(install_dir, "tasker.ini"),
+        ]
+    )
+    return config
+
+
+def socket_path(config):
+    """Returns the ``socket-path`` of a configuration"""
+    files = config["Files"]
+    if not files.get("tasker-dir"):
+        files["tasker-dir"] = os.path.join(os.path.expanduser("~"), "tasker")
+    return files.get(
+        "socket-path", os.path.join(files["tasker-dir"], ".tasker.sock")
+    )
+
+
+def forwardable(argv):
+    """True if the daemon can run the command line *argv*
+
+    Options given before the command change the configuration of the
+    process that runs it, so those command lines run in the client, as
+    does ``batch`` reading standard input.
+    """
+    if not argv:
+        return True
+    if argv[0] == "batch" and argv[1:2] in ([], ["-"]):
+        # the daemon cannot read the client's standard input
+        return False
+    return not argv[0].startswith("-") and argv[0] != "daemon"
+
+
+def forward(path, argv, stream=None):
+    """forward(path, argv [,stream])
+
+    Sends *argv* to the daemon listening at *path* and writes its reply to
+    *stream* (standard output by default).
+
+    :returns: False if the command should run in the client: no daemon
+        is listening, it did not answer in time, or it asked for that
+    """
+    if not hasattr(socket, "AF_UNIX"):
+        return False
+    stream = stream or sys.stdout
+    request = json.dumps({"argv": argv, "cwd": os.getcwd()}).encode("utf-8")
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(ACK_TIMEOUT)
+        reply = b""
+        try:
+            sock.connect(path)
+            sock.sendall(request)
+            sock.shutdown(socket.SHUT_WR)
+            while b"\n" not in reply:
+                chunk = sock.recv(65536)
+                if not chunk:
+                    break
+                reply += chunk
+        except OSError:
+            # not listening, or too busy or wedged to answer
+            return False
+        status, __, output = reply.partition(b"\n")
+        if status + b"\n" != STATUS_RUN:
+            return False
+
+        decoder = codecs.getincrementaldecoder("utf-8")("replace")
+        sock.settimeout(REPLY_TIMEOUT)
+        try:
+            while True:
+                stream.write(decoder.decode(output))
+                output = sock.recv(65536)
+                if not output:
+                    break
+            stream.write(decoder.decode(b"", final=True))
+        except OSError as error:
+            # the command may have run, so it is not run again here
+            stream.write("Error: no answer from the daemon ({})\n".format(error))
+        stream.flush()
+    return True
+
+
+def is_running(path):
+    """True if a daemon is listening at *path*"""
+    if not hasattr(socket, "AF_UNIX"):
+        return False
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(path)
+        except OSError:
+            return False
+    return True
+
+
+def stop(path):
+    """Asks the daemon listening at *path* to stop
+
+    :returns: False if no daemon is listening
+    """
+    return forward(path, ["daemon", "stop"], stream=io.StringIO())
+
+
+class TaskDaemon(object):
+    """TaskDaemon(path, handler [,local])
+
+    Serves commands over a Unix domain socket, one at a time.
+
+    :param path: path of the socket
+    :param handler: callable that runs a list of command line arguments
+        and returns its output as a string
+    :param local: callable that returns True for the command lines the
+        client must run itself
+    """
+
+    def __init__(self, path, handler, local=None):
+        self.log = logging.getLogger("taskerLogger")
+        self.path = path
+        self.handler = handler
+        self.local = local or (lambda argv: False)
+        self.running = False
+
+    def bind(self):
+        """Creates the socket, replacing a stale one left by a daemon that
+        did not stop cleanly. Only the owner may connect to it."""
+        if is_running(self.path):
+            raise OSError("A daemon is already listening at " + self.path)
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        umask = os.umask(0o177)
+        try:
+            sock.bind(self.path)
+        finally:
+            os.umask(umask)
+        sock.listen()
+        return sock
+
+    def serve(self):
+        """Serves requests until a ``daemon stop`` request arrives"""
+        sock = self.bind()
+        self.running = True
+        self.log.info("Daemon listening at %s", self.path)
+        try:
+            while self.running:
+                conn, __ = sock.accept()
+                with conn:
+                    self.handle(conn)
+        finally:
+            sock.close()
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+            self.log.info("Daemon stopped")
+
+    def handle(self, conn):
+        """Reads one request from *conn*, runs it and sends the output"""
+        conn.settimeout(REQUEST_TIMEOUT)
+        data = []
+        try:
+            while True:
+                chunk = conn.recv(65536)
+                if not chunk:
+                    break
+                data.append(chunk)
+            if not data:
+                # is_running connects and closes without a request
+                return
+            request = json.loads(b"".join(data).decode("utf-8"))
+            argv = list(request["argv"])
+        except (OSError, ValueError, KeyError, TypeError) as error:
+            self.log.error("Bad daemon request: %s", error)
+            return
+
+        try:
+            local = argv != ["daemon", "stop"] and self.local(argv)
+        except Exception:
+            self.log.exception("Could not tell where %s should run", argv)
+            local = True
+        try:
+            if local:
+                conn.sendall(STATUS_LOCAL)
+                return
+            conn.sendall(STATUS_RUN)
+        except OSError as error:
+            # the client gave up waiting and runs the command itself
+            self.log.warning("Client left before %s ran: %s", argv, error)
+            return
+
+        if argv == ["daemon", "stop"]:
+            self.running = False
+            output = "Daemon stopped\n"
+        else:
+            output = self.run(argv, request.get("cwd"))
+        try:
+            conn.sendall(output.encode("utf-8"))
+        except OSError as error:
+            self.log.error("Could not send daemon reply: %s", error)
+
+    def run(self, argv, cwd=None):
+        """Runs *argv* with the handler, in the client's directory"""
+        previous = os.getcwd()
+        try:
+            if cwd:
+                os.chdir(cwd)
+            return self.handler(argv)
+        except Exception as error:
+            self.log.exception("Daemon command %s failed", argv)
+            return "Error: {}\n".format(error)
+        finally:
+            os.chdir(previous)
+
+
+def main():
+    """Entry point of the ``s`` script"""
+    argv = sys.argv[1:]
+    if forwardable(argv):
+        config = read_config()
+        if config["Tasker"].getboolean("use-daemon", True):
+            if forward(socket_path(config), argv):
+                return 0
+
+    from taskshell.cli import main as cli_main
+
+    return cli_main()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
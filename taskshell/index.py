@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""
+Task Index
+
+Inverted index over a task dictionary, mapping words, projects, contexts,
+priorities and uids to the set of line numbers of the tasks that contain
+them.
+
+Hidden tasks are kept in a separate reveal index, a sorted list of
+(hide date ordinal, line number) pairs, so the tasks still hidden on any
+date are found with a single binary search.
+
+Filter words in tasker match any part of a task's text, not just whole
+words. A word without whitespace can only appear inside a single
+whitespace-delimited token, so the postings of every token containing
+the word give exactly the tasks whose text contains it.
+"""
+
+import re
+
+from bisect import bisect_right, insort
+from collections import defaultdict
+
+# matches priority filter words such as (A) or ~(A)
+re_pri_filter = re.compile(r"~?\(([A-Z])\)")
+
+
+def _tokens(task):
+    return set(task.text.lower().split())
+
+
+class TaskIndex(object):
+    """TaskIndex()
+
+    Inverted index of tasks keyed by line number.
+    """
+
+    def __init__(self):
+        self.keys = set()
+        self.tokens = defaultdict(set)
+        self.projects = defaultdict(set)
+        self.contexts = defaultdict(set)
+        self.priorities = defaultdict(set)
+        self.uids = defaultdict(set)
+        # sorted (hide ordinal, key) pairs
+        self.reveals = []
+        self._words = {}
+
+    @classmethod
+    def from_tasks(cls, tasks):
+        """from_tasks(tasks)
+        Builds an index from a dictionary of line number, task pairs.
+        """
+        index = cls()
+        for key, task in tasks.items():
+            index.add(key, task)
+        return index
+
+    def _postings(self, task):
+        yield self.tokens, _tokens(task)
+        yield self.projects, set(task.projects)
+        yield self.contexts, set(task.contexts)
+        yield self.priorities, {task.priority}
+        uid = task.extensions.get("uid")
+        yield self.uids, {uid} if uid else set()
+
+    def add(self, key, task):
+        """Adds a task to the index"""
+        self._words.clear()
+        self.keys.add(key)
+        for postings, values in self._postings(task):
+            for value in values:
+                postings[value].add(key)
+        if task.hide_ordinal is not None:
+            insort(self.reveals, (task.hide_ordinal, key))
+
+    def remove(self, key, task):
+        """Removes a task from the index. *task* must be the version of
+        the task that was indexed."""
+        self._words.clear()
+        self.keys.discard(key)
+        for postings, values in self._postings(task):
+            for value in values:
+                found = postings.get(value)
+                if found is not None:
+                    found.discard(key)
+                    if not found:
+                        del postings[value]
+        if task.hide_ordinal is not None:
+            pair = (task.hide_ordinal, key)
+            pos = bisect_right(self.reveals, pair) - 1
+            if pos >= 0 and self.reveals[pos] == pair:
+                del self.reveals[pos]
+
+    def replace(self, key, old, new):
+        """Replaces the indexed version of a task"""
+        self.remove(key, old)
+        self.add(key, new)
+
+    def _reveal_position(self, day):
+        "Index of the first reveal after *day*"
+        return bisect_right(self.reveals, (day.toordinal(), float("inf")))
+
+    def hidden(self, day):
+        """hidden(day)
+        Returns the keys of tasks whose hide date is after *day*.
+        """
+        return {key for __, key in self.reveals[self._reveal_position(day) :]}
+
+    def revealing(self, after, until):
+        """revealing(after, until)
+        Returns the keys of tasks hidden after the date *after* that are
+        revealed by the date *until*, in the order they are revealed.
+        """
+        first = self._reveal_position(after)
+        last = self._reveal_position(until)
+        return [key for __, key in self.reveals[first:last]]
+
+    def word(self, word):
+        """word(word)
+        Returns the keys of tasks whose lowercased text contains *word*, or
+        None if the word contains whitespace and cannot be looked up.
+        """
+        word = word.lower()
+        if not word:
+            return set(self.keys)
+        if word.split() != [word]:
+            return None
+        found = self._words.get(word)
+        if found is None:
+            found = set()
+            for token, keys in self.tokens.items():
+                if word in token:
+                    found |= keys
+            self._words[word] = found
+        return found
+
+    def match(self, filters, filterop=all):
+        """match(filters [,filterop])
+        Returns the keys of the tasks :func:`include_task` would accept
+        for these filters, or None if a filter cannot be answered from
+        the index.
+
+        Each filter is the set of tasks containing the word, toggled for
+        tasks with a matching ``(A)`` priority filter and complemented for
+        ``~word`` negation. The filters are then intersected for ``all``
+        or combined for ``any``.
+        """
+        matched = None
+        for word in filters:
+            hits = self.word(word.replace("~", ""))
+            if hits is None:
+                return None
+            pri = re_pri_filter.match(word)
+            if pri:
+                hits = hits ^ self.priorities.get(pri.group(1), set())
+            if word.startswith("~"):
+                hits = self.keys - hits
+            if matched is None:
+                matched = set(hits)
+            elif filterop is any:
+                matched |= hits
+            else:
+                matched &= hits
+        if matched is None:
+            return set(self.keys) if filterop is all else set()
+        return matched
@@ -11,9 +11,10 @@ import os
 import sys
 import re
 import datetime
+import heapq
+import locale
 import logging
 import textwrap
-import pkg_resources
 import time
 
 from operator import itemgetter, attrgetter
@@ -21,6 +22,17 @@ from collections import defaultdict, Counter
 from functools import partial
 from configparser import ConfigParser, ExtendedInterpolation
 
+from .cache import TaskCache, LineIndex, iter_lines, new_digest, read_digest
+from .archive import ArchiveReader
+from .index import TaskIndex, re_pri_filter
+from .session import Session
+from .query import Query, compile_query
+from .rollup import RollupStore, signature
+from .loader import load_tasks
+from .storage import SQLiteStorage, StorageError
+from .registry import PluginRegistry, LazyLibraries
+from .profiler import profiler
+
 __version__ = "2.0.dev"
 __updated__ = "2020-07-01"
 __history__ = """
@@ -38,7 +50,8 @@ sys.path.insert(0, os.path.abspath(INSTALL_DIR))
 
 CONFIGPATH = os.path.join(INSTALL_DIR, "tasker.ini")
 
-DEFAULT_CONFIG.read([os.path.join(INSTALL_DIR, "defaults.ini"), CONFIGPATH])
+with profiler.phase("read config"):
+    DEFAULT_CONFIG.read([os.path.join(INSTALL_DIR, "defaults.ini"), CONFIGPATH])
 
 
 def save_config():
@@ -47,19 +60,86 @@ def save_config():
         DEFAULT_CONFIG.write(fp)
 
 
+_registries = {}
+
+
+def get_registry(config=None):
+    """get_registry([config])
+    Returns the :class:`PluginRegistry` saved at ``plugin-registry``, by
+    default ``.plugins.json`` in the tasker directory.
+    """
+    files = (config or DEFAULT_CONFIG)["Files"]
+    path = files.get("plugin-registry", "")
+    if not path:
+        tasker_dir = files["tasker-dir"] or os.path.join(
+            os.path.expanduser("~"), "tasker"
+        )
+        path = os.path.join(tasker_dir, ".plugins.json")
+    if path not in _registries:
+        _registries[path] = PluginRegistry(path)
+    return _registries[path]
+
+
 TIMEFMT = "%Y-%m-%dT%H:%M:%S"
 # IDFMT = '%H%M%S%f%d%m%y'
 IDFMT = "%y%m%d%H%M%S%f"
 DATEFMT = "%Y-%m-%d"
 
+# task files are read as bytes so they can be hashed by the cache
+FILE_ENCODING = locale.getpreferredencoding(False)
+
 
 def make_uid(dt=None):
     """utility for creating UIDs"""
     if dt:
-        return dt.strftime(IDFMT)
+        return format_uid(dt)
     else:
         time.sleep(0.001)
-        return datetime.datetime.now().strftime(IDFMT)
+        return format_uid(datetime.datetime.now())
+
+
+# Fixed-width codecs for TIMEFMT, DATEFMT and IDFMT. These produce the same
+# text as strftime/strptime with those formats, without the format-string
+# interpretation that makes the generic functions slow.
+
+
+def parse_timestamp(text):
+    """Returns the datetime for a TIMEFMT (YYYY-MM-DDTHH:MM:SS) string"""
+    try:
+        return datetime.datetime.fromisoformat(text)
+    except ValueError:
+        return datetime.datetime.strptime(text, TIMEFMT)
+
+
+def format_timestamp(dt):
+    """Returns the TIMEFMT (YYYY-MM-DDTHH:MM:SS) string for a naive datetime"""
+    return dt.isoformat("T", "seconds")
+
+
+def parse_date(text):
+    """Returns the date for a DATEFMT (YYYY-MM-DD) string"""
+    try:
+        return datetime.date.fromisoformat(text)
+    except ValueError:
+        return datetime.datetime.strptime(text, DATEFMT).date()
+
+
+def format_date(day):
+    """Returns the DATEFMT (YYYY-MM-DD) string for a date or datetime"""
+    return "%04d-%02d-%02d" % (day.year, day.month, day.day)
+
+
+def format_uid(dt):
+    """Returns the IDFMT string for a datetime"""
+    return "%02d%02d%02d%02d%02d%02d%06d" % (
+        dt.year % 100,
+        dt.month,
+        dt.day,
+        dt.hour,
+        dt.minute,
+        dt.second,
+        dt.microsecond,
+    )
 
 
 re_task = re.compile(
@@ -78,12 +158,45 @@ re_uid = re.compile(r"\s{uid:[^}]*}")
 re_hide = re.compile(r"\s{hide:(\d{4}-\d{2}-\d{2})}")
 re_note = re.compile(r"\s#\s.*$")
 
-re_pri_filter = re.compile(r"~?\(([A-Z])\)")
+
+# the leading flags and timestamps of re_task, used by LazyTask
+re_task_flags = re.compile(
+    r"(?P<complete>x\s)?(?:[(](?P<priority>[A-Z])[)]\s)?"
+    r"(?P<start>\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}\s)?"
+    r"(?P<end>\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}\s)?"
+)
+
+
+def parse_extensions(text):
+    """Returns the ``{key:value}`` extensions in a line of text as a
+    dictionary. A key given twice keeps its last value."""
+    edict = {}
+    for ext in re_ext.findall(text):
+        key, val = ext.split(":", 1)
+        key = key.replace(" {", "")
+        val = val.replace("}", "")
+        edict[key] = val.strip()
+    return edict
+
+
+def hide_ordinal(value):
+    """Returns the date of a hide extension value as a date ordinal, or
+    None if there is no value or it is not a date"""
+    if value is None:
+        return None
+    try:
+        return parse_date(value).toordinal()
+    except ValueError:
+        return None
+
 
 TASK_OK = 0
 TASK_ERROR = 1
 TASK_EXTENSION_ERROR = 2
 
+# orders understood by TaskLib.sort_tasks
+SORT_MODES = ("priority", "number", "start", "end", "project", "context", "age")
+
 
 class Task(object):
     """Simple container for parsed tasks"""
@@ -97,6 +210,9 @@ class Task(object):
         "contexts",
         "projects",
         "extensions",
+        "_stamps",
+        "_sort_key",
+        "_hide",
     )
 
     def __init__(
@@ -118,6 +234,9 @@ class Task(object):
         self.contexts = contexts
         self.projects = projects
         self.extensions = extensions
+        self._stamps = None
+        self._sort_key = None
+        self._hide = None
 
     def __str__(self):
         res = []
@@ -125,20 +244,132 @@ class Task(object):
             res.append("x")
         if self.priority and not self.complete:
             res.append("(%s)" % self.priority)
-        if self.start:
-            res.append(self.start.strftime(TIMEFMT))
-        if self.end:
-            res.append(self.end.strftime(TIMEFMT))
+        start, end = self.timestamps()
+        if start:
+            res.append(start)
+        if end:
+            res.append(end)
         res.append(self.text.strip())
         return " ".join(res)
 
+    def timestamps(self):
+        """timestamps()
+        Returns the formatted (start, end) strings of the task. The strings
+        are cached on the task until start or end is replaced.
+        """
+        start, end = self.start, self.end
+        stamps = self._stamps
+        if stamps is None or stamps[0] is not start or stamps[2] is not end:
+            stamps = self._stamps = (
+                start,
+                format_timestamp(start) if start else None,
+                end,
+                format_timestamp(end) if end else None,
+            )
+        return stamps[1], stamps[3]
+
+    @property
+    def sort_key(self):
+        """Tuple of (complete, no priority, priority, start, end, text)
+        that orders tasks the same way as their text: open tasks with a
+        priority first, as ``(`` sorts before a digit, and completed tasks
+        last. Timestamps are cut to whole seconds, as they are written. It
+        is computed once and cached on the task until one of those fields
+        is replaced.
+        """
+        fields = (self.complete, self.priority, self.start, self.end, self.text)
+        cached = self._sort_key
+        if cached is None or any(a is not b for a, b in zip(cached[0], fields)):
+            complete, priority, start, end, text = fields
+            shown = "" if complete else priority
+            cached = self._sort_key = (
+                fields,
+                (
+                    complete,
+                    not shown,
+                    shown,
+                    start.replace(microsecond=0) if start else datetime.datetime.min,
+                    end.replace(microsecond=0) if end else datetime.datetime.min,
+                    text.strip(),
+                ),
+            )
+        return cached[1]
+
+    @property
+    def hide_ordinal(self):
+        """The date in the hide extension as a :meth:`date.toordinal`
+        number, or None if the task has no valid hide date. Cached on the
+        task until the extension changes.
+        """
+        value = self.extensions.get("hide")
+        cached = self._hide
+        if cached is None or cached[0] is not value:
+            cached = self._hide = (value, hide_ordinal(value))
+        return cached[1]
+
+    def count_fields(self):
+        """Returns the projects, contexts and hide ordinal of the task,
+        the fields counted by :mod:`taskshell.rollup`"""
+        return self.projects, self.contexts, self.hide_ordinal
+
+    def copy(self):
+        """Returns an independent copy of the task"""
+        task = self.__class__(
+            self.complete,
+            self.priority,
+            self.start,
+            self.end,
+            self.text,
+            list(self.contexts),
+            list(self.projects),
+            dict(self.extensions),
+        )
+        task._stamps = self._stamps
+        task._sort_key = self._sort_key
+        task._hide = self._hide
+        return task
+
+    def to_state(self):
+        """to_state()
+        Returns the task as a tuple of plain values that :mod:`marshal`
+        can store. :meth:`from_state` turns it back into a task.
+        """
+        return (
+            None,
+            self.complete,
+            self.priority,
+            self.start.isoformat() if self.start else None,
+            self.end.isoformat() if self.end else None,
+            self.text,
+            self.contexts,
+            self.projects,
+            self.extensions,
+        )
+
+    @classmethod
+    def from_state(cls, state):
+        """from_state(state)
+        Returns a task from a tuple made by :meth:`to_state`.
+        """
+        __, complete, priority, start, end, text, contexts, projects, ext = state
+        return cls(
+            complete,
+            priority,
+            datetime.datetime.fromisoformat(start) if start else None,
+            datetime.datetime.fromisoformat(end) if end else None,
+            text,
+            contexts,
+            projects,
+            ext,
+        )
+
     # __contains__ allows for filtering tasks by content
     def __contains__(self, searchtext):
         return searchtext.lower() in self.text.lower()
 
     # __lt__ is required for sorting tasks
     def __lt__(self, other):
-        return str(self) < str(other)
+        return self.sort_key < other.sort_key
 
     @classmethod
     def from_text(cls, text):
@@ -158,13 +389,17 @@ class Task(object):
         else:
             priority = ""
 
-        if match.group("start"):
-            start = datetime.datetime.strptime(match.group("start").strip(), TIMEFMT)
+        start_text = match.group("start")
+        if start_text:
+            start_text = start_text.strip()
+            start = parse_timestamp(start_text)
         else:
             start = datetime.datetime.now()
 
-        if match.group("end"):
-            end = datetime.datetime.strptime(match.group("end").strip(), TIMEFMT)
+        end_text = match.group("end")
+        if end_text:
+            end_text = end_text.strip()
+            end = parse_timestamp(end_text)
         else:
             end = None
 
@@ -175,27 +410,27 @@ class Task(object):
 
         context = [t.strip() for t in re_context.findall(text)]
         projects = [t.strip() for t in re_project.findall(text)]
-        extensions = re_ext.findall(text)
-        edict = {}
-        for ext in extensions:
-            key, val = ext.split(":", 1)
-            key = key.replace(" {", "")
-            val = val.replace("}", "")
-            edict[key] = val.strip()
+        edict = parse_extensions(text)
         if "uid" not in edict:
-            edict["uid"] = start.strftime(IDFMT)
+            edict["uid"] = format_uid(start)
             task += " {uid:%s}" % edict["uid"]
 
-        return cls(complete, priority, start, end, task, context, projects, edict)
+        this = cls(complete, priority, start, end, task, context, projects, edict)
+        # keep the text the timestamps were parsed from so __str__ can
+        # reuse it instead of formatting them again
+        this._stamps = (
+            start,
+            start_text or format_timestamp(start),
+            end,
+            end_text or (format_timestamp(end) if end else None),
+        )
+        return this
 
     @property
     def is_hidden(self):
         "Returns true if the hidden flag exists and shows a future date"
-        if "hide" not in self.extensions:
-            return False
-        hide_date = datetime.datetime.strptime(self.extensions["hide"], DATEFMT)
-        today = datetime.datetime.now()
-        return today < hide_date
+        ordinal = self.hide_ordinal
+        return ordinal is not None and datetime.date.today().toordinal() < ordinal
 
     def archiveable(self, days=None, projects=None):
         if not self.complete:
@@ -212,6 +447,167 @@ class Task(object):
         return True, "Task archiveable"
 
 
+# fields of Task that LazyTask decodes on first access
+LAZY_FIELDS = (
+    "start",
+    "end",
+    "text",
+    "contexts",
+    "projects",
+    "extensions",
+    "_stamps",
+)
+
+
+def _lazy_field(name):
+    """Wraps the Task slot *name* so it is decoded before use"""
+    slot = Task.__dict__[name]
+
+    def fget(self):
+        if self._line is not None:
+            self._decode()
+        return slot.__get__(self, type(self))
+
+    def fset(self, value):
+        if self._line is not None:
+            self._decode()
+        slot.__set__(self, value)
+
+    return property(fget, fset, doc="Decoded on first access")
+
+
+class LazyTask(Task):
+    """Task that only parses the complete and priority flags up front.
+    The raw line is kept and the remaining fields are decoded the first
+    time any of them is read or written.
+    """
+
+    __slots__ = ("_line",)
+
+    start = _lazy_field("start")
+    end = _lazy_field("end")
+    text = _lazy_field("text")
+    contexts = _lazy_field("contexts")
+    projects = _lazy_field("projects")
+    extensions = _lazy_field("extensions")
+
+    def __init__(self, *args):
+        self._line = None
+        super().__init__(*args)
+
+    @classmethod
+    def from_text(cls, text):
+        """from_text(text)
+        Returns a lazily parsed task from a line of text. A line without
+        a start time, an end time for a completed task, or a uid is
+        parsed at once, as parsing it fills those in.
+        """
+        text = text.strip()
+        if not text:
+            raise ValueError("Task did not parse")
+        task = cls.__new__(cls)
+        task._line = text
+        task._stamps = None
+        task._sort_key = None
+        task._hide = None
+        match = re_task_flags.match(text)
+        task.complete = bool(match.group("complete"))
+        task.priority = match.group("priority") or ""
+        if (
+            not match.group("start")
+            or (task.complete and not match.group("end"))
+            or not re_uid.search(text)
+        ):
+            # decoding fills in the current time or a new uid, which
+            # would differ between copies decoded at different times
+            task._decode()
+        return task
+
+    @property
+    def decoded(self):
+        "True once the lazy fields have been parsed"
+        return self._line is None
+
+    def count_fields(self):
+        # counting every task of a large file should not decode them all
+        line = self._line
+        if line is None:
+            return super().count_fields()
+        return (
+            [t.strip() for t in re_project.findall(line)],
+            [t.strip() for t in re_context.findall(line)],
+            hide_ordinal(parse_extensions(line).get("hide")),
+        )
+
+    def _decode(self):
+        line, self._line = self._line, None
+        parsed = Task.from_text(line)
+        for name in LAZY_FIELDS:
+            Task.__dict__[name].__set__(self, getattr(parsed, name))
+
+    def copy(self):
+        if self._line is None:
+            return super().copy()
+        task = self.__class__.__new__(self.__class__)
+        task._line = self._line
+        task._stamps = None
+        task._sort_key = None
+        task._hide = None
+        task.complete = self.complete
+        task.priority = self.priority
+        return task
+
+    def to_state(self):
+        if self._line is None:
+            return super().to_state()
+        return (self._line, self.complete, self.priority)
+
+    @classmethod
+    def from_state(cls, state):
+        if state[0] is None:
+            return super().from_state(state)
+        task = cls.__new__(cls)
+        task._line, task.complete, task.priority = state
+        task._stamps = None
+        task._sort_key = None
+        task._hide = None
+        return task
+
+    @classmethod
+    def from_lines(cls, lines, complete, priorities):
+        """from_lines(lines, complete, priorities)
+        Returns a list of undecoded tasks from the columns of a snapshot:
+        the raw lines, a bytes object of complete flags and a string of
+        priority letters, with a space for none. Building them in one
+        loop saves a :meth:`from_state` call and a tuple per task.
+        """
+        new = cls.__new__
+        tasks = []
+        append = tasks.append
+        for line, done, priority in zip(lines, complete, priorities):
+            task = new(cls)
+            task._line = line
+            task._stamps = task._sort_key = task._hide = None
+            task.complete = done == 1
+            task.priority = "" if priority == " " else priority
+            append(task)
+        return tasks
+
+    def __getstate__(self):
+        state = (self._line, self.complete, self.priority)
+        if self._line is None:
+            state += tuple(Task.__dict__[name].__get__(self) for name in LAZY_FIELDS)
+        return state
+
+    def __setstate__(self, state):
+        self._line, self.complete, self.priority = state[:3]
+        self._stamps = None
+        self._sort_key = None
+        self._hide = None
+        for name, value in zip(LAZY_FIELDS, state[3:]):
+            Task.__dict__[name].__set__(self, value)
+
+
 def include_task(filterop, filters, task):
     "return a boolean value to include the task or not"
     yeas = []
@@ -231,9 +627,10 @@ class TaskLib(object):
     """TaskLib
 
     Main application.
-    On load, looks for all entry_points of 'tasker_library' and creates
-    a local instance of those libraries. Also assigns itself as the
-    ._tasklib attribute on all new libraries
+    On load, looks up the entry_points of 'tasker_library' in the plugin
+    registry. Each library is created the first time it is used or one of
+    its hooks is called, and is given this TaskLib as its ._tasklib
+    attribute.
     """
 
     def __init__(self, config=None):
@@ -269,14 +666,55 @@ class TaskLib(object):
 
         self.extension_hiders = {}
 
-        self.libraries = {}
-        for entry_point in pkg_resources.iter_entry_points("tasker_library"):
-            libclass = entry_point.load()
-            self.libraries[entry_point.name] = libclass(
-                self.config["Files"]["tasker-dir"]
+        if self.config["Tasker"].getboolean("lazy-tasks", True):
+            self.task_class = LazyTask
+        else:
+            self.task_class = Task
+
+        self.storage = None
+        storage = self.config["Tasker"].get("storage", "file")
+        if storage == "sqlite":
+            self.storage = SQLiteStorage(
+                self.config["Files"].get(
+                    "database-path",
+                    os.path.join(self.config["Files"]["tasker-dir"], "tasks.db"),
+                ),
+                self.task_class,
+            )
+        elif storage != "file":
+            raise ValueError("Unknown storage {!r}".format(storage))
+
+        self.cache = None
+        if self.config["Tasker"].getboolean("cache-tasks", True):
+            self.cache = TaskCache(
+                self.task_class,
+                self.config["Tasker"].getboolean("persist-cache", True),
+                self.config["Files"].get("cache-dir", "") or None,
+            )
+
+        self._archive = None
+        # (ArchiveReader, generation, tasks) from _archived_tasks
+        self._archived = (None, 0, {})
+        # write-behind Session for the task file, see begin_session
+        self.session = None
+        # (file signatures, TaskTable) from get_table
+        self._table = None
+
+        self.rollups = None
+        # the database groups counts itself
+        if self.storage is None and self.config["Tasker"].getboolean(
+            "rollup-counts", True
+        ):
+            self.rollups = RollupStore(
+                self.config["Files"].get(
+                    "rollup-path",
+                    os.path.join(self.config["Files"]["tasker-dir"], ".rollups.json"),
+                )
             )
-            self.libraries[entry_point.name]._tasklib = self
-            # grab a list of extensions to hide
+
+        self.libraries = LazyLibraries(
+            get_registry(self.config).entries("tasker_library"), self._make_library
+        )
 
         self._textwrapper = None
         self.log.debug("tasker-dir %s", config["Files"]["tasker-dir"])
@@ -287,11 +725,26 @@ class TaskLib(object):
         self.queue = []
         # list of (function name, text)
 
-        for libname, library in self.libraries.items():
-            if hasattr(library, "on_startup"):
-                self.log.debug(f"calling library.on_startup ({libname})")
+        self.run_startup_hooks()
+
+    def run_startup_hooks(self):
+        """Calls ``on_startup`` on each library that defines it.
+
+        A long-running process such as the daemon calls this again when
+        the date changes.
+        """
+        self.started_on = datetime.date.today()
+        for libname, library in self.libraries.with_hook("on_startup"):
+            self.log.debug(f"calling library.on_startup ({libname})")
+            with profiler.phase("on_startup " + libname):
                 library.on_startup()
 
+    def _make_library(self, libclass):
+        """Creates a plugin library the first time it is needed"""
+        library = libclass(self.config["Files"]["tasker-dir"])
+        library._tasklib = self
+        return library
+
     def set_theme(self, theme_name=None):
         """set_theme(name)
         Applies format-strings from the local configuration file
@@ -362,6 +815,95 @@ class TaskLib(object):
 
         self.config["Tasker"]["hidden-extensions"] = ",".join(extensions)
 
+    def begin_session(self):
+        """begin_session()
+        Starts holding the task list in memory. Until :meth:`end_session`,
+        changes to tasks are kept in :attr:`session` and only written to
+        the file by :meth:`flush`.
+        """
+        if self.storage is not None:
+            self.log.debug("Storage writes single tasks, no session needed")
+            return None
+        if self.session is None:
+            path = self.config["Files"]["task-path"]
+            self.log.info("Starting session on %s", path)
+            self.session = Session(path, self.get_tasks(path))
+        return self.session
+
+    def end_session(self):
+        """end_session()
+        Writes any held changes and stops holding the task list in memory.
+        Returns the result of the final :meth:`flush`. The session stays
+        open if the flush fails.
+        """
+        if self.session is None:
+            return TASK_OK, "No session"
+        res = self.flush()
+        if res[0] == TASK_OK:
+            self.session = None
+        return res
+
+    def flush(self, force=False):
+        """flush([force])
+        Writes the session's tasks to the task file in a single atomic
+        replace. Refuses to write if the file changed on disk since the
+        session last read or wrote it, unless force is True.
+        """
+        session = self.session
+        if session is None or not session.dirty:
+            return TASK_OK, "Nothing to write"
+        if session.conflicted and not force:
+            self.log.error("%s changed outside this session", session.path)
+            return TASK_ERROR, "Task file changed outside this session"
+        self.log.info("Writing %d held changes to %s", session.pending, session.path)
+        session.write(
+            FILE_ENCODING, self.config["Tasker"].getboolean("fsync-writes", False)
+        )
+        self._rebuild_rollup(session.path, session.tasks.values())
+        if self.cache is not None:
+            self.cache.invalidate(session.path)
+        return TASK_OK, "{:d} Tasks written".format(len(session.tasks))
+
+    def maybe_flush(self):
+        """maybe_flush()
+        Flushes the session if its changes are older than
+        ``session-flush-interval`` seconds or there are at least
+        ``session-flush-commands`` of them. Meant to be called after each
+        command.
+        """
+        if self.session is None:
+            return TASK_OK, "No session"
+        # the next command should start from the session, not from the
+        # copy of the task list the last command loaded
+        self.end_command()
+        tasker = self.config["Tasker"]
+        if self.session.due(
+            tasker.getfloat("session-flush-interval", 30),
+            tasker.getint("session-flush-commands", 20),
+        ):
+            return self.flush()
+        return TASK_OK, "Changes held"
+
+    def end_command(self):
+        """end_command()
+        Drops the task list and queue a command left behind, so the next
+        command reads the tasks again from the session or through the
+        cache, which notices changes made to the file in the meantime.
+        Long-running callers such as the daemon call this after each
+        command.
+        """
+        self.tasks = None
+        self.queue = []
+
+    def _session_for(self, path):
+        """Returns the session if it holds the file at path"""
+        session = self.session
+        if session is not None and os.path.abspath(path) == os.path.abspath(
+            session.path
+        ):
+            return session
+        return None
+
     def get_tasks(self, path):
         """Get tasks from either todo.txt or done.txt
 
@@ -369,14 +911,151 @@ class TaskLib(object):
         :rtype: dict
         :return: dictionary of line number, task instance pairs
         """
-        res = {}
-        with open(path, "r") as fp:
-            idx = 1
-            for line in fp.readlines():
-                if line.strip():
-                    res[idx] = Task.from_text(line.strip())
-                    idx += 1
-        return res
+        session = self._session_for(path)
+        if session is not None:
+            return {idx: task.copy() for idx, task in session.tasks.items()}
+
+        name = self._stored_list(path)
+        if name is not None:
+            return self.storage.get_tasks(name)
+
+        if self.cache is None:
+            return self._load_tasks(path)[2]
+
+        entry = self._cache_entry(path)
+        # callers are free to modify the tasks they get back
+        return {idx: task.copy() for idx, task in entry.tasks.items()}
+
+    def iter_tasks(self, path):
+        """iter_tasks(path)
+        Yields (line number, task) pairs from either todo.txt or done.txt.
+        Tasks come from the cache when it is current, otherwise the file
+        is parsed one line at a time as the generator is consumed.
+
+        :param path: path to the file to read
+        """
+        for idx, task in self._scan_tasks(path):
+            yield idx, task.copy()
+
+    def _scan_tasks(self, path):
+        """Like :meth:`iter_tasks`, but yields the cached task objects
+        themselves. Callers must copy a task before changing it."""
+        session = self._session_for(path)
+        if session is not None:
+            return iter(session.tasks.items())
+        name = self._stored_list(path)
+        if name is not None:
+            return iter(self.storage.entry(name).tasks.items())
+        if self.cache is not None:
+            entry = self.cache.lookup(path)
+            if entry is not None:
+                return iter(entry.tasks.items())
+        return self._stream_tasks(path)
+
+    def _task_map(self, path):
+        """Returns the dictionary :meth:`_scan_tasks` iterates over, without
+        copying it, so tasks can be looked up by key. As with
+        :meth:`_scan_tasks`, the tasks must be copied before changing them."""
+        session = self._session_for(path)
+        if session is not None:
+            return session.tasks
+        name = self._stored_list(path)
+        if name is not None:
+            return self.storage.entry(name).tasks
+        if self.cache is not None:
+            return self._cache_entry(path).tasks
+        return dict(self._stream_tasks(path))
+
+    def _cache_entry(self, path):
+        """Returns a valid cache entry for path, parsing the file if needed"""
+        entry = self.cache.lookup(path)
+        if entry is None:
+            self.log.debug("Parsing %s", path)
+            entry = self.cache.store(path, *self._load_tasks(path))
+        return entry
+
+    def _load_tasks(self, path):
+        """Parses a whole file, on several cores if it is large,
+        ``parallel-parse`` is on and ``lazy-tasks`` is off. Returns
+        (stat, digest, tasks, lines)."""
+        tasker = self.config["Tasker"]
+        workers = 1
+        # a lazy task is little more than a regex match, which costs less
+        # than sending it back from a worker process
+        if tasker.getboolean("parallel-parse", True) and not issubclass(
+            self.task_class, LazyTask
+        ):
+            workers = tasker.getint("parse-workers", 0) or None
+        return load_tasks(
+            path,
+            self.task_class,
+            FILE_ENCODING,
+            workers,
+            tasker.getint("parallel-parse-bytes", 8 * 1024 * 1024),
+        )
+
+    def get_index(self, path):
+        """get_index(path)
+        Returns a :class:`TaskIndex` of the words, projects, contexts and
+        priorities of the tasks in either todo.txt or done.txt. The index
+        is kept with the cached tasks and only rebuilt when they are.
+
+        :param path: path to the file to index
+        """
+        return self._indexed_tasks(path)[1]
+
+    def _indexed_tasks(self, path):
+        """Returns the task dictionary for path and its index. The tasks
+        belong to the cache or session and must be copied before changing
+        them."""
+        holder = self._session_for(path)
+        name = self._stored_list(path)
+        if holder is None and name is not None:
+            holder = self.storage.entry(name)
+        if holder is None:
+            if self.cache is None:
+                tasks = self.get_tasks(path)
+                return tasks, TaskIndex.from_tasks(tasks)
+            holder = self._cache_entry(path)
+        if holder.index is None:
+            self.log.debug("Indexing %s", path)
+            holder.index = TaskIndex.from_tasks(holder.tasks)
+        return holder.tasks, holder.index
+
+    def _built_index(self, path):
+        """Returns the index of path if it has already been built and is
+        still current, without building it"""
+        holder = self._session_for(path)
+        name = self._stored_list(path)
+        if holder is None and name is not None:
+            holder = self.storage.entry(name)
+        if holder is None and self.cache is not None:
+            holder = self.cache.lookup(path)
+        return holder.index if holder is not None else None
+
+    def _stream_tasks(self, path):
+        """Parses a file line by line, yielding (line number, task) pairs.
+        If the whole file is read, the result is stored in the cache."""
+        tasks = {}
+        lines = LineIndex()
+        digest = new_digest()
+        with open(path, "rb") as fp:
+            stat = os.fstat(fp.fileno())
+            parsed = iter_lines(fp, FILE_ENCODING, digest)
+            for idx, (start, end, line) in enumerate(parsed, 1):
+                task = tasks[idx] = self.task_class.from_text(line)
+                lines.append(start, end)
+                yield idx, task
+        if self.cache is not None:
+            self.cache.store(path, stat, digest.hexdigest(), tasks, lines)
+
+    def parse_tasks(self, path):
+        """parse_tasks(path)
+        Reads and parses a task file, bypassing the cache.
+
+        :return: dictionary of line number, task instance pairs
+        """
+        return self._load_tasks(path)[2]
 
     def write_tasks(self, task_dict, local_path):
         """write_tasks(task_dict, local_path)
@@ -384,16 +1063,187 @@ class TaskLib(object):
         :param dict task_dict: dictionary of (line: task) pairs
         :param filepath local_path: file path to write to
         """
+        session = self._session_for(local_path)
+        if session is not None:
+            if task_dict is not session.tasks:
+                session.tasks.clear()
+                session.tasks.update(task_dict)
+            session.touch()
+            return TASK_OK, "{:d} Tasks held for writing".format(len(task_dict))
+        name = self._stored_list(local_path)
+        if name is not None:
+            self.storage.write_tasks(name, task_dict)
+            return TASK_OK, "{:d} Tasks written".format(len(task_dict))
         self.log.info("Writing tasks to %s", local_path)
         with open(local_path, "w") as fp:
             for linenum in sorted(task_dict):
                 fp.write("{}{}".format(task_dict[linenum], "\n"))
+        self._rebuild_rollup(local_path, task_dict.values())
         return TASK_OK, "{:d} Tasks written".format(len(task_dict))
 
+    def append_task(self, task, local_path):
+        """append_task(task, local_path)
+        Writes a single task to the end of a file without rewriting the
+        rest of it.
+        :param Task task: task to append
+        :param filepath local_path: file path to append to
+        """
+        return self.append_tasks([task], local_path)
+
+    def append_tasks(self, tasks, local_path):
+        """append_tasks(tasks, local_path)
+        Writes tasks to the end of a file in one write, without rewriting
+        the rest of it.
+        :param list tasks: tasks to append, in order
+        :param filepath local_path: file path to append to
+        """
+        plural = "" if len(tasks) == 1 else "s"
+        session = self._session_for(local_path)
+        if session is not None:
+            idx = (max(session.tasks) + 1) if session.tasks else 1
+            for idx, task in enumerate(tasks, idx):
+                session.tasks[idx] = task
+            session.touch()
+            return TASK_OK, "{:d} Task{} held for writing".format(len(tasks), plural)
+        name = self._stored_list(local_path)
+        if name is not None:
+            self.storage.append_tasks(name, tasks)
+            return TASK_OK, "{:d} Task{} appended".format(len(tasks), plural)
+        self.log.info("Appending %d task%s to %s", len(tasks), plural, local_path)
+        count = self.cache.count(local_path) if self.cache is not None else None
+        lines = [
+            "{}{}".format(task, os.linesep).encode(FILE_ENCODING) for task in tasks
+        ]
+        before = signature(local_path)
+        with open(local_path, "a+b") as fp:
+            prefix = b""
+            if fp.seek(0, os.SEEK_END) > 0:
+                fp.seek(-1, os.SEEK_END)
+                if fp.read(1) != b"\n":
+                    prefix = os.linesep.encode(FILE_ENCODING)
+            pos = fp.tell() + len(prefix)
+            fp.write(prefix + b"".join(lines))
+            fp.flush()
+            if self.config["Tasker"].getboolean("fsync-writes", False):
+                os.fsync(fp.fileno())
+            stat = os.fstat(fp.fileno())
+        if count is not None and not prefix:
+            # keep the cache in step with the file without reparsing it
+            spans = []
+            for line in lines:
+                spans.append((pos, pos + len(line)))
+                pos += len(line)
+            new_tasks = [self.task_class.from_text(str(task)) for task in tasks]
+            self.cache.append(local_path, before, stat, count, new_tasks, spans)
+        self._update_rollup(local_path, before, added=tasks)
+        return TASK_OK, "{:d} Task{} appended".format(len(tasks), plural)
+
+    def update_task(self, tasknum, task, local_path):
+        """update_task(tasknum, task, local_path)
+        Replaces the line of a single task in a file. Only the changed line
+        and the lines after it are rewritten.
+        :param int tasknum: line number of the task
+        :param Task task: the updated task
+        :param filepath local_path: file path to update
+        """
+        session = self._session_for(local_path)
+        if session is not None:
+            if tasknum not in session.tasks:
+                self.log.error("Task %s not in %s", tasknum, local_path)
+                return TASK_ERROR, "Task number not in task list"
+            session.tasks[tasknum] = task
+            session.touch()
+            return TASK_OK, "1 Task held for writing"
+        name = self._stored_list(local_path)
+        if name is not None:
+            try:
+                self.storage.update_task(name, tasknum, task)
+            except StorageError as error:
+                self.log.error("%s", error)
+                return TASK_ERROR, "Task number not in task list"
+            return TASK_OK, "1 Task updated"
+        self.log.info("Updating task %s in %s", tasknum, local_path)
+        entry = self.cache.lookup(local_path) if self.cache is not None else None
+        before = signature(local_path)
+        with open(local_path, "r+b") as fp:
+            if entry is not None and entry.lines is not None:
+                lines = entry.lines
+            else:
+                entry = None
+                lines = LineIndex.from_data(fp.read(), FILE_ENCODING)
+            try:
+                start, end = lines.span(tasknum)
+            except IndexError:
+                self.log.error("Task %s not in %s", tasknum, local_path)
+                return TASK_ERROR, "Task number not in task list"
+
+            # only the changed line and what follows it are read
+            fp.seek(start)
+            old = fp.read(end - start)
+            newline = old[len(old.rstrip(b"\r\n")) :]
+            line = str(task).encode(FILE_ENCODING) + newline
+            if len(line) == len(old):
+                fp.seek(start)
+                fp.write(line)
+            else:
+                rest = fp.read()
+                fp.seek(start)
+                fp.write(line + rest)
+                fp.truncate()
+            fp.flush()
+            if self.config["Tasker"].getboolean("fsync-writes", False):
+                os.fsync(fp.fileno())
+            stat = os.fstat(fp.fileno())
+
+        # the text may have been edited without reparsing the task
+        new_task = self.task_class.from_text(str(task))
+        if entry is not None:
+            old_task = entry.tasks[tasknum]
+            # keep the cache in step with the file without reparsing it
+            if entry.index is not None:
+                entry.index.replace(tasknum, old_task, new_task)
+            entry.tasks[tasknum] = new_task
+            lines.resize(tasknum, len(line))
+            self.cache.refresh(entry, stat)
+        else:
+            old_task = self.task_class.from_text(old.decode(FILE_ENCODING))
+        self._update_rollup(local_path, before, added=[new_task], removed=[old_task])
+        return TASK_OK, "1 Task updated"
+
+    def save_task(self, tasknum, tasks):
+        """save_task(tasknum, tasks)
+        Saves a change to a single task in the task file. The line is
+        patched in place unless ``patch-tasks`` is turned off, in which
+        case the whole dictionary is written.
+        """
+        path = self.config["Files"]["task-path"]
+        if self.config["Tasker"].getboolean("patch-tasks", True):
+            return self.update_task(tasknum, tasks[tasknum], path)
+        return self.write_tasks(tasks, path)
+
+    def count_tasks(self, path):
+        """count_tasks(path)
+        Returns the number of tasks in a file without parsing them.
+        """
+        session = self._session_for(path)
+        if session is not None:
+            return len(session.tasks)
+        name = self._stored_list(path)
+        if name is not None:
+            return self.storage.count(name)
+        if self.cache is not None:
+            count = self.cache.count(path)
+            if count is not None:
+                return count
+        with open(path, "rb") as fp:
+            return sum(1 for line in fp if line.strip())
+
     def add_task(self, text: str) -> Task:
         """Adds a task to the current file.
         Returns {idx: taskobj"""
         if not hasattr(self, "tasks") or self.tasks is None:
+            if self.config["Tasker"].getboolean("append-tasks", True):
+                return self._append_new_task(text)
             tasks = self.tasks = self.get_tasks(self.config["Files"]["task-path"])
         else:
             tasks = self.tasks
@@ -404,10 +1254,9 @@ class TaskLib(object):
         # check for on_add_task hooks
         # these methods can functionally change the task
         self.queue = []
-        for libname, library in self.libraries.items():
-            if hasattr(library, "on_add_task"):
-                self.log.debug(f"calling library.on_add_task ({libname})")
-                this = library.on_add_task(this)
+        for libname, library in self.libraries.with_hook("on_add_task"):
+            self.log.debug(f"calling library.on_add_task ({libname})")
+            this = library.on_add_task(this)
 
         # Issue: Plugins cannot add a task in response.
         # tasks is a local dictionary being written, so new tasks
@@ -418,6 +1267,66 @@ class TaskLib(object):
 
         return {idx: this}
 
+    def _append_new_task(self, text):
+        """Fast path for :meth:`add_task` when no task list is loaded.
+        Only the new line is written, unless an on_add_task hook loaded
+        (and so may have changed) the rest of the task list.
+        """
+        path = self.config["Files"]["task-path"]
+        this = Task.from_text(text)
+        idx = self.count_tasks(path) + 1
+
+        self.queue = []
+        for libname, library in self.libraries.with_hook("on_add_task"):
+            self.log.debug(f"calling library.on_add_task ({libname})")
+            this = library.on_add_task(this)
+
+        if getattr(self, "tasks", None) is not None:
+            self.log.debug("on_add_task hooks loaded tasks, rewriting file")
+            self.tasks[idx] = this
+            self.write_tasks(self.tasks, path)
+        else:
+            self.append_task(this, path)
+        self.process_queue()
+
+        return {idx: this}
+
+    def add_tasks(self, texts):
+        """Adds several tasks to the current file with a single write.
+        The on_add_task hooks run for each task, as with :meth:`add_task`.
+        Returns {idx: taskobj}"""
+        path = self.config["Files"]["task-path"]
+        tasks = getattr(self, "tasks", None)
+        if tasks is None and not self.config["Tasker"].getboolean(
+            "append-tasks", True
+        ):
+            tasks = self.tasks = self.get_tasks(path)
+        if tasks is None:
+            idx = self.count_tasks(path) + 1
+        else:
+            idx = (max(tasks) + 1) if tasks else 1
+
+        added = {}
+        self.queue = []
+        for idx, text in enumerate(texts, idx):
+            this = Task.from_text(text)
+            for libname, library in self.libraries.with_hook("on_add_task"):
+                self.log.debug(f"calling library.on_add_task ({libname})")
+                this = library.on_add_task(this)
+            added[idx] = this
+        if not added:
+            return added
+
+        if getattr(self, "tasks", None) is not None:
+            # loaded before, or by an on_add_task hook
+            self.tasks.update(added)
+            self.write_tasks(self.tasks, path)
+        else:
+            self.append_tasks(list(added.values()), path)
+        self.process_queue()
+
+        return added
+
     def complete_task(self, tasknum, comment=None):
         """Completes an open task if task is not already closed.
         returns TASK_OK, dictionary of {tasknum, taskobject} if successful,
@@ -431,9 +1340,11 @@ class TaskLib(object):
 
         if tasknum not in tasks:
             del self.tasks
+            self.log.error("Task %s not in list", tasknum)
             return TASK_ERROR, "Task number not in task list"
         if tasks[tasknum].complete:
             del self.tasks
+            self.log.error("Task %s already completed", tasknum)
             return TASK_ERROR, "Task already completed"
 
         this = tasks[tasknum]
@@ -445,24 +1356,21 @@ class TaskLib(object):
         # check for on_complete_task hooks
         # these methods can functionally change the task
         self.queue = []
-        for libname, library in self.libraries.items():
-            if hasattr(library, "on_complete_task"):
-                self.log.debug(f"calling library.on_complete_task ({libname})")
-                this = library.on_complete_task(this)
-                if this is None:
-                    self.log.error(
-                        ("Plugin %s.on_complete_task failed to return task object"),
-                        libname,
-                    )
-                    raise RuntimeError(
-                        "Plugin failed to return task in on_complete_task"
-                    )
+        for libname, library in self.libraries.with_hook("on_complete_task"):
+            self.log.debug(f"calling library.on_complete_task ({libname})")
+            this = library.on_complete_task(this)
+            if this is None:
+                self.log.error(
+                    ("Plugin %s.on_complete_task failed to return task object"),
+                    libname,
+                )
+                raise RuntimeError("Plugin failed to return task in on_complete_task")
 
         # Issue: Plugins cannot add a task in response.
         # tasks is a local dictionary being written, so new tasks
         # are overridden
         tasks[tasknum] = this
-        self.write_tasks(tasks, self.config["Files"]["task-path"])
+        self.save_task(tasknum, tasks)
         self.process_queue()
         return TASK_OK, {tasknum: tasks[tasknum]}
 
@@ -484,8 +1392,13 @@ class TaskLib(object):
         opendate=None,
         closedate=None,
         hidedate=None,
+        limit=None,
+        query=None,
+        sort=None,
+        revealing=None,
     ):
-        """sort_tasks([by_pri, filters, filteropp, showcomplete])
+        """sort_tasks([by_pri, filters, filteropp, showcomplete, opendate,
+        closedate, hidedate, limit, query, sort, revealing])
         Returns a list of (line, task) tuples.
         Default behavior sorts by priority.
         Default behavior does no filtering.
@@ -493,6 +1406,12 @@ class TaskLib(object):
         Default behavior does not list completed tasks
         Default behavior does not look in the done.txt file.
         To filter, provide a list of strings to filter by.
+        If limit is given, only the first *limit* tasks are returned.
+        query is a :class:`Query` or query text, see :mod:`taskshell.query`.
+        Raises :class:`QueryError` if the query text is not valid.
+        sort is one of :data:`SORT_MODES` and overrides by_pri.
+        If revealing is a number of days, only the tasks that are hidden
+        today and revealed within that many days are returned.
         """
 
         filters = filters or []
@@ -500,87 +1419,226 @@ class TaskLib(object):
         if filterop not in (any, all):
             self.log.error("Bad filterop parameter in sort_tasks")
             return TASK_ERROR, "Filter Operation must by 'any' or 'all'."
+        sort = sort or ("priority" if by_pri else "number")
+        if sort not in SORT_MODES:
+            self.log.error("Bad sort parameter in sort_tasks")
+            return TASK_ERROR, "Sort must be one of %s" % ", ".join(SORT_MODES)
         showcomplete = showcomplete or closedate or False
-        hidedate = hidedate or datetime.date.today()
+        today = datetime.date.today()
+        hidedate = hidedate or today
+        if revealing is not None:
+            hidedate = today + datetime.timedelta(days=revealing)
+        if query is not None and not isinstance(query, Query):
+            query = compile_query(query)
+
+        if (
+            self.config["Tasker"].getboolean("use-table", False)
+            and sort in ("priority", "number")
+            and query is None
+            and revealing is None
+        ):
+            return self._sort_table(
+                sort == "priority", filters, filterop, showcomplete,
+                opendate, closedate, hidedate, limit,
+            )
 
-        everything = [
-            (key, val)
-            for key, val in list(
-                self.get_tasks(self.config["Files"]["task-path"]).items()
+        # each stage is a generator, so the task file is filtered in a
+        # single pass and only the surviving tasks are ever held in a list
+        path = self.config["Files"]["task-path"]
+        index = matched = everything = None
+        indexed_filters = False
+        name = self._stored_list(path)
+        if (
+            name is not None
+            and self._session_for(path) is None
+            and query is None
+            and revealing is None
+        ):
+            # the database narrows the rows down before any are parsed,
+            # the stages below still check every row it returns
+            everything = iter(
+                self.storage.select(
+                    name,
+                    filters if filterop is all else (),
+                    showcomplete,
+                    hidedate.toordinal(),
+                    opendate,
+                    closedate,
+                    self.config["Tasker"].getboolean("show-priority-z", True),
+                ).items()
+            )
+        elif (filters or query is not None or revealing is not None) and (
+            self.cache is not None or self.session is not None
+        ):
+            tasks, index = self._indexed_tasks(path)
+            if filters:
+                matched = index.match(filters, filterop)
+                indexed_filters = matched is not None
+            if query is not None:
+                found = query.plan(index)
+                if found is not None:
+                    matched = found if matched is None else matched & found
+            if revealing is not None:
+                found = set(index.revealing(today, hidedate))
+                matched = found if matched is None else matched & found
+
+        if everything is not None:
+            self.log.info("Selecting tasks in the database")
+        elif matched is not None:
+            self.log.info("Selecting tasks using the index")
+            everything = ((key, tasks[key]) for key in sorted(matched))
+        else:
+            everything = self._scan_tasks(path)
+
+        if not showcomplete:
+            everything = ((key, val) for key, val in everything if not val.complete)
+
+        if revealing is not None and index is None:
+            self.log.info("Showing tasks revealed by %s", hidedate)
+            shown = today.toordinal()
+            everything = (
+                (key, val)
+                for key, val in everything
+                if val.hide_ordinal is not None and val.hide_ordinal > shown
             )
-            if (showcomplete or not val.complete)
-        ]
 
-        if filters:
+        if query is not None:
+            self.log.info("Filtering tasks by query %s", query.text)
+            everything = ((key, val) for key, val in everything if query(val))
+
+        if filters and not indexed_filters:
             self.log.info("Filtering tasks by keywords")
-            everything = [
+            everything = (
                 (key, val)
                 for key, val in everything
                 if include_task(filterop, filters, val)
-            ]
+            )
 
         if not self.config["Tasker"].getboolean("show-priority-z", True):
             self.log.info("Hiding priority Z tasks")
-            everything = [(key, val) for key, val in everything if val.priority != "Z"]
+            everything = ((key, val) for key, val in everything if val.priority != "Z")
 
         if opendate:
             self.log.info("Showing items opened on %s", opendate)
-            everything = [
+            everything = (
                 (key, val) for key, val in everything if val.start.date() == opendate
-            ]
+            )
 
         if closedate:
             self.log.info("Showing items closed on %s", closedate)
-            everything = [
+            everything = (
                 (key, val)
                 for key, val in everything
                 if val.end and val.end.date() == closedate
-            ]
-
-        # if the task has a hide extension and the value of that extension
-        # is greater than the current day, do not show task.
+            )
 
         # show task unless there is a hide extension and the value is greater
-        # than the current day
-
-        everything = [
-            (key, task)
-            for key, task in everything
-            if datetime.datetime.strptime(
-                task.extensions.get("hide", hidedate.strftime(DATEFMT)),
-                DATEFMT,
-            ).date()
-            <= hidedate
-        ]
+        # than the hide date. The reveal index answers this with one binary
+        # search when the tasks are indexed.
+        if index is None:
+            index = self._built_index(path)
+        if index is not None:
+            hidden = index.hidden(hidedate)
+            everything = (
+                (key, task) for key, task in everything if key not in hidden
+            )
+        else:
+            shown = hidedate.toordinal()
+            everything = (
+                (key, task)
+                for key, task in everything
+                if task.hide_ordinal is None or task.hide_ordinal <= shown
+            )
+
+        sortkey = self._sort_function(sort)
+
+        if limit is not None:
+            stuff = heapq.nsmallest(limit, everything, key=sortkey)
+        else:
+            stuff = sorted(everything, key=sortkey)
+
+        # the scanned tasks may belong to the cache
+        return [(key, task.copy()) for key, task in stuff]
+
+    def _sort_table(
+        self, by_pri, filters, filterop, showcomplete, opendate, closedate,
+        hidedate, limit,
+    ):
+        """Answers :meth:`sort_tasks` from the :class:`TaskTable` of the
+        task file, used when ``use-table`` is True. The table is only
+        rebuilt when the file changes, so repeated listings of a large
+        file filter and sort whole columns instead of every task.
+        """
+        tasker = self.config["Tasker"]
+        table = self.get_table()
+        mask = table.select(
+            filters,
+            filterop,
+            showcomplete,
+            opendate,
+            closedate,
+            hidedate,
+            tasker.getboolean("show-priority-z", True),
+        )
+        keys = table.order(mask, by_pri, tasker.getboolean("priority-z-last", True))
+        if limit is not None:
+            keys = keys[:limit]
+        # only the tasks the table chose are looked up and copied
+        tasks = self._task_map(self.config["Files"]["task-path"])
+        return [(key, tasks[key].copy()) for key in keys]
+
+    def _sort_function(self, sort):
+        """Returns a sort key for (line, task) pairs in one of the
+        :data:`SORT_MODES`. Ties are broken by :attr:`Task.sort_key`.
+
+        priority puts tasks with a priority first, then unprioritized and
+        Z tasks (in the order set by ``priority-z-last``). start and end
+        are oldest first, with tasks that are still open last for end.
+        project and context sort by the first project or context in
+        alphabetical order, with tasks that have none last. age puts the
+        tasks that have been (or were) open the longest first.
+        """
+        if sort == "number":
+            return itemgetter(0)
 
-        if by_pri:
-            plist, zlist, ulist = [], [], []
-            for key, val in everything:
-                pri = val.priority
-                if pri and pri != "Z":
-                    plist.append((key, val))
-                elif not pri:
-                    ulist.append((key, val))
-                else:
-                    zlist.append((key, val))
-
-            getter = itemgetter(1)
+        if sort == "priority":
             if self.config["Tasker"].getboolean("priority-z-last", True):
-                stuff = (
-                    sorted(plist, key=getter)
-                    + sorted(ulist, key=getter)
-                    + sorted(zlist, key=getter)
-                )
+                ranks = {"": 1, "Z": 2}
             else:
-                stuff = (
-                    sorted(plist, key=getter)
-                    + sorted(zlist, key=getter)
-                    + sorted(ulist, key=getter)
-                )
+                ranks = {"": 2, "Z": 1}
 
-        else:
-            stuff = sorted(everything, key=itemgetter(0))
-        return stuff
+            def sortkey(item):
+                return ranks.get(item[1].priority, 0), item[1].sort_key
+
+        elif sort == "start":
+
+            def sortkey(item):
+                return item[1].start or datetime.datetime.min, item[1].sort_key
+
+        elif sort == "end":
+
+            def sortkey(item):
+                end = item[1].end
+                return end is None, end or datetime.datetime.min, item[1].sort_key
+
+        elif sort in ("project", "context"):
+            getter = attrgetter(sort + "s")
+
+            def sortkey(item):
+                found = getter(item[1])
+                return not found, min(found) if found else "", item[1].sort_key
+
+        elif sort == "age":
+            now = datetime.datetime.now()
+            never = datetime.timedelta(0)
+
+            def sortkey(item):
+                task = item[1]
+                if task.start is None:
+                    return never, task.sort_key
+                return task.start - (task.end or now), task.sort_key
+
+        return sortkey
 
     def prep_extension_hiders(self):
         """create the regex substitutions to hide extensionss"""
@@ -598,6 +1656,10 @@ class TaskLib(object):
         opendate=None,
         closedate=None,
         hidedate=None,
+        limit=None,
+        query=None,
+        sort=None,
+        revealing=None,
     ):
         """list_tasks([by_pri, filters, filterop, showcomplete, showuid)
         Returns a list of formatted tasks.
@@ -613,6 +1675,11 @@ class TaskLib(object):
         :param date opendate: If not None, filters tasks opened on opendate
         :param date closedate: If not None, filters tasks closed on closedate
         :param date hidedate: The date to filter extensions marked to hide
+        :param int limit: If not None, the most tasks to list
+        :param str query: If not None, a query tasks must match
+        :param str sort: If not None, one of :data:`SORT_MODES`
+        :param int revealing: If not None, only lists hidden tasks revealed
+                              within this many days
         :rtype: dictionary
         """
         showext = showext or False
@@ -625,6 +1692,10 @@ class TaskLib(object):
             opendate,
             closedate,
             hidedate,
+            limit,
+            query,
+            sort,
+            revealing,
         )
         self.log.info(
             "Listing %s tasks %s",
@@ -692,7 +1763,7 @@ class TaskLib(object):
         t = tasks[tasknum]
         t.text = self.update_note(t.text, note)
         tasks[tasknum] = t
-        self.write_tasks(tasks, self.config["Files"]["task-path"])
+        self.save_task(tasknum, tasks)
         return TASK_OK, {tasknum: tasks[tasknum]}
 
     def update_note(self, text, note=None):
@@ -725,7 +1796,7 @@ class TaskLib(object):
         t = self.reprioritize_task(tasks[tasknum], priority)
         t.text = self.update_note(t.text, note)
         tasks[tasknum] = t
-        self.write_tasks(tasks, self.config["Files"]["task-path"])
+        self.save_task(tasknum, tasks)
         return TASK_OK, {tasknum: tasks[tasknum]}
 
     def write_current_tasks(self):
@@ -762,12 +1833,12 @@ class TaskLib(object):
             self.log.error("Task %s already completed. Cannot hide")
             return TASK_ERROR, "Cannot hide closed task"
         if "hide" not in tasks[tasknum].extensions:
-            tasks[tasknum].text += " {hide:%s}" % hidedate.strftime(DATEFMT)
+            tasks[tasknum].text += " {hide:%s}" % format_date(hidedate)
         else:
             tasks[tasknum].text = re_hide.sub(
-                " {hide:%s}" % hidedate.strftime(DATEFMT), tasks[tasknum].text
+                " {hide:%s}" % format_date(hidedate), tasks[tasknum].text
             )
-        self.write_tasks(tasks, self.config["Files"]["task-path"])
+        self.save_task(tasknum, tasks)
         return TASK_OK, {tasknum: tasks[tasknum]}
 
     def unhide_task(self, tasknum):
@@ -779,25 +1850,161 @@ class TaskLib(object):
             self.log.error("Task %s already completed. Cannot unhide")
             return TASK_ERROR, "Cannot unhide completed task"
         tasks[tasknum].text = re_hide.sub("", tasks[tasknum].text)
-        self.write_tasks(tasks, self.config["Files"]["task-path"])
+        self.save_task(tasknum, tasks)
         return TASK_OK, {tasknum: tasks[tasknum]}
 
+    @property
+    def archive(self):
+        """:class:`ArchiveReader` for the done-path file, brought up to
+        date with the file each time it is used."""
+        path = self.config["Files"]["done-path"]
+        if self._archive is None or self._archive.path != path:
+            self._archive = ArchiveReader(
+                path,
+                self.task_class.from_text,
+                self.config["Files"].get("done-index", path + ".idx"),
+                FILE_ENCODING,
+            )
+        else:
+            self._archive.refresh()
+        return self._archive
+
+    def _archived_tasks(self):
+        """Returns a dictionary of line number, task pairs for done.txt,
+        read through :attr:`archive`. Each line is parsed once; later
+        calls only parse the lines appended since, unless the file was
+        rewritten. Callers must copy a task before changing it.
+        """
+        archive = self.archive
+        reader, generation, tasks = self._archived
+        if (
+            reader is not archive
+            or generation != archive.generation
+            or len(tasks) > len(archive)
+        ):
+            tasks = {}
+        # the last line may have grown if it had no line terminator
+        tasks.update(archive.tasks(max(1, len(tasks))))
+        self._archived = (archive, archive.generation, tasks)
+        return tasks
+
+    def get_archived_tasks(self):
+        """get_archived_tasks()
+        Returns the tasks of done.txt like :meth:`get_tasks`, parsing only
+        the lines added since the last call when the file is read directly.
+        """
+        path = self.config["Files"]["done-path"]
+        if self._stored_list(path) is not None or self._session_for(path):
+            return self.get_tasks(path)
+        return {key: task.copy() for key, task in self._archived_tasks().items()}
+
     def build_task_dict(self, include_archive=False, only_archive=False):
         """build_task_dict(include_archive, only_archive)
         Builds a dictionary of tasks, much like :meth:`get_tasks` but will
         read either file, or both.
         """
         if only_archive:
-            tasks = self.get_tasks(self.config["Files"]["done-path"])
+            tasks = self.get_archived_tasks()
         else:
             tasks = self.get_tasks(self.config["Files"]["task-path"])
             if include_archive:
-                done = self.get_tasks(self.config["Files"]["done-path"])
-                for key, val in done.items():
+                for key, val in self.get_archived_tasks().items():
                     tasks["x%d" % key] = val
 
         return tasks
 
+    def get_table(self, include_archive=False, only_archive=False):
+        """get_table([include_archive, only_archive])
+        Returns a :class:`TaskTable` of the tasks :meth:`build_task_dict`
+        would return. The table is rebuilt only when either file changes.
+        NumPy is used if it is installed, unless ``use-numpy`` is False.
+        """
+        paths = [self.config["Files"]["task-path"], self.config["Files"]["done-path"]]
+        signature = [include_archive, only_archive]
+        for path in paths:
+            name = self._stored_list(path)
+            if name is not None:
+                signature.append(self.storage.signature(name))
+                continue
+            try:
+                stat = os.stat(path)
+                signature.append((stat.st_size, stat.st_mtime_ns))
+            except FileNotFoundError:
+                signature.append(None)
+        # a session's unwritten changes are not in the signature
+        if self.session is not None and self.session.dirty:
+            signature = None
+        if signature is None or self._table is None or self._table[0] != signature:
+            self.log.debug("Building task table")
+            from .table import TaskTable
+
+            table = TaskTable(
+                self.build_task_dict(include_archive, only_archive),
+                self.config["Tasker"].getboolean("use-numpy", True),
+            )
+            self._table = (signature, table)
+        return self._table[1]
+
+    def _uid_sources(self, include_archive=True):
+        """Yields (path, key function) for the files searched by uid. Keys
+        from done.txt are formatted the same as in :meth:`build_task_dict`.
+        """
+        yield self.config["Files"]["task-path"], int
+        if include_archive:
+            yield self.config["Files"]["done-path"], "x{:d}".format
+
+    def find_by_uids(self, uids, include_archive=True):
+        """find_by_uids(uids [,include_archive])
+        Returns a dictionary of uid, list of (key, task) pairs for each of
+        the given uids. Keys are line numbers in todo.txt, or ``x<line>``
+        for tasks in done.txt if include_archive is True.
+
+        Tasks are found through the uid index kept with the cached tasks,
+        so neither file is scanned once it has been read.
+        """
+        found = {uid: [] for uid in uids}
+        for path, make_key in self._uid_sources(include_archive):
+            name = self._stored_list(path)
+            if name is not None:
+                for uid, rows in self.storage.find_uids(name, found).items():
+                    found[uid].extend(
+                        (make_key(key), self.task_class.from_text(line))
+                        for key, line in rows
+                    )
+                continue
+            if not os.path.exists(path):
+                continue
+            tasks, index = self._indexed_tasks(path)
+            for uid, pairs in found.items():
+                for key in sorted(index.uids.get(uid, ())):
+                    pairs.append((make_key(key), tasks[key].copy()))
+        return found
+
+    def find_by_uid(self, uid, include_archive=True):
+        """find_by_uid(uid [,include_archive])
+        Returns a list of (key, task) pairs for the tasks with the given
+        uid. See :meth:`find_by_uids`.
+        """
+        return self.find_by_uids([uid], include_archive)[uid]
+
+    def duplicate_uids(self, include_archive=False):
+        """duplicate_uids([include_archive])
+        Returns a dictionary of uid, list of keys pairs for every uid used
+        by more than one task.
+        """
+        keys = defaultdict(list)
+        for path, make_key in self._uid_sources(include_archive):
+            name = self._stored_list(path)
+            if name is not None:
+                for uid, found in self.storage.duplicate_uids(name).items():
+                    keys[uid].extend(make_key(key) for key in found)
+                continue
+            if not os.path.exists(path):
+                continue
+            for uid, found in self.get_index(path).uids.items():
+                keys[uid].extend(make_key(key) for key in sorted(found))
+        return {uid: found for uid, found in keys.items() if len(found) > 1}
+
     def get_counts(self, kind, include_archive=False, only_archive=False):
         """get_counts(kind, include_archive, only_archive)
         Returns a dictionary of :class:`collections.Counter` objects.
@@ -820,6 +2027,37 @@ class TaskLib(object):
             getter = attrgetter("contexts")
         else:
             raise ValueError("Should pass 'project' or 'context' to get_counts")
+
+        if self.storage is not None:
+            names = []
+            if not only_archive:
+                names.append("todo")
+            if include_archive or only_archive:
+                names.append("done")
+            return self.storage.counts(
+                names, kind, datetime.date.today().toordinal()
+            )
+
+        if self.rollups is not None and not (
+            self.session is not None and self.session.dirty and not only_archive
+        ):
+            parts = []
+            if not only_archive:
+                parts.append(self.config["Files"]["task-path"])
+            if include_archive or only_archive:
+                parts.append(self.config["Files"]["done-path"])
+            for path in parts:
+                if not self.rollups.current(
+                    self._file_part(path), signature(path), path
+                ):
+                    self._rebuild_rollup(path)
+            return self.rollups.counts(
+                [self._file_part(path) for path in parts], kind
+            )
+
+        if self.config["Tasker"].getboolean("use-table", False):
+            return self.get_table(include_archive, only_archive).counts(kind)
+
         res = defaultdict(Counter)
         nothing = "NO {}".format(kind)
 
@@ -844,26 +2082,138 @@ class TaskLib(object):
 
         return res
 
+    def _file_part(self, path):
+        """Returns "todo" or "done" for the task-path and done-path files,
+        the names of their rollup parts and storage lists"""
+        path = os.path.abspath(path)
+        if path == os.path.abspath(self.config["Files"]["task-path"]):
+            return "todo"
+        if path == os.path.abspath(self.config["Files"]["done-path"]):
+            return "done"
+        return None
+
+    def _stored_list(self, path):
+        """Returns the storage list that holds path, or None if the tasks
+        of path are kept in the file itself"""
+        if self.storage is None:
+            return None
+        return self._file_part(path)
+
+    def import_tasks(self):
+        """import_tasks()
+        Replaces the tasks in the storage backend with the contents of
+        todo.txt and done.txt.
+        """
+        if self.storage is None:
+            return TASK_ERROR, "Tasks are stored in the text files"
+        count = 0
+        for key in ("task-path", "done-path"):
+            path = self.config["Files"][key]
+            if os.path.exists(path):
+                self.log.info("Importing %s", path)
+                count += self.storage.import_file(
+                    self._file_part(path), path, FILE_ENCODING
+                )
+        return TASK_OK, "{:d} Tasks imported".format(count)
+
+    def export_tasks(self):
+        """export_tasks()
+        Writes the tasks in the storage backend to todo.txt and done.txt.
+        """
+        if self.storage is None:
+            return TASK_ERROR, "Tasks are stored in the text files"
+        count = 0
+        for key in ("task-path", "done-path"):
+            path = self.config["Files"][key]
+            self.log.info("Exporting %s", path)
+            count += self.storage.export_file(
+                self._file_part(path), path, FILE_ENCODING
+            )
+        return TASK_OK, "{:d} Tasks exported".format(count)
+
+    def _rebuild_rollup(self, path, tasks=None):
+        """Recounts the rollups of path from tasks, or from the file"""
+        part = self._file_part(path)
+        if self.rollups is None or part is None:
+            return
+        sig = signature(path)
+        if sig is None:
+            self.rollups.rebuild(part, (), sig)
+            return
+        started = time.perf_counter()
+        digest = None
+        if tasks is None:
+            self.log.info("Counting projects and contexts in %s", path)
+            tasks = (task for __, task in self._scan_tasks(path))
+            if self.cache is not None:
+                # the digest the cache validated the tasks with
+                entry = self._cache_entry(path)
+                tasks, digest = entry.tasks.values(), entry.digest
+        self.rollups.rebuild(part, tasks, sig, digest or read_digest(path))
+        self.log.info(
+            "Counted %s in %.2f seconds", path, time.perf_counter() - started
+        )
+
+    def _update_rollup(self, path, before, added=(), removed=()):
+        """Adjusts the rollups of path after a write"""
+        part = self._file_part(path)
+        if self.rollups is None or part is None:
+            return
+        self.rollups.update(part, before, signature(path), added, removed)
+
+    def rebuild_rollups(self):
+        """rebuild_rollups()
+        Recounts the project and context rollups of both files.
+        """
+        if self.rollups is None:
+            return TASK_ERROR, "Rollups are turned off"
+        for path in (
+            self.config["Files"]["task-path"],
+            self.config["Files"]["done-path"],
+        ):
+            self._rebuild_rollup(path)
+        return TASK_OK, "Rollups rebuilt"
+
     def archive_tasks(self, tasks_to_archive):
         """archive_tasks(list of task IDS)
         This does the actual archiving. It assumes the calling method
         has already confirmed tasks are archiveable.
+        Returns TASK_OK, message, or TASK_ERROR, message if a session
+        could not write todo.txt. Nothing is archived if the task file
+        changed outside the session.
         """
-        tasks = self.get_tasks(self.config["Files"]["task-path"])
-        done = self.get_tasks(self.config["Files"]["done-path"])
+        session = self.session
+        if session is not None and session.conflicted:
+            if session.dirty:
+                self.log.error("%s changed outside this session", session.path)
+                return TASK_ERROR, "Task file changed outside this session"
+            # nothing is held, so start again from the file
+            self.log.info("Reloading %s", session.path)
+            session.reload(self.parse_tasks(session.path))
 
-        next_done = max(done) + 1 if done else 1
+        tasks = self.get_tasks(self.config["Files"]["task-path"])
 
-        for key in tasks_to_archive:
-            done[next_done] = tasks[key]
-            next_done += 1
-            tasks.pop(key)
+        archived = [tasks.pop(key) for key in tasks_to_archive]
 
+        # done.txt is only appended to, and is written first so a failure
+        # part way through duplicates tasks rather than losing them
+        done_path = self.config["Files"]["done-path"]
+        if self.storage is not None:
+            self.storage.append_tasks("done", archived)
+        else:
+            before = signature(done_path)
+            self.archive.append(archived)
+            self._update_rollup(done_path, before, added=archived)
         self.write_tasks(tasks, self.config["Files"]["task-path"])
-        self.write_tasks(done, self.config["Files"]["done-path"])
+        if session is not None:
+            # done.txt has already been written, keep todo.txt in step
+            res = self.flush()
+            if res[0] == TASK_ERROR:
+                return res
 
         msg = f"Archived {len(tasks_to_archive)} tasks"
         self.log.info(msg)
+        return TASK_OK, msg
 
 
 if __name__ == "__main__":
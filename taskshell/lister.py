@@ -3,10 +3,22 @@
 Created on Fri Mar 18 12:39:22 2016
 
 @author: jenglish
+
+Prints rows of values as a table with a column for each header.
+
+Each cell is split into its leading ANSI color codes and its text once,
+and the column widths are measured from the text in a single pass.
+Columns whose cells are all numbers are aligned to the right.
+
+:func:`print_list` measures every row before printing. For very large
+reports :func:`stream_list` measures only the first rows, or takes fixed
+widths, and prints the rest as they come.
 """
 from __future__ import print_function
 
 import re
+import sys
+import itertools
 
 # https://stackoverflow.com/questions/2186919
 # https://stackoverflow.com/questions/4963691
@@ -14,39 +26,126 @@ split_ANSI_escape_sequences = re.compile(r"""
     (?P<col>(\x1b\[[;\d]*[A-Za-z])*)(?P<text>.*)
     """, re.VERBOSE).match
 
+re_number = re.compile(r"[-+]?\d+(\.\d*)?%?$")
+
+# rows measured by stream_list when no widths are given
+SAMPLE_ROWS = 200
+
+# lines written to the stream at a time
+WRITE_BLOCK = 1000
+
 
 def split_ANSI(s):
     return split_ANSI_escape_sequences(str(s)).groupdict()
 
 
+def split_cell(value):
+    """Returns the color codes and the text of a cell"""
+    text = str(value)
+    if "\x1b" not in text:
+        return "", text
+    match = split_ANSI_escape_sequences(text)
+    return match.group("col"), match.group("text")
+
+
+def split_row(thing):
+    """Returns the split cells of a row, which is a tuple or list of
+    values or a single value"""
+    if isinstance(thing, (tuple, list)):
+        return [split_cell(item) for item in thing]
+    return [split_cell(thing)]
+
+
+class TableWriter(object):
+    """TableWriter(headers [,widths, stream])
+
+    Writes rows under headers.
+
+    :param list headers: column headers
+    :param list widths: fixed column widths, or None to measure them
+    :param stream: file to write to, standard output by default
+    """
+
+    def __init__(self, headers, widths=None, stream=None):
+        self.headers = [h.strip() for h in headers]
+        self.widths = list(widths) if widths else None
+        self.stream = stream
+
+    def measure(self, rows):
+        """Returns the widths of the columns and whether each holds only
+        numbers, from split rows"""
+        widths = [len(header) for header in self.headers]
+        numeric = [None] * len(widths)
+        for cells in rows:
+            if len(cells) > len(widths):
+                extra = len(cells) - len(widths)
+                widths.extend([0] * extra)
+                numeric.extend([None] * extra)
+            for idx, (col, text) in enumerate(cells):
+                if len(text) > widths[idx]:
+                    widths[idx] = len(text)
+                if text and numeric[idx] is not False:
+                    numeric[idx] = re_number.match(text) is not None
+        return widths, [bool(flag) for flag in numeric]
+
+    def lines(self, rows, widths, numeric):
+        """Yields the header, the rule and a line for each split row"""
+        formats = [
+            "{}{:>%d} " % width if right else "{}{:%d} " % width
+            for width, right in zip(widths, numeric)
+        ]
+        yield "".join(
+            fmt.format("", header) for fmt, header in zip(formats, self.headers)
+        ) + "\n"
+        yield " ".join("-" * width for width in widths) + "\n"
+        for cells in rows:
+            if len(cells) > len(formats):
+                formats.extend("{}{} " for __ in range(len(cells) - len(formats)))
+            yield "".join(
+                fmt.format(col, text) for fmt, (col, text) in zip(formats, cells)
+            ) + "\n"
+
+    def write(self, things, sample=None):
+        """write(things [,sample])
+
+        Writes the table. Unless the writer has fixed widths, they are
+        measured from the first *sample* rows, or from all of them if
+        *sample* is None; longer cells in later rows are not cut.
+        """
+        things = iter(things)
+        measured = []
+        for thing in things:
+            measured.append(split_row(thing))
+            if sample is not None and len(measured) >= sample:
+                break
+        widths, numeric = self.measure(measured)
+        if self.widths:
+            widths = self.widths + widths[len(self.widths):]
+
+        rows = itertools.chain(measured, (split_row(thing) for thing in things))
+        stream = self.stream or sys.stdout
+        block = []
+        for line in self.lines(rows, widths, numeric):
+            block.append(line)
+            if len(block) == WRITE_BLOCK:
+                stream.write("".join(block))
+                block = []
+        stream.write("".join(block))
+        stream.flush()
+
+
 def print_list(things, headers):
-    headers = [h.strip() for h in headers]
-    lengths = [len(header) for header in headers]
-
-    for thing in things:
-        if isinstance(things[0], tuple):
-            for thing in things:
-                for idx, item in enumerate(thing):
-                    lengths[idx] = max(lengths[idx], len(split_ANSI(item)['text']))
-        else:
-            lengths[0] = max(lengths[0], len(split_ANSI(thing)['text']))
-
-    # header_row = ' '.join(headers)
-    for idx, header in enumerate(headers):
-        print("{0:{1}} ".format(header, lengths[idx]), end='')
-    print('')
-    print(*['-' * l for l in lengths], sep=" ")
-    for thing in things:
-        if isinstance(thing, tuple):
-            for idx, item in enumerate(thing):
-                d = split_ANSI(item)
-                col = d.get('col', '')
-                text = d.get('text', 'OOPS!')
-
-                print("{0}{1:{2}s} ".format(col, text, lengths[idx]), end='')
-        else:
-            print(thing, end="")
-        print('')
+    """Prints the rows *things* under *headers*, measuring every row"""
+    TableWriter(headers).write(things)
+
+
+def stream_list(things, headers, widths=None, sample=SAMPLE_ROWS):
+    """stream_list(things, headers [,widths, sample])
+
+    Prints rows as they are produced, with column widths given by
+    *widths* or measured from the first *sample* rows.
+    """
+    TableWriter(headers, widths).write(things, sample)
 
 
 if __name__ == '__main__':
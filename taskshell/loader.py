@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""
+Parallel Loader
+
+Parses a large task file on several cores. The file is split into byte
+ranges that end on a newline, each range is parsed by
+:meth:`Task.from_text` in a worker process, and the pieces are numbered
+in order so the line numbers match a serial parse.
+
+Small files are parsed serially, as starting the workers costs more than
+the parse itself.
+"""
+
+import io
+import os
+import logging
+
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from .cache import LineIndex, iter_lines, file_digest
+
+# files smaller than this are parsed serially
+PARALLEL_MIN_BYTES = 8 * 1024 * 1024
+# no worker is given less than this many bytes
+CHUNK_MIN_BYTES = 2 * 1024 * 1024
+
+
+def cpu_count():
+    """Returns the number of cores this process may run on"""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def worker_count(
+    size, workers=None, min_bytes=PARALLEL_MIN_BYTES, chunk_bytes=CHUNK_MIN_BYTES
+):
+    """worker_count(size [,workers, min_bytes, chunk_bytes])
+    Returns how many processes to parse a file of *size* bytes with, so
+    that none gets less than *chunk_bytes*. 1 means the file should be
+    parsed serially.
+    """
+    if size < min_bytes:
+        return 1
+    workers = workers or cpu_count()
+    return max(1, min(workers, size // max(1, chunk_bytes)))
+
+
+def chunk_ranges(data, count):
+    """chunk_ranges(data, count)
+    Splits *data* into at most *count* (start, end) byte ranges, each
+    ending just after a newline or at the end of the data.
+    """
+    ranges = []
+    start = 0
+    size = len(data)
+    for part in range(1, count):
+        end = data.find(b"\n", max(start, size * part // count))
+        if end < 0:
+            break
+        end += 1
+        if end > start:
+            ranges.append((start, end))
+            start = end
+    if start < size or not ranges:
+        ranges.append((start, size))
+    return ranges
+
+
+def parse_range(path, start, end, encoding, task_class):
+    """parse_range(path, start, end, encoding, task_class)
+    Parses the lines between two byte offsets of a file. Returns the
+    tasks and the start and end offsets of their lines in the file.
+    """
+    with open(path, "rb") as fp:
+        fp.seek(start)
+        data = fp.read(end - start)
+    return parse_data(data, start, encoding, task_class)
+
+
+def parse_data(data, offset, encoding, task_class):
+    """parse_data(data, offset, encoding, task_class)
+    Parses the lines in *data*, which starts *offset* bytes into its file.
+    Returns the same as :func:`parse_range`.
+    """
+    tasks = []
+    starts = array("Q")
+    ends = array("Q")
+    for line_start, line_end, text in iter_lines(io.BytesIO(data), encoding):
+        tasks.append(task_class.from_text(text))
+        starts.append(offset + line_start)
+        ends.append(offset + line_end)
+    return tasks, starts, ends
+
+
+def load_tasks(
+    path,
+    task_class,
+    encoding,
+    workers=None,
+    min_bytes=PARALLEL_MIN_BYTES,
+    chunk_bytes=CHUNK_MIN_BYTES,
+):
+    """load_tasks(path, task_class, encoding [,workers, min_bytes, chunk_bytes])
+    Parses a whole task file, in parallel if it is large enough.
+
+    :return: (stat, digest, tasks, lines) where tasks is a dictionary of
+        line number, task pairs and lines their :class:`LineIndex`
+    """
+    log = logging.getLogger("taskerLogger")
+    with open(path, "rb") as fp:
+        stat = os.fstat(fp.fileno())
+        data = fp.read()
+    digest = file_digest(data)
+    count = worker_count(len(data), workers, min_bytes, chunk_bytes)
+
+    pieces = None
+    if count > 1:
+        ranges = chunk_ranges(data, count)
+        log.debug("Parsing %s in %d chunks", path, len(ranges))
+        try:
+            with ProcessPoolExecutor(max_workers=len(ranges)) as pool:
+                futures = [
+                    pool.submit(parse_range, path, start, end, encoding, task_class)
+                    for start, end in ranges
+                ]
+                pieces = [future.result() for future in futures]
+        except (OSError, BrokenProcessPool) as error:
+            log.warning("Parallel parse of %s failed: %s", path, error)
+            pieces = None
+        # the workers read the file again, so it must not have changed
+        if pieces is not None:
+            after = os.stat(path)
+            if (after.st_size, after.st_mtime_ns) != (stat.st_size, stat.st_mtime_ns):
+                log.warning("%s changed while parsing, parsing serially", path)
+                pieces = None
+
+    if pieces is None:
+        pieces = [parse_data(data, 0, encoding, task_class)]
+
+    tasks = {}
+    lines = LineIndex()
+    for chunk_tasks, starts, ends in pieces:
+        tasks.update(enumerate(chunk_tasks, len(tasks) + 1))
+        lines.starts.extend(starts)
+        lines.ends.extend(ends)
+    return stat, digest, tasks, lines
@@ -76,6 +76,10 @@ class ChecklistCmd(minioncmd.MinionCmd):
 
     Store complex repetitive tasks witohut cluttering the task list"""
 
+    # commands that prompt or open a browser, so the daemon leaves them
+    # to the client
+    interactive_commands = ("new", "html")
+
     def __init__(self, completekey="tab", stdin=None, stdout=None, checklib=None):
         super().__init__(
             "checklist", completekey=completekey, stdin=stdin, stdout=stdout
@@ -671,10 +675,13 @@ class ChecklistLib(object):
         if taskdone:
             # complete the corresponding main task
             if task.attrib.get("uid"):
-                tasks = self._tasklib.sort_tasks(
-                    filters=[f"uid:{task.attrib.get('uid')}"],
-                    hidedate = datetime.date.max
-                )
+                tasks = [
+                    (key, linked)
+                    for key, linked in self._tasklib.find_by_uid(
+                        task.attrib.get("uid"), include_archive=False
+                    )
+                    if not linked.complete
+                ]
                 if len(tasks) == 1:
                     self.log.info(
                         "Checklist task complete, marking linked tast as done"
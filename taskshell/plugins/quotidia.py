@@ -58,6 +58,9 @@ class QuotidiaCmd(minioncmd.MinionCmd):
 
     Manage scheduled tasks"""
 
+    # commands that prompt, so the daemon leaves them to the client
+    interactive_commands = ("new",)
+
     def __init__(self, completekey="tab", stdin=None, stdout=None, qlib=None):
         super().__init__(
             "quotidia", completekey=completekey, stdin=stdin, stdout=stdout
@@ -207,6 +210,8 @@ class QuotidiaLib(object):
 
         self.directory = pathlib.Path(directory) / "quotidia"
         self.directory.mkdir(exist_ok=True)
+        # date on_startup last scheduled the quotidia
+        self.stamp_path = self.directory / ".last-startup"
 
         self.qids = {}
         self.now = datetime.datetime.now()
@@ -239,6 +244,11 @@ class QuotidiaLib(object):
             json.dump(q, qf, cls=QuotidiaEncoder)
         self.log.info("Saved %s", fname)
 
+    def save_quotidia(self, quotidia):
+        "saves several quotidia after a batch of changes"
+        for q in quotidia:
+            self.save_quotidium(q)
+
     def activate_quotidium(self, qid):
         q = self.qids[qid]
         self.log.debug("Activating quotidium %s", qid)
@@ -297,19 +307,50 @@ class QuotidiaLib(object):
                 q_to_run.append(q)
         return q_to_run
 
-    def run_quotidium(self, qid):
+    def run_quotidium(self, qid, save=True):
         if qid not in self.qids:
             self.log.critical("Cannot run qid %s: does not exist", qid)
             raise ValueError("Cannot run qid %s: does not exist" % qid)
         self.qids[qid].history.insert(0, datetime.date.today())
-        self.save_quotidium(self.qids[qid])
+        if save:
+            self.save_quotidium(self.qids[qid])
+
+    def last_startup(self):
+        "returns the date on_startup last ran, or None"
+        try:
+            return datetime.date.fromisoformat(self.stamp_path.read_text().strip())
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def open_qids(self):
+        "returns the set of qids that have an open task"
+        tasks = self._tasklib.get_tasks(self._tasklib.config["Files"]["task-path"])
+        return {
+            task.extensions.get("qid")
+            for task in tasks.values()
+            if not task.complete and "qid" in task.extensions
+        }
 
     def on_startup(self):
-        for (a, b) in self.get_todays_quotidia():
-            # check if an open task on that quotidia exists
-            qtasks = self._tasklib.list_tasks(filters=[f"{{qid:{a}}}"])
-            if qtasks:
-                continue
-            self.run_quotidium(a)
-            self._tasklib.add_task(b.task_text)
-            self.log.info("Adding Quotidia for %s", a)
+        # the schedule only changes with the date, so this runs once a day
+        today = datetime.date.today()
+        if self.last_startup() == today:
+            self.log.debug("Quotidia already scheduled today")
+            return
+
+        due = sorted(self.get_todays_quotidia(), key=operator.itemgetter(0))
+        if due:
+            open_qids = self.open_qids()
+            ran = []
+            for (a, b) in due:
+                # skip the quotidia that still have an open task
+                if a in open_qids:
+                    continue
+                self.run_quotidium(a, save=False)
+                ran.append(b)
+                self.log.info("Adding Quotidia for %s", a)
+            if ran:
+                self._tasklib.add_tasks([q.task_text for q in ran])
+                self.save_quotidia(ran)
+
+        self.stamp_path.write_text(today.isoformat())
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+Startup Profiler
+
+Records how long each phase of startup takes: reading the configuration,
+setting up logging, building the argument parser, loading plugins,
+creating their libraries and running their ``on_startup`` hooks.
+
+Phases are always recorded, as a phase costs two calls to
+:func:`time.perf_counter_ns`. ``s --profile-startup`` prints the
+breakdown and ``s --profile-json FILE`` writes it as JSON.
+"""
+
+import sys
+import json
+import time
+import contextlib
+
+
+class StartupProfiler(object):
+    """StartupProfiler()
+
+    Collects timed phases. Phases can be nested, and each is reported
+    under the names of the phases that contain it.
+    """
+
+    def __init__(self):
+        self.started_ns = time.perf_counter_ns()
+        self.phases = []
+        self._stack = []
+
+    def begin(self, name):
+        """Starts the phase *name*, which lasts until :meth:`end`"""
+        self._stack.append((name, time.perf_counter_ns()))
+
+    def end(self):
+        """Ends the phase started last"""
+        end = time.perf_counter_ns()
+        name, start = self._stack.pop()
+        path = " > ".join([outer for outer, __ in self._stack] + [name])
+        self.phases.append((path, start, end))
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Times the block of a with statement as the phase *name*"""
+        self.begin(name)
+        try:
+            yield
+        finally:
+            self.end()
+
+    def elapsed_ns(self):
+        """Nanoseconds since the profiler was created"""
+        return time.perf_counter_ns() - self.started_ns
+
+    def breakdown(self):
+        """Returns a list of dictionaries with the name, start and duration
+        (in milliseconds) of each phase, longest first"""
+        rows = [
+            {
+                "phase": path,
+                "start_ms": (start - self.started_ns) / 1e6,
+                "duration_ms": (end - start) / 1e6,
+            }
+            for path, start, end in self.phases
+        ]
+        rows.sort(key=lambda row: row["duration_ms"], reverse=True)
+        return rows
+
+    def report(self, stream=None):
+        """Prints the breakdown as a table"""
+        stream = stream or sys.stderr
+        total = self.elapsed_ns() / 1e6
+        rows = self.breakdown()
+        width = max([len(row["phase"]) for row in rows] + [len("phase")])
+        print(
+            "{:<{w}}  {:>9}  {:>9}  {:>6}".format(
+                "phase", "start ms", "ms", "%", w=width
+            ),
+            file=stream,
+        )
+        for row in rows:
+            print(
+                "{:<{w}}  {:>9.2f}  {:>9.2f}  {:>6.1f}".format(
+                    row["phase"],
+                    row["start_ms"],
+                    row["duration_ms"],
+                    100 * row["duration_ms"] / total if total else 0,
+                    w=width,
+                ),
+                file=stream,
+            )
+        print(
+            "{:<{w}}  {:>9}  {:>9.2f}".format("total", "", total, w=width),
+            file=stream,
+        )
+
+    def write_json(self, path):
+        """Writes the breakdown and total to a JSON file"""
+        with open(path, "w", encoding="utf-8") as fp:
+            json.dump(
+                {"total_ms": self.elapsed_ns() / 1e6, "phases": self.breakdown()},
+                fp,
+                indent=2,
+            )
+
+
+# shared by every module that takes part in startup
+profiler = StartupProfiler()
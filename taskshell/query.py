@@ -0,0 +1,400 @@
+# -*- coding: utf-8 -*-
+"""
+Task Queries
+
+A small filter language for :meth:`TaskLib.sort_tasks`. A query is
+compiled once into a tree of predicates::
+
+    +garden AND (pri:A-C OR @phone) NOT @waiting start>=2020-06-01
+
+Terms:
+
+* ``word`` - the task text contains word (case insensitive)
+* ``+project`` and ``@context`` - the task has the project or context
+* ``(A)``, ``pri:A``, ``pri:A-C`` - the task has one of the priorities,
+  ``pri:`` matches tasks without a priority
+* ``ext:key=value`` or ``ext:key`` - the task has the extension
+* ``start`` or ``end`` followed by ``<``, ``<=``, ``>``, ``>=``, ``=`` or
+  ``!=`` and an ISO date or ``today``
+
+Terms are combined with ``AND``, ``OR`` and ``NOT`` (or ``~``) and grouped
+with parentheses. Terms next to each other are joined by ``AND``, which
+binds tighter than ``OR``.
+
+Each node has a cost, and the children of ``AND`` and ``OR`` nodes are
+tested cheapest first. Given a :class:`TaskIndex`, :meth:`Query.plan`
+also orders them by how many tasks they can match and returns the
+candidate line numbers the index can narrow the query down to.
+"""
+
+import re
+import datetime
+import operator
+
+from abc import ABC, abstractmethod
+from functools import lru_cache
+
+re_token = re.compile(r"\s*(?:(?P<pri>\([A-Z]\))|(?P<op>[()~])|(?P<word>[^\s()~]+))")
+re_date_term = re.compile(r"^(?P<field>start|end)(?P<op><=|>=|!=|<|>|=)(?P<value>.+)$")
+re_pri_range = re.compile(r"^(?:(?P<low>[A-Z])(?:-(?P<high>[A-Z]))?)?$")
+
+COMPARISONS = {
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+    "=": operator.eq,
+    "!=": operator.ne,
+}
+
+
+class QueryError(ValueError):
+    """Raised for a query that cannot be compiled"""
+
+
+class Node(ABC):
+    """A predicate over tasks"""
+
+    cost = 1
+
+    @abstractmethod
+    def __call__(self, task):
+        """Returns True if *task* matches"""
+
+    def candidates(self, index):
+        """Returns the keys of every task in *index* that could match, or
+        None if the index cannot narrow this node down."""
+        return None
+
+    def plan(self, index):
+        """Orders the node for evaluation against *index* and returns its
+        candidates"""
+        return self.candidates(index)
+
+
+class Word(Node):
+    cost = 4
+
+    def __init__(self, word):
+        self.word = word.lower()
+
+    def __call__(self, task):
+        return self.word in task.text.lower()
+
+    def candidates(self, index):
+        return index.word(self.word)
+
+    def __repr__(self):
+        return "Word(%r)" % self.word
+
+
+class Project(Node):
+    cost = 2
+    attribute = "projects"
+
+    def __init__(self, name):
+        self.name = name
+
+    def __call__(self, task):
+        return self.name in getattr(task, self.attribute)
+
+    def candidates(self, index):
+        return getattr(index, self.attribute).get(self.name, set())
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, self.name)
+
+
+class Context(Project):
+    attribute = "contexts"
+
+
+class Priority(Node):
+    cost = 1
+
+    def __init__(self, priorities):
+        self.priorities = frozenset(priorities)
+
+    def __call__(self, task):
+        return task.priority in self.priorities
+
+    def candidates(self, index):
+        found = set()
+        for pri in self.priorities:
+            found |= index.priorities.get(pri, set())
+        return found
+
+    def __repr__(self):
+        return "Priority(%r)" % "".join(sorted(self.priorities))
+
+
+class Extension(Node):
+    cost = 2
+
+    def __init__(self, key, value=None):
+        self.key = key
+        self.value = value
+
+    def __call__(self, task):
+        if self.value is None:
+            return self.key in task.extensions
+        return task.extensions.get(self.key) == self.value
+
+    def candidates(self, index):
+        if self.key == "uid" and self.value is not None:
+            return index.uids.get(self.value, set())
+        return None
+
+    def __repr__(self):
+        return "Extension(%r, %r)" % (self.key, self.value)
+
+
+class DateCompare(Node):
+    cost = 3
+
+    def __init__(self, field, op, day):
+        self.field = field
+        self.op = op
+        self.day = day
+
+    def __call__(self, task):
+        stamp = getattr(task, self.field)
+        return stamp is not None and COMPARISONS[self.op](stamp.date(), self.day)
+
+    def __repr__(self):
+        return "DateCompare(%r, %r, %r)" % (self.field, self.op, self.day)
+
+
+class Not(Node):
+    def __init__(self, child):
+        self.child = child
+        self.cost = child.cost
+
+    def __call__(self, task):
+        return not self.child(task)
+
+    def plan(self, index):
+        self.child.plan(index)
+        return None
+
+    def __repr__(self):
+        return "Not(%r)" % self.child
+
+
+class Group(Node):
+    """Base for And and Or"""
+
+    def __init__(self, children):
+        self.children = sorted(children, key=lambda child: child.cost)
+        self.cost = sum(child.cost for child in self.children)
+
+    def __repr__(self):
+        return "%s(%s)" % (
+            self.__class__.__name__,
+            ", ".join(repr(child) for child in self.children),
+        )
+
+    def _plan_children(self, index):
+        found = [child.plan(index) for child in self.children]
+        # fewest matches first, then cheapest; unindexed children last
+        order = sorted(
+            range(len(found)),
+            key=lambda idx: (
+                found[idx] is None,
+                len(found[idx]) if found[idx] is not None else 0,
+                self.children[idx].cost,
+            ),
+        )
+        self.children = [self.children[idx] for idx in order]
+        return [found[idx] for idx in order]
+
+
+class And(Group):
+    def __call__(self, task):
+        return all(child(task) for child in self.children)
+
+    def candidates(self, index):
+        return self._combine([child.candidates(index) for child in self.children])
+
+    def plan(self, index):
+        return self._combine(self._plan_children(index))
+
+    def _combine(self, found):
+        result = None
+        for keys in found:
+            if keys is not None:
+                result = set(keys) if result is None else result & keys
+        return result
+
+
+class Or(Group):
+    def __call__(self, task):
+        return any(child(task) for child in self.children)
+
+    def candidates(self, index):
+        return self._combine([child.candidates(index) for child in self.children])
+
+    def plan(self, index):
+        return self._combine(self._plan_children(index))
+
+    def _combine(self, found):
+        result = set()
+        for keys in found:
+            if keys is None:
+                return None
+            result |= keys
+        return result
+
+
+class Everything(Node):
+    cost = 0
+
+    def __call__(self, task):
+        return True
+
+    def __repr__(self):
+        return "Everything()"
+
+
+class Query(object):
+    """Query(text)
+
+    A compiled query. Calling it with a task tests the task. Use
+    :func:`compile_query` to reuse compiled queries.
+    """
+
+    def __init__(self, text):
+        self.text = text
+        self.root = _Parser(text).parse()
+
+    def __call__(self, task):
+        return self.root(task)
+
+    def __repr__(self):
+        return "Query(%r)" % self.text
+
+    def plan(self, index):
+        """plan(index)
+        Orders the query for evaluation against the tasks in *index* and
+        returns the line numbers of the tasks that could match, or None if
+        every task has to be tested.
+        """
+        return self.root.plan(index)
+
+
+@lru_cache(maxsize=128)
+def compile_query(text):
+    """compile_query(text)
+    Returns the :class:`Query` for *text*, compiling it the first time.
+    Raises :class:`QueryError` if the query is not valid.
+    """
+    return Query(text)
+
+
+def _term(word):
+    if word.startswith("+") and len(word) > 1:
+        return Project(word)
+    if word.startswith("@") and len(word) > 1:
+        return Context(word)
+    if word.startswith("pri:"):
+        match = re_pri_range.match(word[4:])
+        if not match:
+            raise QueryError("Bad priority term %r" % word)
+        low, high = match.group("low"), match.group("high") or match.group("low")
+        if low is None:
+            return Priority([""])
+        if high < low:
+            raise QueryError("Bad priority range %r" % word)
+        return Priority(chr(code) for code in range(ord(low), ord(high) + 1))
+    if word.startswith("ext:"):
+        key, sep, value = word[4:].partition("=")
+        if not key:
+            raise QueryError("Bad extension term %r" % word)
+        return Extension(key, value if sep else None)
+    match = re_date_term.match(word)
+    if match:
+        value = match.group("value")
+        if value == "today":
+            day = datetime.date.today()
+        else:
+            try:
+                day = datetime.date.fromisoformat(value)
+            except ValueError:
+                raise QueryError("Bad date %r in %r" % (value, word)) from None
+        return DateCompare(match.group("field"), match.group("op"), day)
+    return Word(word)
+
+
+class _Parser(object):
+    """Recursive descent parser for the query grammar::
+
+        query   = or_expr
+        or_expr = and_expr ("OR" and_expr)*
+        and_expr = not_expr (["AND"] not_expr)*
+        not_expr = ("NOT" | "~") not_expr | "(" or_expr ")" | term
+    """
+
+    def __init__(self, text):
+        self.text = text
+        self.tokens = []
+        pos = 0
+        text = text.rstrip()
+        while pos < len(text):
+            match = re_token.match(text, pos)
+            kind = match.lastgroup
+            self.tokens.append((kind, match.group(kind)))
+            pos = match.end()
+        self.pos = 0
+
+    def peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        return None, None
+
+    def next(self):
+        token = self.peek()
+        self.pos += 1
+        return token
+
+    def parse(self):
+        if not self.tokens:
+            return Everything()
+        node = self.or_expr()
+        if self.pos < len(self.tokens):
+            raise QueryError("Unexpected %r in %r" % (self.peek()[1], self.text))
+        return node
+
+    def or_expr(self):
+        children = [self.and_expr()]
+        while self.peek() == ("word", "OR"):
+            self.next()
+            children.append(self.and_expr())
+        return children[0] if len(children) == 1 else Or(children)
+
+    def and_expr(self):
+        children = [self.not_expr()]
+        while True:
+            kind, value = self.peek()
+            if kind is None or value in ("OR", ")"):
+                break
+            if (kind, value) == ("word", "AND"):
+                self.next()
+            children.append(self.not_expr())
+        return children[0] if len(children) == 1 else And(children)
+
+    def not_expr(self):
+        kind, value = self.next()
+        if kind is None:
+            raise QueryError("Unexpected end of %r" % self.text)
+        if value == "~" or (kind, value) == ("word", "NOT"):
+            return Not(self.not_expr())
+        if value == "(":
+            node = self.or_expr()
+            if self.next()[1] != ")":
+                raise QueryError("Missing ) in %r" % self.text)
+            return node
+        if kind == "pri":
+            return Priority(value[1])
+        if value == ")" or value in ("AND", "OR"):
+            raise QueryError("Unexpected %r in %r" % (value, self.text))
+        return _term(value)
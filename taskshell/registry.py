@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+"""
+Plugin Registry
+
+Finds the ``tasker_commands``, ``tasker_library`` and ``tasker_minions``
+entry points without importing the plugins that provide them.
+
+Scanning the installed distributions is slow, so the result is saved to
+a JSON file along with the modification times of the directories on
+``sys.path``. Installing or removing a distribution changes the
+modification time of its site-packages directory, which makes the saved
+registry stale and triggers a new scan.
+
+A scan imports each plugin once, to record the hooks each library
+defines and the description of each command. After that a plugin is
+only imported when its command, minion or one of its hooks is used.
+"""
+
+import os
+import sys
+import json
+import logging
+import importlib
+
+from collections.abc import Mapping
+from importlib import metadata
+
+from .profiler import profiler
+
+REGISTRY_VERSION = 1
+
+GROUPS = ("tasker_commands", "tasker_library", "tasker_minions")
+
+# TaskLib methods call these on every library that defines them
+HOOKS = ("on_startup", "on_add_task", "on_complete_task")
+
+
+def path_stamp():
+    """Returns the modification times of the directories on sys.path"""
+    stamp = []
+    for entry in sys.path:
+        try:
+            stamp.append([entry, os.stat(entry or ".").st_mtime_ns])
+        except OSError:
+            pass
+    return stamp
+
+
+def load_object(value):
+    """Imports and returns the object named by an entry point value such
+    as ``package.module:attribute``"""
+    module_name, __, attrs = value.partition(":")
+    obj = importlib.import_module(module_name.strip())
+    for attr in filter(None, attrs.strip().split(".")):
+        obj = getattr(obj, attr)
+    return obj
+
+
+class Plugin(object):
+    """One entry point: its name, group, value and what the scan learned
+    about it"""
+
+    def __init__(self, name, group, value, hooks=(), description=None):
+        self.name = name
+        self.group = group
+        self.value = value
+        self.hooks = list(hooks)
+        self.description = description
+
+    def load(self):
+        """Imports the plugin and returns the object it names"""
+        with profiler.phase("import " + self.value):
+            return load_object(self.value)
+
+    def as_dict(self):
+        return {
+            "name": self.name,
+            "group": self.group,
+            "value": self.value,
+            "hooks": self.hooks,
+            "description": self.description,
+        }
+
+
+class PluginRegistry(object):
+    """PluginRegistry([path])
+
+    The entry points of the tasker groups, read from the JSON file at
+    *path* while it is current and scanned from the installed
+    distributions otherwise.
+    """
+
+    def __init__(self, path=None):
+        self.log = logging.getLogger("taskerLogger")
+        self.path = path
+        self.plugins = None
+
+    def entries(self, group):
+        """Returns the :class:`Plugin` list of an entry point group"""
+        if self.plugins is None:
+            with profiler.phase("plugin registry"):
+                self.plugins = self._load()
+        return [plugin for plugin in self.plugins if plugin.group == group]
+
+    def _load(self):
+        stamp = path_stamp()
+        if self.path:
+            try:
+                with open(self.path, encoding="utf-8") as fp:
+                    data = json.load(fp)
+                if data.get("version") == REGISTRY_VERSION and data["stamp"] == stamp:
+                    return [Plugin(**plugin) for plugin in data["plugins"]]
+                self.log.debug("Plugin registry %s is stale", self.path)
+            except FileNotFoundError:
+                pass
+            except (ValueError, KeyError, TypeError) as error:
+                self.log.warning(
+                    "Ignoring unreadable registry %s: %s", self.path, error
+                )
+
+        plugins = self._scan()
+        if self.path:
+            self._save(stamp, plugins)
+        return plugins
+
+    def _save(self, stamp, plugins):
+        temp = self.path + ".tmp"
+        data = {
+            "version": REGISTRY_VERSION,
+            "stamp": stamp,
+            "plugins": [plugin.as_dict() for plugin in plugins],
+        }
+        try:
+            with open(temp, "w", encoding="utf-8") as fp:
+                json.dump(data, fp)
+            os.replace(temp, self.path)
+        except OSError as error:
+            self.log.warning("Could not save plugin registry %s: %s", self.path, error)
+
+    def _scan(self):
+        self.log.debug("Scanning entry points for plugins")
+        with profiler.phase("scan entry points"):
+            found = metadata.entry_points()
+        plugins = []
+        for group in GROUPS:
+            if hasattr(found, "select"):
+                points = found.select(group=group)
+            else:
+                points = found.get(group, ())
+            for point in points:
+                plugin = Plugin(point.name, group, point.value)
+                if group != "tasker_minions":
+                    self._inspect(plugin)
+                plugins.append(plugin)
+        return plugins
+
+    def _inspect(self, plugin):
+        """Records the hooks of a library or the description of a command"""
+        try:
+            obj = plugin.load()
+        except Exception as error:
+            self.log.error("Could not load plugin %s: %s", plugin.value, error)
+            return
+        if plugin.group == "tasker_library":
+            plugin.hooks = [hook for hook in HOOKS if hasattr(obj, hook)]
+        else:
+            plugin.description = getattr(obj, "description", None)
+
+
+class LazyLibraries(Mapping):
+    """LazyLibraries(plugins, factory)
+
+    Mapping of library name to library instance that creates each library
+    the first time it is looked up.
+
+    :param plugins: :class:`Plugin` list of the ``tasker_library`` group
+    :param factory: callable that turns a library class into an instance
+    """
+
+    def __init__(self, plugins, factory):
+        self.plugins = {plugin.name: plugin for plugin in plugins}
+        self.factory = factory
+        self.loaded = {}
+
+    def __getitem__(self, name):
+        if name not in self.loaded:
+            plugin = self.plugins[name]
+            with profiler.phase("create library " + name):
+                self.loaded[name] = self.factory(plugin.load())
+        return self.loaded[name]
+
+    def __contains__(self, name):
+        # Mapping would create the library to answer this
+        return name in self.plugins
+
+    def __iter__(self):
+        return iter(self.plugins)
+
+    def __len__(self):
+        return len(self.plugins)
+
+    def with_hook(self, hook):
+        """Yields (name, library) for each library that defines hook,
+        creating only those libraries"""
+        for name, plugin in self.plugins.items():
+            if hook in plugin.hooks:
+                yield name, self[name]
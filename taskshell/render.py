@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""
+Task Rendering
+
+Turns a dictionary of numbered tasks into the lines printed by ``list``
+and the other task commands.
+
+The color theme is compiled once per listing into a table of escape
+sequences, hidden extensions are removed with one combined regular
+expression, and the lines are joined and written to the stream at once.
+Long listings can instead be streamed to a pager in blocks of lines.
+"""
+
+import re
+import sys
+import shlex
+import logging
+import contextlib
+import subprocess
+
+import colorama
+
+# lines sent to a pager at a time
+PAGER_BLOCK = 1000
+
+re_color = re.compile(
+    r"""
+    (?P<style>bright|dim|normal|resetall)?\s*
+    (?P<fore>black|blue|cyan|green|lightblack|magenta|red|reset|white|yellow)?
+    (\s+on\s+(?P<back>black|blue|cyan|green|lightblack|magenta|red|reset|white|yellow))?
+    """,
+    re.VERBOSE + re.IGNORECASE,
+)
+
+
+def get_color(text):
+    """Convert a textLib theme string to a colorama color"""
+    stuff = re_color.match(text).groupdict()
+    style = stuff.get("style") or ""
+    if style.upper() == "RESETALL":
+        style = "RESET_ALL"
+
+    fore = stuff.get("fore") or ""
+    if fore.upper() == "LIGHTBLACK":
+
+        fore = "LIGHTBLACK_EX"
+
+    back = stuff.get("back") or ""
+    if back.upper() == "LIGHTBLACK":
+        back = "LIGHTBLACK_EX"
+
+    res = []
+    if style:
+        res.append(getattr(colorama.Style, style.upper()))
+    if fore:
+        res.append(getattr(colorama.Fore, fore.upper()))
+    if back:
+        res.append(getattr(colorama.Back, back.upper()))
+    return "".join(res)
+
+
+def compile_theme(theme):
+    """Returns a dictionary of theme key (priority or ``Closed``) and
+    escape sequence"""
+    return {key: get_color(value) for key, value in theme.items()}
+
+
+def compile_hider(extensions):
+    """Returns a regular expression that matches any of the extensions,
+    with the space before it, or None if there are none to hide"""
+    names = sorted(set(ext for ext in extensions if ext))
+    if not names:
+        return None
+    return re.compile(r"\s{(?:%s):[^}]*}" % "|".join(map(re.escape, names)))
+
+
+class TaskRenderer(object):
+    """TaskRenderer(theme, extensions)
+
+    Formats numbered tasks with the colors of a theme.
+
+    :param dict theme: theme key, color description pairs, as in
+        :attr:`TaskLib.theme`
+    :param list extensions: names of the extensions to hide
+    """
+
+    def __init__(self, theme, extensions):
+        self.log = logging.getLogger("taskerLogger")
+        self.colors = compile_theme(theme)
+        self.hider = compile_hider(extensions)
+
+    def lines(self, taskdict, showext=False):
+        """Yields the lines listing the tasks, ending with the count"""
+        if not taskdict:
+            yield "No tasks found\n"
+            return
+        idlen = len(str(max(taskdict)))
+        colors = self.colors
+        closed = colors.get("Closed", "")
+        hider = None if showext else self.hider
+        reset = colorama.Style.RESET_ALL
+        for key, task in taskdict.items():
+            text = str(task)
+            if hider is not None:
+                text = hider.sub("", text)
+            color = closed if task.complete else colors.get(task.priority, "")
+            if color:
+                yield "{}{:{}d} {}{}\n".format(color, key, idlen, text, reset)
+            else:
+                yield "{:{}d} {}\n".format(key, idlen, text)
+        yield "{}{}\n".format(colorama.Fore.RESET, "_" * (idlen + 1))
+        yield "{:d} task{:s} shown\n".format(
+            len(taskdict), "" if len(taskdict) == 1 else "s"
+        )
+
+    def write(self, taskdict, showext=False, stream=None):
+        """Writes the listing to *stream* (standard output by default) in
+        one write"""
+        stream = stream or sys.stdout
+        stream.write("".join(self.lines(taskdict, showext)))
+        stream.flush()
+
+    def page(self, taskdict, command, showext=False):
+        """Streams the listing to the pager *command*, such as ``less -R``,
+        a block of lines at a time. Writes it to standard output if the
+        pager cannot be started."""
+        try:
+            pager = subprocess.Popen(
+                shlex.split(command),
+                stdin=subprocess.PIPE,
+                encoding=sys.stdout.encoding or "utf-8",
+                errors="replace",
+            )
+        except (OSError, ValueError) as error:
+            self.log.error("Could not start pager %s: %s", command, error)
+            self.write(taskdict, showext)
+            return
+        block = []
+        try:
+            for line in self.lines(taskdict, showext):
+                block.append(line)
+                if len(block) == PAGER_BLOCK:
+                    pager.stdin.write("".join(block))
+                    block = []
+            pager.stdin.write("".join(block))
+        except BrokenPipeError:
+            # the pager was closed before the end of the list
+            pass
+        finally:
+            with contextlib.suppress(BrokenPipeError):
+                pager.stdin.close()
+            pager.wait()
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""
+Rollup Store
+
+Materialized project and context counts for :meth:`TaskLib.get_counts`.
+
+Counts are kept separately for todo.txt and done.txt (the *parts* of the
+store), each with the size, modification time and digest of the file they
+were counted from. TaskLib adjusts the counts of a part as it writes to the
+file, and a part whose file was changed by anything else is recounted the
+next time it is used. As in :mod:`taskshell.cache`, counts made within
+:data:`RACY_WINDOW` of the file's modification time are checked against
+the digest of the file, so a same-size rewrite is not missed. Counts
+adjusted by TaskLib's own writes record no digest, and are trusted on the
+signature taken right after the write, so a write does not have to read
+the whole file again.
+
+Whether a task is hidden depends on the day, so hidden tasks are counted
+by the ordinal of the date they are revealed, and summed for the dates
+still in the future when the counts are read.
+"""
+
+import os
+import json
+import time
+import logging
+import datetime
+
+from collections import Counter, defaultdict
+
+from .cache import RACY_WINDOW, read_digest
+
+ROLLUP_VERSION = 2
+KINDS = ("PROJECT", "CONTEXT")
+
+
+def signature(path):
+    """Returns the (size, mtime_ns) of a file, or None if it is missing"""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def contributions(task):
+    """Yields (kind, name, label, hide ordinal) for each count a task adds
+    to, the same way :meth:`TaskLib.get_counts` counts it. The hide
+    ordinal is None for labels that are not affected by hiding."""
+    projects, contexts, hide = task.count_fields()
+    key = "closed" if task.complete else "open"
+    for kind, items in (("PROJECT", projects), ("CONTEXT", contexts)):
+        if not items:
+            yield kind, "NO {}".format(kind), key, hide
+        for item in items:
+            yield kind, item, key, hide
+            if task.priority:
+                yield kind, item, task.priority, None
+
+
+class RollupStore(object):
+    """RollupStore(path)
+
+    JSON file of project and context counts for each task file.
+    """
+
+    def __init__(self, path):
+        self.log = logging.getLogger("taskerLogger")
+        self.path = path
+        self.parts = {}
+        try:
+            with open(path, encoding="utf-8") as fp:
+                data = json.load(fp)
+            if data.get("version") == ROLLUP_VERSION:
+                self.parts = data["parts"]
+        except FileNotFoundError:
+            pass
+        except (ValueError, KeyError, AttributeError) as error:
+            self.log.warning("Ignoring unreadable rollups %s: %s", path, error)
+
+    def save(self):
+        temp = self.path + ".tmp"
+        try:
+            with open(temp, "w", encoding="utf-8") as fp:
+                json.dump({"version": ROLLUP_VERSION, "parts": self.parts}, fp)
+            os.replace(temp, self.path)
+        except OSError as error:
+            self.log.warning("Could not save rollups %s: %s", self.path, error)
+
+    def current(self, part, sig, path=None):
+        """current(part, sig [,path])
+        True if the counts of part were made from a file with this
+        signature. If path is given and the counts were made too soon
+        after the file was modified to trust its modification time, the
+        digest of the file is checked as well.
+        """
+        entry = self.parts.get(part)
+        if entry is None or entry["signature"] != sig:
+            return False
+        if path is None or sig is None:
+            return True
+        if entry["digest"] is None or entry["counted_ns"] - sig[1] >= RACY_WINDOW:
+            return True
+        if entry["digest"] != read_digest(path):
+            return False
+        self.log.debug("Rollups of %s verified by digest", path)
+        entry["counted_ns"] = time.time_ns()
+        self.save()
+        return True
+
+    def drop(self, part):
+        """Forgets the counts of a part, so they are rebuilt when next used"""
+        if self.parts.pop(part, None) is not None:
+            self.save()
+
+    def rebuild(self, part, tasks, sig, digest=None):
+        """rebuild(part, tasks, sig [,digest])
+        Recounts a part from every task in its file, which has the given
+        signature and hex digest.
+        """
+        self.parts[part] = {
+            "signature": sig,
+            "digest": digest,
+            "counted_ns": time.time_ns(),
+            "counts": {kind: {} for kind in KINDS},
+        }
+        self._apply(part, tasks, 1)
+        self.save()
+
+    def update(self, part, before, after, added=(), removed=()):
+        """update(part, before, after [,added, removed])
+        Adjusts the counts of a part for tasks added to and removed from
+        its file by a write that changed the file's signature from before
+        to after. If the counts did not describe the file before the write,
+        they are dropped instead.
+        """
+        if not self.current(part, before):
+            self.drop(part)
+            return
+        self._apply(part, removed, -1)
+        self._apply(part, added, 1)
+        entry = self.parts[part]
+        entry["signature"] = after
+        # the file is not read again to hash it
+        entry["digest"] = None
+        entry["counted_ns"] = time.time_ns()
+        self.save()
+
+    def _apply(self, part, tasks, delta):
+        counts = self.parts[part]["counts"]
+        for task in tasks:
+            for kind, name, label, hide in contributions(task):
+                names = counts[kind]
+                entry = names.setdefault(name, {})
+                entry[label] = entry.get(label, 0) + delta
+                if not entry[label]:
+                    del entry[label]
+                if hide is not None:
+                    hidden = entry.setdefault("hide", {})
+                    day = str(hide)
+                    hidden[day] = hidden.get(day, 0) + delta
+                    if not hidden[day]:
+                        del hidden[day]
+                    if not hidden:
+                        del entry["hide"]
+                if not entry:
+                    del names[name]
+
+    def counts(self, parts, kind, day=None):
+        """counts(parts, kind [,day])
+        Returns the dictionary :meth:`TaskLib.get_counts` would return for
+        the given parts, with tasks hidden after day (default today)
+        counted as hidden.
+        """
+        today = (day or datetime.date.today()).toordinal()
+        res = defaultdict(Counter)
+        for part in parts:
+            for name, entry in self.parts[part]["counts"][kind].items():
+                counter = res[name]
+                for label, value in entry.items():
+                    if label != "hide":
+                        counter[label] += value
+                        continue
+                    hidden = sum(n for day, n in value.items() if int(day) > today)
+                    if hidden:
+                        counter["hidden"] += hidden
+        return res
@@ -0,0 +1,119 @@
+"""Benchmark the fixed-width timestamp codec against strptime/strftime
+
+Usage: python bench_timestamps.py [TASKFILE ...]
+
+Checks that the codec produces byte-identical text to the strftime and
+strptime formats it replaces, for a spread of generated timestamps and
+for every line of any task files given, then times both implementations.
+"""
+
+import sys
+import random
+import datetime
+import timeit
+
+from taskshell.lib import (
+    Task,
+    TIMEFMT,
+    DATEFMT,
+    IDFMT,
+    parse_timestamp,
+    format_timestamp,
+    parse_date,
+    format_date,
+    format_uid,
+)
+
+
+def legacy_str(task):
+    """Task.__str__ as it was written with strftime"""
+    res = []
+    if task.complete:
+        res.append("x")
+    if task.priority and not task.complete:
+        res.append("(%s)" % task.priority)
+    if task.start:
+        res.append(task.start.strftime(TIMEFMT))
+    if task.end:
+        res.append(task.end.strftime(TIMEFMT))
+    res.append(task.text.strip())
+    return " ".join(res)
+
+
+def sample_datetimes(count, seed=2020):
+    rand = random.Random(seed)
+    low = datetime.datetime(1000, 1, 1).timestamp()
+    high = datetime.datetime(9999, 12, 31).timestamp()
+    return [
+        datetime.datetime.fromtimestamp(rand.uniform(low, high)).replace(
+            microsecond=rand.randrange(1000000)
+        )
+        for __ in range(count)
+    ]
+
+
+def check_codec(stamps):
+    errors = 0
+    for dt in stamps:
+        text = dt.strftime(TIMEFMT)
+        if format_timestamp(dt) != text:
+            errors += 1
+            print("format_timestamp mismatch:", text, format_timestamp(dt))
+        if parse_timestamp(text) != datetime.datetime.strptime(text, TIMEFMT):
+            errors += 1
+            print("parse_timestamp mismatch:", text)
+        day = dt.strftime(DATEFMT)
+        if format_date(dt) != day or format_date(parse_date(day)) != day:
+            errors += 1
+            print("date mismatch:", day)
+        if format_uid(dt) != dt.strftime(IDFMT):
+            errors += 1
+            print("format_uid mismatch:", dt.strftime(IDFMT))
+    return errors
+
+
+def check_file(path):
+    errors = lines = 0
+    with open(path) as fp:
+        for line in fp:
+            if not line.strip():
+                continue
+            lines += 1
+            task = Task.from_text(line)
+            if str(task) != legacy_str(task):
+                errors += 1
+                print("%s:%d round trip mismatch" % (path, lines))
+            again = Task.from_text(str(task))
+            if str(again) != str(task):
+                errors += 1
+                print("%s:%d reparse mismatch" % (path, lines))
+    print("%s: %d lines checked" % (path, lines))
+    return errors
+
+
+def main(paths):
+    stamps = sample_datetimes(20000)
+    errors = check_codec(stamps)
+    for path in paths:
+        errors += check_file(path)
+    print("%d mismatches" % errors)
+
+    texts = [dt.strftime(TIMEFMT) for dt in stamps]
+    number = 5
+    timings = [
+        (
+            "strptime",
+            lambda: [datetime.datetime.strptime(t, TIMEFMT) for t in texts],
+        ),
+        ("parse_timestamp", lambda: [parse_timestamp(t) for t in texts]),
+        ("strftime", lambda: [dt.strftime(TIMEFMT) for dt in stamps]),
+        ("format_timestamp", lambda: [format_timestamp(dt) for dt in stamps]),
+    ]
+    for name, func in timings:
+        best = min(timeit.repeat(func, number=number, repeat=3)) / number
+        print("{:<18} {:8.2f} us/call".format(name, best / len(texts) * 1e6))
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+Task Session
+
+Write-behind state for interactive use. While a session is open,
+:class:`TaskLib` keeps the task list in memory, changes only mark it dirty,
+and the whole list is written back in one atomic replace when the session
+is flushed.
+
+The file is not locked. Instead the size and modification time of the file
+are recorded whenever it is read or written, and a flush refuses to
+overwrite the file if either has changed in the meantime.
+"""
+
+import os
+import time
+import shutil
+import logging
+
+
+def _signature(path):
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+
+class Session(object):
+    """Session(path, tasks)
+
+    In-memory copy of a task file.
+
+    :param path: path of the task file
+    :param tasks: dictionary of line number, task pairs read from the file
+    """
+
+    def __init__(self, path, tasks):
+        self.log = logging.getLogger("taskerLogger")
+        self.path = path
+        self.tasks = tasks
+        self.signature = _signature(path)
+        self.dirty = False
+        self.pending = 0
+        self.last_flush = time.monotonic()
+        # TaskIndex of tasks, dropped whenever they change
+        self.index = None
+
+    def touch(self):
+        """Records a change to the tasks"""
+        self.dirty = True
+        self.pending += 1
+        self.index = None
+
+    @property
+    def conflicted(self):
+        "True if the file changed on disk since it was last read or written"
+        return _signature(self.path) != self.signature
+
+    def reload(self, tasks):
+        """reload(tasks)
+        Replaces the tasks with those just read from the file. Only safe
+        when no changes are held.
+        """
+        self.tasks = tasks
+        self.signature = _signature(self.path)
+        self.index = None
+
+    def due(self, interval=None, commands=None):
+        """due([interval, commands])
+        True if there are changes older than *interval* seconds or more
+        than *commands* changes waiting to be written.
+        """
+        if not self.dirty:
+            return False
+        if commands and self.pending >= commands:
+            return True
+        return bool(interval) and time.monotonic() - self.last_flush >= interval
+
+    def write(self, encoding, fsync=False):
+        """write(encoding [,fsync])
+        Writes the tasks to a temporary file next to the task file and
+        moves it into place, so the file is never left half written.
+        The tasks are renumbered to match their lines in the file. If the
+        task file is a symbolic link, the file it points to is replaced
+        and keeps its permissions.
+        """
+        # lines are numbered by their position once they are written
+        self.tasks = {
+            idx: self.tasks[key] for idx, key in enumerate(sorted(self.tasks), 1)
+        }
+        self.index = None
+        target = os.path.realpath(self.path)
+        temp = target + ".tmp"
+        with open(temp, "w", encoding=encoding) as fp:
+            for linenum in sorted(self.tasks):
+                fp.write("{}{}".format(self.tasks[linenum], "\n"))
+            if fsync:
+                fp.flush()
+                os.fsync(fp.fileno())
+        if os.path.exists(target):
+            shutil.copymode(target, temp)
+        os.replace(temp, target)
+        self.signature = _signature(self.path)
+        self.dirty = False
+        self.pending = 0
+        self.last_flush = time.monotonic()
@@ -0,0 +1,419 @@
+# -*- coding: utf-8 -*-
+"""
+Task Storage
+
+Backends that keep the task list somewhere other than todo.txt and
+done.txt. :class:`TaskLib` still addresses tasks by the configured file
+paths; each path is mapped to a named list (``todo`` or ``done``) and the
+backend stores the lists however it likes.
+
+Set ``storage`` in the ``[Tasker]`` section to pick a backend. ``file``,
+the default, uses the text files directly and does not go through this
+module. ``sqlite`` uses :class:`SQLiteStorage`, a database at
+``database-path``.
+"""
+
+import os
+import sqlite3
+import logging
+import contextlib
+
+from collections import Counter, defaultdict
+
+from .index import re_pri_filter
+
+SCHEMA_VERSION = 1
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    id INTEGER PRIMARY KEY,
+    list TEXT NOT NULL,
+    linenum INTEGER NOT NULL,
+    line TEXT NOT NULL,
+    uid TEXT,
+    priority TEXT NOT NULL DEFAULT '',
+    complete INTEGER NOT NULL DEFAULT 0,
+    start_at TEXT,
+    end_at TEXT,
+    hide INTEGER,
+    UNIQUE (list, linenum)
+);
+CREATE INDEX IF NOT EXISTS tasks_uid ON tasks (uid);
+CREATE INDEX IF NOT EXISTS tasks_open ON tasks (list, complete, priority);
+CREATE INDEX IF NOT EXISTS tasks_hide ON tasks (list, hide);
+CREATE TABLE IF NOT EXISTS task_projects (
+    task_id INTEGER NOT NULL REFERENCES tasks (id) ON DELETE CASCADE,
+    name TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS task_projects_name ON task_projects (name);
+CREATE INDEX IF NOT EXISTS task_projects_task ON task_projects (task_id);
+CREATE TABLE IF NOT EXISTS task_contexts (
+    task_id INTEGER NOT NULL REFERENCES tasks (id) ON DELETE CASCADE,
+    name TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS task_contexts_name ON task_contexts (name);
+CREATE INDEX IF NOT EXISTS task_contexts_task ON task_contexts (task_id);
+"""
+
+JOIN_TABLES = {"PROJECT": "task_projects", "CONTEXT": "task_contexts"}
+
+
+class StorageError(Exception):
+    """Raised when a backend cannot complete a change"""
+
+
+class StoredList(object):
+    """Parsed tasks of one list and their :class:`TaskIndex`, kept the same
+    way as a cache entry or session"""
+
+    def __init__(self, tasks, version):
+        self.tasks = tasks
+        self.version = version
+        # TaskIndex, built the first time it is needed
+        self.index = None
+
+
+class SQLiteStorage(object):
+    """SQLiteStorage(path, task_class)
+
+    Keeps task lists in a SQLite database. Each task is one row of the
+    ``tasks`` table, with its uid, priority, flags, dates and hide date in
+    indexed columns and its projects and contexts in join tables. A change
+    to a single task is a single-row UPDATE, and several processes can
+    share the database.
+
+    :param path: path of the database file
+    :param task_class: class used to parse the stored lines
+    """
+
+    def __init__(self, path, task_class):
+        self.log = logging.getLogger("taskerLogger")
+        self.path = path
+        self.task_class = task_class
+        self.connection = sqlite3.connect(path, timeout=30, isolation_level=None)
+        self.connection.execute("PRAGMA foreign_keys = ON")
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        # every statement of the schema is safe to run again
+        self.connection.executescript(SCHEMA)
+        self.connection.execute("PRAGMA user_version = %d" % SCHEMA_VERSION)
+        # lowercases the way include_task does, unlike SQLite's lower()
+        self.connection.create_function("py_lower", 1, str.lower, deterministic=True)
+        self.lists = {}
+        # writes made through this connection, which data_version ignores
+        self.changes = 0
+
+    def close(self):
+        self.connection.close()
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Runs a block in a write transaction, taking the database lock
+        up front so concurrent writers wait instead of failing part way"""
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield self.connection
+        except BaseException:
+            self.connection.execute("ROLLBACK")
+            raise
+        self.connection.execute("COMMIT")
+
+    def version(self):
+        """Changes whenever another connection commits a change"""
+        return self.connection.execute("PRAGMA data_version").fetchone()[0]
+
+    def entry(self, name):
+        """entry(name)
+        Returns the :class:`StoredList` of a list, reading it again only
+        if another connection changed the database since it was read.
+        """
+        version = self.version()
+        stored = self.lists.get(name)
+        if stored is None or stored.version != version:
+            self.log.debug("Reading list %s from %s", name, self.path)
+            parse = self.task_class.from_text
+            rows = self.connection.execute(
+                "SELECT linenum, line FROM tasks WHERE list = ? ORDER BY linenum",
+                (name,),
+            )
+            stored = self.lists[name] = StoredList(
+                {linenum: parse(line) for linenum, line in rows}, version
+            )
+        return stored
+
+    def get_tasks(self, name):
+        """Returns a dictionary of line number, task pairs of a list"""
+        return {idx: task.copy() for idx, task in self.entry(name).tasks.items()}
+
+    def count(self, name):
+        return self.connection.execute(
+            "SELECT COUNT(*) FROM tasks WHERE list = ?", (name,)
+        ).fetchone()[0]
+
+    def signature(self, name):
+        """Value that changes whenever the list changes"""
+        return (self.version(), self.changes)
+
+    def _parsed(self, task):
+        # the text of a task may have been edited without reparsing it
+        return self.task_class.from_text(str(task))
+
+    def _insert(self, name, linenum, task):
+        cursor = self.connection.execute(
+            "INSERT INTO tasks (list, linenum, line, uid, priority, complete, "
+            "start_at, end_at, hide) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (name, linenum) + self._columns(task),
+        )
+        self._link(cursor.lastrowid, task)
+
+    def _columns(self, task):
+        return (
+            str(task),
+            task.extensions.get("uid"),
+            task.priority or "",
+            int(bool(task.complete)),
+            task.start.isoformat() if task.start else None,
+            task.end.isoformat() if task.end else None,
+            task.hide_ordinal,
+        )
+
+    def _link(self, task_id, task):
+        for table, names in (
+            ("task_projects", task.projects),
+            ("task_contexts", task.contexts),
+        ):
+            self.connection.executemany(
+                "INSERT INTO %s (task_id, name) VALUES (?, ?)" % table,
+                # a name given twice counts twice, as in the text files
+                [(task_id, name) for name in names],
+            )
+
+    def write_tasks(self, name, task_dict):
+        """write_tasks(name, task_dict)
+        Replaces a list with the tasks in task_dict, numbered from 1 in
+        the order of their keys, the same as writing a file.
+        """
+        tasks = {
+            idx: self._parsed(task_dict[key])
+            for idx, key in enumerate(sorted(task_dict), 1)
+        }
+        self.changes += 1
+        with self.transaction():
+            self.connection.execute("DELETE FROM tasks WHERE list = ?", (name,))
+            for linenum, task in tasks.items():
+                self._insert(name, linenum, task)
+        self.lists[name] = StoredList(tasks, self.version())
+
+    def append_tasks(self, name, tasks):
+        """append_tasks(name, tasks)
+        Adds tasks to the end of a list.
+        """
+        stored = self.lists.get(name)
+        current = stored is not None and stored.version == self.version()
+        tasks = [self._parsed(task) for task in tasks]
+        added = {}
+        self.changes += 1
+        with self.transaction():
+            last = self.connection.execute(
+                "SELECT COALESCE(MAX(linenum), 0) FROM tasks WHERE list = ?", (name,)
+            ).fetchone()[0]
+            for linenum, task in enumerate(tasks, last + 1):
+                self._insert(name, linenum, task)
+                added[linenum] = task
+        if current and last == len(stored.tasks):
+            for linenum, task in added.items():
+                stored.tasks[linenum] = task
+                if stored.index is not None:
+                    stored.index.add(linenum, task)
+        else:
+            self.lists.pop(name, None)
+
+    def update_task(self, name, tasknum, task):
+        """update_task(name, tasknum, task)
+        Replaces one task of a list with a single-row UPDATE. Raises
+        :class:`StorageError` if the list has no such task.
+        """
+        task = self._parsed(task)
+        stored = self.lists.get(name)
+        current = stored is not None and stored.version == self.version()
+        self.changes += 1
+        with self.transaction():
+            row = self.connection.execute(
+                "SELECT id FROM tasks WHERE list = ? AND linenum = ?", (name, tasknum)
+            ).fetchone()
+            if row is None:
+                raise StorageError("Task %s not in list %s" % (tasknum, name))
+            task_id = row[0]
+            self.connection.execute(
+                "UPDATE tasks SET line = ?, uid = ?, priority = ?, complete = ?, "
+                "start_at = ?, end_at = ?, hide = ? WHERE id = ?",
+                self._columns(task) + (task_id,),
+            )
+            for table in JOIN_TABLES.values():
+                self.connection.execute(
+                    "DELETE FROM %s WHERE task_id = ?" % table, (task_id,)
+                )
+            self._link(task_id, task)
+        if current and tasknum in stored.tasks:
+            if stored.index is not None:
+                stored.index.replace(tasknum, stored.tasks[tasknum], task)
+            stored.tasks[tasknum] = task
+        else:
+            self.lists.pop(name, None)
+
+    def select(
+        self,
+        name,
+        words=(),
+        showcomplete=False,
+        shown=None,
+        opendate=None,
+        closedate=None,
+        show_priority_z=True,
+    ):
+        """select(name [,words, showcomplete, shown, opendate, closedate,
+        show_priority_z])
+        Returns a dictionary of line number, task pairs of the tasks in a
+        list that can pass the same arguments of :meth:`TaskLib.sort_tasks`.
+        The filters run as one query, and only the rows it returns are
+        parsed, or taken from the list if it was already read.
+
+        words must all appear in a task; ``~word`` and ``(A)`` filters are
+        left to the caller, as is sorting and any limit. shown is a date
+        ordinal, tasks hidden after it are left out.
+        """
+        clauses = ["list = ?"]
+        params = [name]
+        if not (showcomplete or closedate):
+            clauses.append("complete = 0")
+        if shown is not None:
+            clauses.append("(hide IS NULL OR hide <= ?)")
+            params.append(shown)
+        if opendate:
+            clauses.append("substr(start_at, 1, 10) = ?")
+            params.append(opendate.isoformat())
+        if closedate:
+            clauses.append("substr(end_at, 1, 10) = ?")
+            params.append(closedate.isoformat())
+        if not show_priority_z:
+            clauses.append("priority != 'Z'")
+        for word in words:
+            if word.startswith("~") or re_pri_filter.match(word):
+                continue
+            # the text of a task is part of its line
+            clauses.append("instr(py_lower(line), ?) > 0")
+            params.append(word.lower())
+
+        stored = self.lists.get(name)
+        if stored is None or stored.version != self.version():
+            stored = None
+        parse = self.task_class.from_text
+        rows = self.connection.execute(
+            "SELECT linenum, line FROM tasks WHERE %s ORDER BY linenum"
+            % " AND ".join(clauses),
+            params,
+        )
+        return {
+            linenum: stored.tasks[linenum] if stored is not None else parse(line)
+            for linenum, line in rows
+        }
+
+    def find_uids(self, name, uids):
+        """Returns a dictionary of uid, list of (line number, line) pairs
+        of the tasks in a list with the given uids"""
+        found = defaultdict(list)
+        uids = list(uids)
+        # stay under SQLite's limit on query parameters
+        for pos in range(0, len(uids), 500):
+            chunk = uids[pos : pos + 500]
+            rows = self.connection.execute(
+                "SELECT uid, linenum, line FROM tasks WHERE list = ? AND uid IN (%s) "
+                "ORDER BY linenum" % ",".join("?" * len(chunk)),
+                [name] + chunk,
+            )
+            for uid, linenum, line in rows:
+                found[uid].append((linenum, line))
+        return found
+
+    def duplicate_uids(self, name):
+        """Returns a dictionary of uid, sorted line numbers for every uid
+        used more than once in a list"""
+        found = defaultdict(list)
+        rows = self.connection.execute(
+            "SELECT uid, linenum FROM tasks WHERE list = ? AND uid IN ("
+            "SELECT uid FROM tasks WHERE list = ? AND uid IS NOT NULL "
+            "GROUP BY uid HAVING COUNT(*) > 1) ORDER BY linenum",
+            (name, name),
+        )
+        for uid, linenum in rows:
+            found[uid].append(linenum)
+        return found
+
+    def counts(self, names, kind, today):
+        """counts(names, kind, today)
+        Returns the same dictionary as :meth:`TaskLib.get_counts` for the
+        given lists, grouped by the database. today is a date ordinal.
+        """
+        table = JOIN_TABLES[kind]
+        where = "t.list IN (%s)" % ",".join("?" * len(names))
+        names = list(names)
+        res = defaultdict(Counter)
+
+        def add(name, label, value):
+            if value:
+                res[name][label] += value
+
+        rows = self.connection.execute(
+            "SELECT j.name, SUM(t.complete = 0), SUM(t.complete = 1), "
+            "SUM(t.hide > ?) FROM %s j JOIN tasks t ON t.id = j.task_id "
+            "WHERE %s GROUP BY j.name" % (table, where),
+            [today] + names,
+        )
+        for name, opened, closed, hidden in rows:
+            add(name, "open", opened)
+            add(name, "closed", closed)
+            add(name, "hidden", hidden)
+        rows = self.connection.execute(
+            "SELECT j.name, t.priority, COUNT(*) FROM %s j "
+            "JOIN tasks t ON t.id = j.task_id WHERE %s AND t.priority != '' "
+            "GROUP BY j.name, t.priority" % (table, where),
+            names,
+        )
+        for name, priority, count in rows:
+            add(name, priority, count)
+        nothing = "NO {}".format(kind)
+        opened, closed, hidden = self.connection.execute(
+            "SELECT SUM(t.complete = 0), SUM(t.complete = 1), SUM(t.hide > ?) "
+            "FROM tasks t WHERE %s AND NOT EXISTS "
+            "(SELECT 1 FROM %s j WHERE j.task_id = t.id)" % (where, table),
+            [today] + names,
+        ).fetchone()
+        add(nothing, "open", opened)
+        add(nothing, "closed", closed)
+        add(nothing, "hidden", hidden)
+        return res
+
+    def import_file(self, name, path, encoding="utf-8"):
+        """import_file(name, path [,encoding])
+        Replaces a list with the tasks in a todo.txt format file. Returns
+        the number of tasks imported.
+        """
+        tasks = {}
+        with open(path, encoding=encoding) as fp:
+            for line in fp:
+                if line.strip():
+                    tasks[len(tasks) + 1] = self.task_class.from_text(line)
+        self.write_tasks(name, tasks)
+        return len(tasks)
+
+    def export_file(self, name, path, encoding="utf-8"):
+        """export_file(name, path [,encoding])
+        Writes a list to a todo.txt format file. Returns the number of
+        tasks exported.
+        """
+        tasks = self.entry(name).tasks
+        temp = path + ".tmp"
+        with open(temp, "w", encoding=encoding) as fp:
+            for linenum in sorted(tasks):
+                fp.write("{}{}".format(tasks[linenum], "\n"))
+        os.replace(temp, path)
+        return len(tasks)
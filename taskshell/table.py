@@ -0,0 +1,431 @@
+# -*- coding: utf-8 -*-
+"""
+Task Table
+
+A columnar copy of a task dictionary for filtering, sorting and counting
+very large lists. Every field is held in one array with a row per task:
+
+* priority - 0 for none, 1 to 26 for A to Z
+* complete - 0 or 1
+* start, end - seconds since 1970-01-01, or MISSING
+* hide - date ordinal of the hide extension, 0 for none
+* projects, contexts - ids of interned names, with per-row offsets
+* text - the lowercased text of every task in one string, with offsets
+
+If NumPy is installed the columns are NumPy arrays and every filter is a
+vectorized operation on whole columns. Otherwise they are :mod:`array`
+arrays, and row selections are held as Python integers used as bitmasks,
+so combining filters is still a single operation.
+
+Word filters search the text buffer once with :meth:`str.find` and map
+each hit back to its row with a binary search on the offsets.
+"""
+
+import re
+import datetime
+
+from array import array
+from bisect import bisect_right
+from collections import Counter, defaultdict
+
+from .index import re_pri_filter
+
+# NumPy is imported by the first table that uses it, as importing it
+# takes longer than starting the rest of the shell
+numpy = None
+_numpy_checked = False
+
+EPOCH = datetime.datetime(1970, 1, 1)
+SECOND = datetime.timedelta(seconds=1)
+MISSING = -(2 ** 62)
+
+# priority codes are positions in this string
+PRIORITIES = " ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+
+
+def _load_numpy():
+    """Imports NumPy the first time it is needed. Returns None if it is
+    not installed."""
+    global numpy, _numpy_checked
+    if not _numpy_checked:
+        _numpy_checked = True
+        try:
+            import numpy as module
+        except ImportError:
+            module = None
+        numpy = module
+    return numpy
+
+
+def _seconds(stamp):
+    return MISSING if stamp is None else (stamp - EPOCH) // SECOND
+
+
+def _day_bounds(day):
+    "first and last second of a date"
+    start = _seconds(datetime.datetime.combine(day, datetime.time()))
+    return start, start + 86399
+
+
+class TaskTable(object):
+    """TaskTable(tasks [,use_numpy])
+
+    Columnar table of a dictionary of key, task pairs, such as the result
+    of :meth:`TaskLib.build_task_dict`. Rows keep the order of the
+    dictionary.
+
+    :param dict tasks: the tasks to store
+    :param bool use_numpy: use NumPy if it is installed (default True)
+    """
+
+    def __init__(self, tasks, use_numpy=True):
+        self.numpy = use_numpy and _load_numpy() is not None
+        self.keys = list(tasks)
+        self.project_names = []
+        self.context_names = []
+        project_ids = {}
+        context_ids = {}
+
+        priority = array("B")
+        complete = array("B")
+        start = array("q")
+        end = array("q")
+        hide = array("l")
+        projects, project_offsets = array("l"), array("l", [0])
+        contexts, context_offsets = array("l"), array("l", [0])
+        texts = []
+        stripped = []
+        for task in tasks.values():
+            priority.append(PRIORITIES.index(task.priority or " "))
+            complete.append(1 if task.complete else 0)
+            start.append(_seconds(task.start))
+            end.append(_seconds(task.end))
+            hide.append(task.hide_ordinal or 0)
+            for name in task.projects:
+                if name not in project_ids:
+                    project_ids[name] = len(self.project_names)
+                    self.project_names.append(name)
+                projects.append(project_ids[name])
+            project_offsets.append(len(projects))
+            for name in task.contexts:
+                if name not in context_ids:
+                    context_ids[name] = len(self.context_names)
+                    self.context_names.append(name)
+                contexts.append(context_ids[name])
+            context_offsets.append(len(contexts))
+            texts.append(task.text.lower().replace("\n", " "))
+            stripped.append(task.text.strip())
+
+        self.text = "\n".join(texts)
+        text_offsets = array("q")
+        pos = 0
+        for text in texts:
+            text_offsets.append(pos)
+            pos += len(text) + 1
+        # rank of each row's text in sorted order, for tie breaking
+        text_rank = array("l", [0]) * len(texts)
+        for rank, row in enumerate(
+            sorted(range(len(stripped)), key=stripped.__getitem__)
+        ):
+            text_rank[row] = rank
+
+        columns = dict(
+            priority=priority,
+            complete=complete,
+            start=start,
+            end=end,
+            hide=hide,
+            projects=projects,
+            project_offsets=project_offsets,
+            contexts=contexts,
+            context_offsets=context_offsets,
+            text_rank=text_rank,
+            text_offsets=text_offsets,
+        )
+        for name, column in columns.items():
+            if self.numpy:
+                column = numpy.frombuffer(column, dtype=column.typecode)
+            setattr(self, name, column)
+        if self.numpy:
+            self._keys = numpy.empty(len(self.keys), dtype=object)
+            self._keys[:] = self.keys
+        self._project_ids = project_ids
+        self._context_ids = context_ids
+        self._orders = {}
+
+    def __len__(self):
+        return len(self.keys)
+
+    # row selections are boolean arrays with NumPy and bitmasks without
+
+    def everything(self):
+        "Selection of every row"
+        if self.numpy:
+            return numpy.ones(len(self), dtype=bool)
+        return (1 << len(self)) - 1
+
+    def nothing(self):
+        "Empty selection"
+        if self.numpy:
+            return numpy.zeros(len(self), dtype=bool)
+        return 0
+
+    def invert(self, mask):
+        if self.numpy:
+            return ~mask
+        return self.everything() & ~mask
+
+    def _from_rows(self, rows):
+        if self.numpy:
+            mask = self.nothing()
+            mask[list(rows)] = True
+            return mask
+        bits = bytearray(b"0") * len(self)
+        for row in rows:
+            bits[row] = ord("1")
+        bits.reverse()
+        return int(bits or b"0", 2)
+
+    def _where(self, column, test):
+        """Selection of rows where test(value) is true. test must work on a
+        whole NumPy column as well as on single values."""
+        if self.numpy:
+            return test(column)
+        bits = "".join("1" if test(value) else "0" for value in reversed(column))
+        return int(bits or "0", 2)
+
+    def rows(self, mask):
+        "Returns the row numbers in a selection"
+        if self.numpy:
+            return numpy.flatnonzero(mask).tolist()
+        bits = bin(mask)[:1:-1]
+        return [row for row, bit in enumerate(bits) if bit == "1"]
+
+    def _has(self, names, ids, values, offsets):
+        "Selection of rows with any of the interned names"
+        wanted = {ids[name] for name in names if name in ids}
+        if not wanted:
+            return self.nothing()
+        if self.numpy:
+            hits = numpy.isin(values, list(wanted))
+            rows = numpy.repeat(numpy.arange(len(self)), numpy.diff(offsets))
+            return numpy.bincount(rows[hits], minlength=len(self)).astype(bool)
+        return self._from_rows(
+            bisect_right(offsets, idx) - 1
+            for idx, value in enumerate(values)
+            if value in wanted
+        )
+
+    def project(self, *names):
+        "Selection of rows with any of the projects"
+        return self._has(names, self._project_ids, self.projects, self.project_offsets)
+
+    def context(self, *names):
+        "Selection of rows with any of the contexts"
+        return self._has(names, self._context_ids, self.contexts, self.context_offsets)
+
+    def priority_in(self, letters):
+        "Selection of rows with one of the priorities, '' for none"
+        codes = [PRIORITIES.index(letter or " ") for letter in letters]
+        if self.numpy:
+            return numpy.isin(self.priority, codes)
+        return self._where(self.priority, codes.__contains__)
+
+    def containing(self, word):
+        "Selection of rows whose lowercased text contains word"
+        word = word.lower()
+        if not word:
+            return self.everything()
+        text, offsets = self.text, self.text_offsets
+        if self.numpy:
+            found = numpy.fromiter(
+                (hit.start() for hit in re.finditer(re.escape(word), text)),
+                dtype=numpy.int64,
+            )
+            mask = self.nothing()
+            mask[numpy.searchsorted(offsets, found, side="right") - 1] = True
+            return mask
+        rows = []
+        pos = text.find(word)
+        while pos != -1:
+            row = bisect_right(offsets, pos) - 1
+            rows.append(row)
+            if row + 1 >= len(offsets):
+                break
+            pos = text.find(word, offsets[row + 1])
+        return self._from_rows(rows)
+
+    def match(self, filters, filterop=all):
+        """match(filters [,filterop])
+        Selection of the rows :func:`include_task` would accept.
+        """
+        combined = None
+        for word in filters:
+            hits = self.containing(word.replace("~", ""))
+            pri = re_pri_filter.match(word)
+            if pri:
+                hits = hits ^ self.priority_in(pri.group(1))
+            if word.startswith("~"):
+                hits = self.invert(hits)
+            if combined is None:
+                combined = hits
+            elif filterop is any:
+                combined = combined | hits
+            else:
+                combined = combined & hits
+        if combined is None:
+            return self.everything() if filterop is all else self.nothing()
+        return combined
+
+    def select(
+        self,
+        filters=None,
+        filterop=all,
+        showcomplete=False,
+        opendate=None,
+        closedate=None,
+        hidedate=None,
+        show_priority_z=True,
+    ):
+        """select([filters, filterop, showcomplete, opendate, closedate,
+        hidedate, show_priority_z])
+        Selection of the rows :meth:`TaskLib.sort_tasks` would list for the
+        same arguments.
+        """
+        mask = self.everything()
+        showcomplete = showcomplete or closedate
+        if not showcomplete:
+            mask &= self._where(self.complete, lambda value: value == 0)
+        if filters:
+            mask &= self.match(filters, filterop)
+        if not show_priority_z:
+            mask &= self.invert(self.priority_in("Z"))
+        if opendate:
+            low, high = _day_bounds(opendate)
+            mask &= self._where(self.start, lambda value: (value >= low) & (value <= high))
+        if closedate:
+            low, high = _day_bounds(closedate)
+            mask &= self._where(self.end, lambda value: (value >= low) & (value <= high))
+        shown = (hidedate or datetime.date.today()).toordinal()
+        mask &= self._where(self.hide, lambda value: value <= shown)
+        return mask
+
+    def _priority_order(self, priority_z_last):
+        """Row numbers of the whole table in priority order. Computed once
+        for each setting of priority_z_last."""
+        if priority_z_last in self._orders:
+            return self._orders[priority_z_last]
+        none_rank, z_rank = (1, 2) if priority_z_last else (2, 1)
+        z_code = PRIORITIES.index("Z")
+        if self.numpy:
+            priority, complete = self.priority, self.complete
+            rank = numpy.where(priority == 0, none_rank, 0)
+            rank = numpy.where(priority == z_code, z_rank, rank)
+            # completed tasks sort as if they had no priority
+            shown = numpy.where(complete == 1, 0, priority)
+            order = numpy.lexsort(
+                (self.text_rank, self.end, self.start, shown, complete, rank)
+            )
+        else:
+
+            def sortkey(row):
+                priority = self.priority[row]
+                complete = self.complete[row]
+                if priority == 0:
+                    rank = none_rank
+                elif priority == z_code:
+                    rank = z_rank
+                else:
+                    rank = 0
+                return (
+                    rank,
+                    complete,
+                    0 if complete else priority,
+                    self.start[row],
+                    self.end[row],
+                    self.text_rank[row],
+                )
+
+            order = sorted(range(len(self)), key=sortkey)
+        self._orders[priority_z_last] = order
+        return order
+
+    def order(self, mask, by_pri=True, priority_z_last=True):
+        """order(mask [,by_pri, priority_z_last])
+        Returns the keys of the selected rows sorted the same way as
+        :meth:`TaskLib.sort_tasks`. The table is sorted once, so ordering
+        any selection only takes a pass over the sorted rows.
+        """
+        if self.numpy:
+            if by_pri:
+                order = self._priority_order(priority_z_last)
+                rows = order[mask[order]]
+            else:
+                rows = numpy.flatnonzero(mask)
+            return self._keys[rows].tolist()
+
+        if not by_pri:
+            return [self.keys[row] for row in self.rows(mask)]
+        bits = bin(mask)[:1:-1]
+        return [
+            self.keys[row]
+            for row in self._priority_order(priority_z_last)
+            if row < len(bits) and bits[row] == "1"
+        ]
+
+    def counts(self, kind, day=None):
+        """counts(kind [,day])
+        Returns the same dictionary of :class:`collections.Counter` objects
+        as :meth:`TaskLib.get_counts` for 'project' or 'context', with
+        hidden counted as of day (default today).
+        """
+        kind = kind.upper()
+        if kind == "PROJECT":
+            names, values, offsets = self.project_names, self.projects, self.project_offsets
+        elif kind == "CONTEXT":
+            names, values, offsets = self.context_names, self.contexts, self.context_offsets
+        else:
+            raise ValueError("Should pass 'project' or 'context' to counts")
+        nothing = "NO {}".format(kind)
+        today = (day or datetime.date.today()).toordinal()
+        res = defaultdict(Counter)
+
+        if self.numpy:
+            sizes = numpy.diff(offsets)
+            rows = numpy.repeat(numpy.arange(len(self)), sizes)
+            complete = self.complete.astype(bool)
+            hidden = self.hide > today
+            size = len(names)
+
+            def tally(selected):
+                return numpy.bincount(values[selected[rows]], minlength=size)
+
+            groups = [("closed", complete), ("open", ~complete), ("hidden", hidden)]
+            for code in numpy.unique(self.priority[rows]).tolist():
+                if code:
+                    groups.append((PRIORITIES[code], self.priority == code))
+            for label, selected in groups:
+                for idx, count in enumerate(tally(selected).tolist()):
+                    if count:
+                        res[names[idx]][label] += count
+                bare = selected & (sizes == 0)
+                if label in ("open", "closed", "hidden") and bare.any():
+                    res[nothing][label] += int(bare.sum())
+            return res
+
+        for row in range(len(self)):
+            items = values[offsets[row] : offsets[row + 1]]
+            key = "closed" if self.complete[row] else "open"
+            hidden = self.hide[row] > today
+            if not items:
+                res[nothing][key] += 1
+                if hidden:
+                    res[nothing]["hidden"] += 1
+            for idx in items:
+                counter = res[names[idx]]
+                counter[key] += 1
+                if self.priority[row]:
+                    counter[PRIORITIES[self.priority[row]]] += 1
+                if hidden:
+                    counter["hidden"] += 1
+        return res
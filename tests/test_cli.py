@@ -0,0 +1,226 @@
+import io
+import sys
+import time
+import socket
+import tempfile
+import threading
+import unittest
+import unittest.mock as mock
+import contextlib
+
+import minioncmd
+
+from taskshell import TaskLib, daemon
+from taskshell import cli, lister
+from taskshell.session import Session
+
+from configparser import ConfigParser, ExtendedInterpolation
+
+
+def make_config(tasker_dir):
+    config = ConfigParser(interpolation=ExtendedInterpolation())
+    config['Files'] = {
+        'done-path': '${tasker-dir}/done.txt',
+        'task-path': '${tasker-dir}/todo.txt',
+        'tasker-dir': tasker_dir,
+        'socket-path': '${tasker-dir}/tasker.sock',
+        }
+    config['Tasker'] = {
+        'wrap-width': '78',
+        'show-priority-z': 'true',
+        'priority-z-last': 'true',
+        'wrap-behavior': 'wrap',
+        'hidden-extensions': 'uid,hide',
+        'theme-name': 'default',
+        'archive-days': 7,
+        'session-mode': 'false',
+        }
+    return config
+
+
+class DemoCmd(minioncmd.MinionCmd):
+    interactive_commands = ("ask",)
+
+    def __init__(self):
+        super().__init__("demo")
+
+    def do_ask(self, text):
+        print(input("name: "))
+
+    def do_tell(self, text):
+        print("told", text)
+
+
+@unittest.skipUnless(hasattr(socket, 'AF_UNIX'), 'needs Unix sockets')
+class DaemonCommandTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.config = make_config(self.tmp.name)
+        self.path = self.config['Files']['socket-path']
+        self.task_path = self.config['Files']['task-path']
+        with open(self.task_path, 'w') as fp:
+            fp.write('first task\nsecond task\nthird task\n')
+        self.cmd = cli.TaskCmd(config=self.config, lib=TaskLib(self.config))
+        self.cmd.add_minion("demo", DemoCmd())
+        server = daemon.TaskDaemon(
+            self.path, self.cmd.run_captured, self.cmd.runs_locally)
+        self.thread = threading.Thread(target=server.serve)
+        self.thread.start()
+        while not daemon.is_running(self.path):
+            time.sleep(0.01)
+
+    def tearDown(self):
+        daemon.stop(self.path)
+        self.thread.join(5)
+        self.tmp.cleanup()
+
+    def send(self, *argv):
+        out = io.StringIO()
+        self.assertTrue(daemon.forward(self.path, list(argv), out))
+        return out.getvalue()
+
+    def lines(self):
+        with open(self.task_path) as fp:
+            return fp.read().splitlines()
+
+    def test_each_write_starts_from_the_file(self):
+        self.send('do', '1')
+        self.assertTrue(self.lines()[0].startswith('x '))
+        self.send('pri', '2', 'A')
+        lines = self.lines()
+        self.assertTrue(lines[0].startswith('x '))
+        self.assertTrue(lines[1].startswith('(A) '))
+        with open(self.task_path, 'a') as fp:
+            fp.write('edited outside the daemon\n')
+        self.send('add', 'fourth')
+        lines = self.lines()
+        self.assertEqual(len(lines), 5)
+        self.assertTrue(lines[0].startswith('x '))
+        self.assertTrue(lines[1].startswith('(A) '))
+        self.assertEqual(lines[3], 'edited outside the daemon')
+        self.assertIn('fourth', lines[4])
+
+    def test_configuration_restored(self):
+        before = self.config['Tasker']['hidden-extensions']
+        self.send('list', '--showhidden')
+        self.assertEqual(self.config['Tasker']['hidden-extensions'], before)
+
+    def test_interactive_commands_run_in_client(self):
+        self.assertFalse(daemon.forward(self.path, ['demo', 'ask'], io.StringIO()))
+        self.assertFalse(daemon.forward(self.path, ['demo'], io.StringIO()))
+        self.assertEqual(self.send('demo', 'tell', 'me'), 'told me\n')
+
+    def test_main_forwards(self):
+        out = io.StringIO()
+        with mock.patch.object(daemon, 'read_config', lambda: self.config), \
+                mock.patch.object(sys, 'argv', ['s', 'list']), \
+                contextlib.redirect_stdout(out):
+            self.assertEqual(daemon.main(), 0)
+        self.assertIn('3 tasks shown', out.getvalue())
+
+
+class BatchTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.config = make_config(self.tmp.name)
+        self.task_path = self.config['Files']['task-path']
+        with open(self.task_path, 'w') as fp:
+            fp.write('first task\nsecond task\nthird task\n')
+        self.cmd = cli.TaskCmd(config=self.config, lib=TaskLib(self.config))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def run_batch(self, text):
+        path = self.tmp.name + '/my batch.txt'
+        with open(path, 'w') as fp:
+            fp.write(text)
+        out = io.StringIO()
+        with mock.patch('taskshell.session.Session.write', autospec=True,
+                        side_effect=Session.write) as write, \
+                contextlib.redirect_stdout(out):
+            self.cmd.onecmd('batch "{}"'.format(path))
+        return out.getvalue(), write.call_count
+
+    def lines(self):
+        with open(self.task_path) as fp:
+            return fp.read().splitlines()
+
+    def test_one_write(self):
+        output, writes = self.run_batch(
+            '# numbers refer to the list before the batch\n'
+            'do 1\n\npri 2 A\nadd fourth task\npri 4 B\n')
+        self.assertEqual(writes, 1)
+        self.assertIn('4 commands run, 0 failed', output)
+        lines = self.lines()
+        self.assertEqual(len(lines), 4)
+        self.assertTrue(lines[0].startswith('x '))
+        self.assertTrue(lines[1].startswith('(A) '))
+        self.assertTrue(lines[3].startswith('(B) '))
+        self.assertIn('fourth task', lines[3])
+
+    def test_failures_counted(self):
+        output, writes = self.run_batch(
+            'archive\npri 9 A\ndo 1\ndo 1\nlist --no-such-option\n'
+            'add "unbalanced\nadd kept\n')
+        self.assertIn('cannot run in a batch', output)
+        self.assertIn('7 commands run, 5 failed', output)
+        lines = self.lines()
+        self.assertEqual(len(lines), 4)
+        self.assertTrue(lines[0].startswith('x '))
+
+
+class ProjectsReportTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.config = make_config(self.tmp.name)
+        with open(self.config['Files']['task-path'], 'w') as fp:
+            for num in range(lister.SAMPLE_ROWS):
+                fp.write('task {0} +p{0:03d}\n'.format(num))
+            fp.write('x 2020-01-01 2020-01-01 done +a_much_longer_project\n')
+        self.cmd = cli.TaskCmd(config=self.config, lib=TaskLib(self.config))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def report(self, text=''):
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            self.cmd.onecmd('projects ' + text)
+        return out.getvalue().splitlines()[1:]
+
+    def test_widths_from_first_rows(self):
+        lines = self.report()
+        self.assertEqual(lines[0], 'Project Open Closed ')
+        self.assertEqual(lines[1], '------- ---- ------')
+        self.assertEqual(lines[2], '+p000      1      0 ')
+        self.assertEqual(len(lines), lister.SAMPLE_ROWS + 3)
+        self.assertEqual(lines[-1], '+a_much_longer_project    0      1 ')
+
+    def test_filters(self):
+        lines = self.report('closed')
+        self.assertEqual(len(lines), 3)
+        self.assertTrue(lines[2].startswith('+a_much_longer_project '))
+        self.assertEqual(len(self.report('open')), lister.SAMPLE_ROWS + 2)
+
+
+@unittest.skipUnless(hasattr(socket, 'AF_UNIX'), 'needs Unix sockets')
+class DaemonFallbackTestCase(unittest.TestCase):
+    def test_wedged_daemon_runs_locally(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            config = make_config(tmp)
+            path = config['Files']['socket-path']
+            # listens but never accepts
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                sock.bind(path)
+                sock.listen()
+                started = time.monotonic()
+                with mock.patch.object(daemon, 'read_config', lambda: config), \
+                        mock.patch.object(sys, 'argv', ['s', 'list']), \
+                        mock.patch.object(cli, 'main', return_value=7):
+                    self.assertEqual(daemon.main(), 7)
+                self.assertLess(time.monotonic() - started, 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
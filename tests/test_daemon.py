@@ -0,0 +1,83 @@
+import io
+import os
+import time
+import socket
+import shutil
+import pathlib
+import tempfile
+import threading
+import unittest
+
+from taskshell import daemon
+
+tmp_dir = pathlib.Path(tempfile.mkdtemp(prefix='taskshell-test-'))
+
+
+def tearDownModule():
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+@unittest.skipUnless(hasattr(socket, 'AF_UNIX'), 'needs Unix sockets')
+class TaskDaemonTestCase(unittest.TestCase):
+    path = str(tmp_dir / 'tasker.sock')
+
+    def test_forward_and_stop(self):
+        server = daemon.TaskDaemon(self.path, lambda argv: ' '.join(argv) + '\n')
+        # leave a stale socket behind for serve to replace
+        server.bind().close()
+        thread = threading.Thread(target=server.serve)
+        thread.start()
+        try:
+            while not daemon.is_running(self.path):
+                time.sleep(0.01)
+            out = io.StringIO()
+            self.assertTrue(daemon.forward(self.path, ['list', '+Phone'], out))
+            self.assertEqual(out.getvalue(), 'list +Phone\n')
+        finally:
+            self.assertTrue(daemon.stop(self.path))
+            thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertFalse(daemon.forward(self.path, ['list'], io.StringIO()))
+
+    def test_local_commands_not_run(self):
+        ran = []
+        server = daemon.TaskDaemon(
+            self.path, lambda argv: ran.append(argv) or 'ran\n',
+            lambda argv: argv[:1] == ['ask'])
+        thread = threading.Thread(target=server.serve)
+        thread.start()
+        try:
+            while not daemon.is_running(self.path):
+                time.sleep(0.01)
+            self.assertFalse(daemon.forward(self.path, ['ask'], io.StringIO()))
+            self.assertTrue(daemon.forward(self.path, ['tell'], io.StringIO()))
+        finally:
+            daemon.stop(self.path)
+            thread.join(5)
+        self.assertEqual(ran, [['tell']])
+
+    def test_wedged_daemon(self):
+        # a socket that listens but never accepts
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+            sock.bind(self.path)
+            sock.listen()
+            started = time.monotonic()
+            self.assertFalse(daemon.forward(self.path, ['list'], io.StringIO()))
+            self.assertLess(time.monotonic() - started, daemon.ACK_TIMEOUT + 1)
+        os.unlink(self.path)
+
+    def test_forwardable(self):
+        self.assertTrue(daemon.forwardable([]))
+        self.assertTrue(daemon.forwardable(['list', '-a']))
+        self.assertFalse(daemon.forwardable(['-n', 'list']))
+        self.assertFalse(daemon.forwardable(['daemon', 'start']))
+        self.assertFalse(daemon.forwardable(['batch', '-']))
+        self.assertTrue(daemon.forwardable(['batch', 'nightly.txt']))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,28 @@
+import io
+import unittest
+
+from taskshell.lister import TableWriter
+
+
+class TableWriterTestCase(unittest.TestCase):
+    def test_widths_and_numeric_alignment(self):
+        out = io.StringIO()
+        TableWriter(['Project', 'Open'], stream=out).write(
+            [('+Home', 3), ('\x1b[31m+Work', 12)])
+        lines = out.getvalue().splitlines()
+        self.assertEqual(lines[0], 'Project Open ')
+        self.assertEqual(lines[1], '------- ----')
+        self.assertEqual(lines[2], '+Home      3 ')
+        self.assertEqual(lines[3], '\x1b[31m+Work     12 ')
+
+    def test_sampled_widths(self):
+        out = io.StringIO()
+        rows = (('p%d' % i, 'x' * i) for i in range(1, 6))
+        TableWriter(['P', 'X'], stream=out).write(rows, sample=2)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(lines[1], '-- --')
+        self.assertEqual(lines[-1], 'p5 xxxxx ')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,39 @@
+import json
+import shutil
+import pathlib
+import tempfile
+import unittest
+
+from taskshell.profiler import StartupProfiler
+
+tmp_dir = pathlib.Path(tempfile.mkdtemp(prefix='taskshell-test-'))
+
+
+def tearDownModule():
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+class StartupProfilerTestCase(unittest.TestCase):
+    def test_nested_phases(self):
+        profiler = StartupProfiler()
+        with profiler.phase('outer'):
+            with profiler.phase('inner'):
+                pass
+        rows = profiler.breakdown()
+        self.assertEqual(sorted(row['phase'] for row in rows),
+                         ['outer', 'outer > inner'])
+        self.assertGreaterEqual(rows[0]['duration_ms'], rows[1]['duration_ms'])
+
+    def test_write_json(self):
+        profiler = StartupProfiler()
+        with profiler.phase('read config'):
+            pass
+        path = tmp_dir / 'profile.json'
+        profiler.write_json(str(path))
+        data = json.loads(path.read_text())
+        self.assertEqual(data['phases'][0]['phase'], 'read config')
+        self.assertGreater(data['total_ms'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -75,6 +75,9 @@ class QuotidiaTestCase(unittest.TestCase):
                 qf.write(qtext)
         with open(CONFIG['Files']['task-path'], 'w') as fp:
             fp.write('')
+        stamp = q_dir / '.last-startup'
+        if stamp.exists():
+            stamp.unlink()
 
     def loadlibs(self):
         # many tests are dependent on faking the date, so creating
@@ -168,3 +171,14 @@ class QuotidiaTestCase(unittest.TestCase):
             mondaytasks = self.task_lib.sort_tasks(filters=["{qid:monday}"])
             self.assertEqual(len(mondaytasks), 1)
 
+    def test_quotidia_scheduled_once_per_day(self):
+        with fixed_today(datetime.date(2020, 8, 3)):
+            self.loadlibs()
+            self.assertEqual(
+                len(self.task_lib.sort_tasks(filters=["{qid:monday}"])), 1)
+            with open(CONFIG['Files']['task-path'], 'w') as fp:
+                fp.write('')
+            self.tearDown()
+            self.loadlibs()
+            self.assertEqual(
+                len(self.task_lib.sort_tasks(filters=["{qid:monday}"])), 0)
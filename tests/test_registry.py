@@ -0,0 +1,63 @@
+import json
+import shutil
+import pathlib
+import tempfile
+import unittest
+
+from taskshell.registry import PluginRegistry, Plugin, LazyLibraries
+
+tmp_dir = pathlib.Path(tempfile.mkdtemp(prefix='taskshell-test-'))
+
+
+def tearDownModule():
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+class PluginRegistryTestCase(unittest.TestCase):
+    path = str(tmp_dir / 'plugins.json')
+
+    class CountingRegistry(PluginRegistry):
+        scans = 0
+
+        def _scan(self):
+            PluginRegistryTestCase.CountingRegistry.scans += 1
+            return [Plugin('demo', 'tasker_library', 'collections:Counter',
+                           hooks=['on_add_task'])]
+
+    def setUp(self):
+        if pathlib.Path(self.path).exists():
+            pathlib.Path(self.path).unlink()
+        self.CountingRegistry.scans = 0
+
+    def test_registry_is_saved_and_reused(self):
+        first = self.CountingRegistry(self.path).entries('tasker_library')
+        second = self.CountingRegistry(self.path).entries('tasker_library')
+        self.assertEqual(self.CountingRegistry.scans, 1)
+        self.assertEqual([p.as_dict() for p in first],
+                         [p.as_dict() for p in second])
+        self.assertEqual(
+            self.CountingRegistry(self.path).entries('tasker_minions'), [])
+
+    def test_stale_registry_is_rescanned(self):
+        self.CountingRegistry(self.path).entries('tasker_library')
+        data = json.loads(pathlib.Path(self.path).read_text())
+        data['stamp'] = []
+        pathlib.Path(self.path).write_text(json.dumps(data))
+        self.CountingRegistry(self.path).entries('tasker_library')
+        self.assertEqual(self.CountingRegistry.scans, 2)
+
+    def test_libraries_created_on_first_use(self):
+        plugins = self.CountingRegistry(self.path).entries('tasker_library')
+        made = []
+        libraries = LazyLibraries(plugins, lambda cls: made.append(cls) or cls())
+        self.assertIn('demo', libraries)
+        self.assertEqual(made, [])
+        self.assertEqual(list(libraries.with_hook('on_startup')), [])
+        self.assertEqual(made, [])
+        (name, library), = libraries.with_hook('on_add_task')
+        self.assertIs(libraries['demo'], library)
+        self.assertEqual(len(made), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,28 @@
+import io
+import unittest
+
+from taskshell import Task
+from taskshell.render import TaskRenderer
+
+
+class TaskRendererTestCase(unittest.TestCase):
+    def test_lines(self):
+        renderer = TaskRenderer({'A': 'bright red'}, ['uid', 'hide'])
+        tasks = {9: Task.from_text('(A) call Bob {uid:1} {hide:2020-01-01}'),
+                 10: Task.from_text('plain task {uid:2} {cn:3}')}
+        lines = list(renderer.lines(tasks))
+        self.assertIn(' 9 (A) ', lines[0])
+        self.assertTrue(lines[0].startswith('\x1b['))
+        self.assertNotIn('{uid', lines[0] + lines[1])
+        self.assertNotIn('{hide', lines[0])
+        self.assertTrue(lines[1].endswith('plain task {cn:3}\n'))
+        self.assertEqual(lines[-1], '2 tasks shown\n')
+
+    def test_write_once(self):
+        out = io.StringIO()
+        TaskRenderer({}, []).write({}, stream=out)
+        self.assertEqual(out.getvalue(), 'No tasks found\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,13 +1,31 @@
+import os
+import shutil
+import sys
+import subprocess
+import time
 import unittest
+import unittest.mock as mock
 import pathlib
+import tempfile
 
-from taskshell import TaskLib
+import datetime
+
+from taskshell import TaskLib, Task, LazyTask, TASK_OK, TASK_ERROR
+from taskshell import compile_query, QueryError
+from taskshell.table import TaskTable
+from taskshell.loader import load_tasks, chunk_ranges
+from taskshell import cache
+from taskshell.lib import (TIMEFMT, DATEFMT, IDFMT, parse_timestamp,
+                           format_timestamp, parse_date, format_date,
+                           format_uid, include_task)
 
 from configparser import ConfigParser, ExtendedInterpolation
 
-tmp_dir = pathlib.Path(__file__).parent / 'tmp'
-if not tmp_dir.exists():
-    tmp_dir.mkdir()
+tmp_dir = pathlib.Path(tempfile.mkdtemp(prefix='taskshell-test-'))
+
+
+def tearDownModule():
+    shutil.rmtree(tmp_dir, ignore_errors=True)
 
 TEST_CONFIG = ConfigParser(interpolation=ExtendedInterpolation())
 
@@ -33,6 +51,8 @@ class TaskLibTestCase(unittest.TestCase):
         self.test_lib = TaskLib(TEST_CONFIG)
         with open(TEST_CONFIG['Files']['task-path'], 'w') as fp:
             fp.write('')
+        with open(TEST_CONFIG['Files']['done-path'], 'w') as fp:
+            fp.write('')
 
     def tearDown(self):
         del self.test_lib
@@ -47,7 +67,721 @@ class TaskLibTestCase(unittest.TestCase):
         self.assertIsInstance(res, tuple)
         self.assertIsInstance(res[0], int)
         self.assertIsInstance(res[1], dict)
-       
+
+    def test_add_task_appends_line(self):
+        path = TEST_CONFIG['Files']['task-path']
+        with open(path, 'w') as fp:
+            fp.write('(A) existing task without newline')
+        res = self.test_lib.add_task('(B) appended task')
+        self.assertEqual(list(res), [2])
+        with open(path) as fp:
+            lines = fp.read().splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[0].startswith('(A) existing task'))
+        self.assertEqual(lines[1], str(res[2]))
+
+    def test_add_tasks_appends_in_one_write(self):
+        path = TEST_CONFIG['Files']['task-path']
+        self.test_lib.add_task('(A) existing task')
+        res = self.test_lib.add_tasks(['second task', '(C) third task'])
+        self.assertEqual(list(res), [2, 3])
+        with open(path) as fp:
+            lines = fp.read().splitlines()
+        self.assertEqual(lines[1:], [str(res[2]), str(res[3])])
+        self.assertEqual(self.test_lib.add_tasks([]), {})
+
+    def test_update_task_patches_single_line(self):
+        path = TEST_CONFIG['Files']['task-path']
+        for text in ['(A) first task', 'second task', '(C) third task']:
+            self.test_lib.add_task(text)
+        with open(path, 'rb') as fp:
+            before = fp.read().splitlines()
+        self.test_lib.get_tasks(path)
+        self.test_lib.prioritize_task(2, 'B', 'with a much longer note')
+        with open(path, 'rb') as fp:
+            after = fp.read().splitlines()
+        self.assertEqual(before[0], after[0])
+        self.assertEqual(before[2], after[2])
+        self.assertTrue(after[1].startswith(b'(B) '))
+        tasks = self.test_lib.get_tasks(path)
+        self.assertEqual(tasks[2].priority, 'B')
+        self.assertEqual(str(tasks[3]), before[2].decode())
+        fresh = self.test_lib.parse_tasks(path)
+        self.assertEqual([str(t) for t in fresh.values()],
+                         [str(t) for t in tasks.values()])
+
+    def test_sort_tasks_limit(self):
+        for text in ['plain task', '(C) third', '(A) first', '(Z) last',
+                     '(B) second']:
+            self.test_lib.add_task(text)
+        everything = self.test_lib.sort_tasks()
+        self.assertEqual([t.priority for k, t in everything],
+                         ['A', 'B', 'C', '', 'Z'])
+        top = self.test_lib.sort_tasks(limit=2)
+        self.assertEqual([k for k, t in top], [k for k, t in everything[:2]])
+        self.assertEqual([k for k, t in top], [3, 5])
+        self.assertEqual([k for k, t in self.test_lib.sort_tasks(
+            by_pri=False, limit=3)], [1, 2, 3])
+
+    def test_archive_tasks_appends_to_done(self):
+        for text in ['x first', 'second', 'x third']:
+            self.test_lib.add_task(text)
+        self.test_lib.archive_tasks([1, 3])
+        archive = self.test_lib.archive
+        self.assertEqual(len(archive), 2)
+        self.assertEqual([t.text.split()[0] for n, t in archive.newest()],
+                         ['third', 'first'])
+        self.test_lib.archive_tasks([1])
+        self.assertEqual(archive.task(3).text.split()[0], 'second')
+        self.assertEqual(self.test_lib.count_tasks(
+            TEST_CONFIG['Files']['task-path']), 0)
+        self.assertEqual(
+            len(self.test_lib.get_tasks(TEST_CONFIG['Files']['done-path'])), 3)
+
+    def test_archived_tasks_parse_appended_lines(self):
+        for text in ['x first', 'x second', 'x third']:
+            self.test_lib.add_task(text)
+        self.test_lib.archive_tasks([1, 2])
+        done = self.test_lib.build_task_dict(only_archive=True)
+        self.assertEqual([t.text.split()[0] for t in done.values()],
+                         ['first', 'second'])
+        parsed = []
+        archive = self.test_lib.archive
+        parse = archive.parse
+        archive.parse = lambda line: parsed.append(line) or parse(line)
+        self.test_lib.archive_tasks([1])
+        done = self.test_lib.build_task_dict(include_archive=True)
+        self.assertEqual(sorted(done), ['x1', 'x2', 'x3'])
+        self.assertEqual(done['x3'].text.split()[0], 'third')
+        # the last known line is read again in case it had no newline
+        self.assertEqual(len(parsed), 2)
+        with open(TEST_CONFIG['Files']['done-path'], 'w') as fp:
+            fp.write('x rewritten\n')
+        done = self.test_lib.build_task_dict(only_archive=True)
+        self.assertEqual([t.text.split()[0] for t in done.values()],
+                         ['rewritten'])
+
+    def test_get_tasks_uses_cache(self):
+        path = TEST_CONFIG['Files']['task-path']
+        self.test_lib.add_task('(A) cached task')
+        first = self.test_lib.get_tasks(path)
+        entry = self.test_lib.cache.lookup(path)
+        self.assertIsNotNone(entry)
+        second = self.test_lib.get_tasks(path)
+        self.assertEqual(str(first[1]), str(second[1]))
+        self.assertIsNot(first[1], second[1])
+
+    def write_old_file(self, path, text):
+        "Writes a file with a modification time outside the racy window"
+        with open(path, 'w') as fp:
+            fp.write(text)
+        stat = os.stat(path)
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns - 10 ** 10))
+
+    def test_verified_snapshot_trusted_again(self):
+        path = TEST_CONFIG['Files']['task-path']
+        with open(path, 'w') as fp:
+            fp.write('first {uid:aaa}\nsecond {uid:bbb}\n')
+        TaskLib(TEST_CONFIG).get_tasks(path)
+        # the snapshot was made right after the file was written
+        stat = os.stat(path)
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns - 10 ** 10))
+        with mock.patch('taskshell.cache.read_digest',
+                        wraps=cache.read_digest) as digest:
+            TaskLib(TEST_CONFIG).get_tasks(path)
+            self.assertEqual(digest.call_count, 1)
+            self.assertEqual(len(TaskLib(TEST_CONFIG).get_tasks(path)), 2)
+            self.assertEqual(digest.call_count, 1)
+
+    def test_append_keeps_snapshot(self):
+        path = TEST_CONFIG['Files']['task-path']
+        self.write_old_file(path, 'first {uid:aaa}\nsecond {uid:bbb}\n')
+        TaskLib(TEST_CONFIG).get_tasks(path)
+        with mock.patch.object(cache.TaskCache, '_unpack_tasks',
+                               side_effect=AssertionError('unpacked')):
+            self.assertEqual(list(TaskLib(TEST_CONFIG).add_task('third')), [3])
+            self.assertEqual(list(TaskLib(TEST_CONFIG).add_tasks(
+                ['fourth', 'fifth'])), [4, 5])
+        with mock.patch('taskshell.lib.load_tasks',
+                        side_effect=AssertionError('parsed')):
+            lib = TaskLib(TEST_CONFIG)
+            tasks = lib.get_tasks(path)
+            self.assertEqual(lib.count_tasks(path), 5)
+        with open(path, 'rb') as fp:
+            lines = cache.LineIndex.from_data(fp.read(), 'utf-8')
+        entry = lib.cache.peek(path)
+        self.assertEqual(entry.lines.starts, lines.starts)
+        self.assertEqual(entry.lines.ends, lines.ends)
+        fresh = lib.parse_tasks(path)
+        self.assertEqual([str(t) for t in tasks.values()],
+                         [str(t) for t in fresh.values()])
+        lib.prioritize_task(4, 'A')
+        self.assertEqual(TaskLib(TEST_CONFIG).get_tasks(path)[4].priority, 'A')
+
+    def test_patch_does_not_hash_the_file(self):
+        path = TEST_CONFIG['Files']['task-path']
+        self.write_old_file(path, 'first {uid:aaa}\nsecond {uid:bbb}\n')
+        with mock.patch('taskshell.cache.read_digest') as digest:
+            lib = TaskLib(TEST_CONFIG)
+            lib.prioritize_task(1, 'B', 'with a longer note')
+            lib.complete_task(2)
+            tasks = TaskLib(TEST_CONFIG).get_tasks(path)
+        self.assertEqual(digest.call_count, 0)
+        self.assertEqual(tasks[1].priority, 'B')
+        self.assertTrue(tasks[2].complete)
+        fresh = TaskLib(TEST_CONFIG).parse_tasks(path)
+        self.assertEqual([str(t) for t in tasks.values()],
+                         [str(t) for t in fresh.values()])
+
+    def test_writes_do_not_hash_the_file(self):
+        path = TEST_CONFIG['Files']['task-path']
+        self.write_old_file(path, 'first +home {uid:aaa}\nsecond {uid:bbb}\n')
+        TaskLib(TEST_CONFIG).get_counts('project')
+        with mock.patch('taskshell.cache.read_digest') as digest, \
+                mock.patch('taskshell.rollup.read_digest') as counted:
+            lib = TaskLib(TEST_CONFIG)
+            lib.add_task('third +home')
+            lib.prioritize_task(1, 'B')
+            lib.complete_task(2)
+            lib = TaskLib(TEST_CONFIG)
+            counts = lib.get_counts('project')
+            tasks = lib.get_tasks(path)
+        self.assertEqual(digest.call_count, 0)
+        self.assertEqual(counted.call_count, 0)
+        self.assertEqual(counts['+home'], {'open': 2, 'B': 1})
+        self.assertEqual(tasks[1].priority, 'B')
+        self.assertTrue(tasks[2].complete)
+
+    def test_cache_invalidated_by_external_edit(self):
+        path = TEST_CONFIG['Files']['task-path']
+        self.test_lib.add_task('(A) first task')
+        self.test_lib.get_tasks(path)
+        with open(path, 'a') as fp:
+            fp.write('(B) second task\n')
+        tasks = self.test_lib.get_tasks(path)
+        self.assertEqual(len(tasks), 2)
+        self.assertEqual(tasks[2].priority, 'B')
+
+    def test_index_matches_include_task(self):
+        path = TEST_CONFIG['Files']['task-path']
+        for text in ['(A) call Bob +home', 'buy milk @store',
+                     '(B) call the bank @phone', 'x done +home']:
+            self.test_lib.add_task(text)
+        tasks = self.test_lib.get_tasks(path)
+        index = self.test_lib.get_index(path)
+        for filters in (['call'], ['~call'], ['(A)'], ['~(A)'], ['ALL'],
+                        ['+home', 'milk'], ['call', '~bank']):
+            for op in (all, any):
+                expected = {k for k, t in tasks.items()
+                            if include_task(op, filters, t)}
+                self.assertEqual(index.match(filters, op), expected,
+                                 (filters, op))
+        self.assertEqual(sorted(index.projects['+home']), [1, 4])
+        self.test_lib.note_task(2, 'from the corner')
+        self.assertEqual(index.match(['corner']), {2})
+        self.assertEqual([k for k, t in self.test_lib.sort_tasks(
+            filters=['call'])], [1, 3])
+
+
+    def test_find_by_uid(self):
+        path = TEST_CONFIG['Files']['task-path']
+        for text in ['x first {uid:aaa}', 'second {uid:bbb}',
+                     'third {uid:ccc}', 'copy {uid:ccc}']:
+            self.test_lib.add_task(text)
+        self.test_lib.archive_tasks([1])
+        found = self.test_lib.find_by_uid('bbb')
+        self.assertEqual([k for k, t in found], [1])
+        self.assertTrue(found[0][1].text.startswith('second'))
+        self.assertEqual([k for k, t in self.test_lib.find_by_uid('aaa')],
+                         ['x1'])
+        self.assertEqual(self.test_lib.find_by_uid('aaa', False), [])
+        batch = self.test_lib.find_by_uids(['aaa', 'ccc', 'zzz'])
+        self.assertEqual({u: [k for k, t in v] for u, v in batch.items()},
+                         {'aaa': ['x1'], 'ccc': [2, 3], 'zzz': []})
+        self.assertEqual(self.test_lib.duplicate_uids(), {'ccc': [2, 3]})
+        self.test_lib.note_task(2, 'moved {uid:ddd}')
+        self.assertEqual(self.test_lib.duplicate_uids(), {})
+        self.assertEqual(len(self.test_lib.get_tasks(path)), 3)
+
+
+    def test_session_holds_changes_until_flush(self):
+        path = TEST_CONFIG['Files']['task-path']
+        for text in ['first', 'second', 'third']:
+            self.test_lib.add_task(text)
+        self.test_lib.begin_session()
+        self.test_lib.prioritize_task(1, 'A')
+        self.test_lib.note_task(2, 'held')
+        self.test_lib.add_task('fourth')
+        self.assertEqual(self.test_lib.count_tasks(path), 4)
+        self.assertEqual(len(self.test_lib.parse_tasks(path)), 3)
+        self.assertEqual([k for k, t in self.test_lib.sort_tasks(
+            filters=['held'])], [2])
+        self.assertEqual(self.test_lib.flush(), (TASK_OK, '4 Tasks written'))
+        fresh = self.test_lib.parse_tasks(path)
+        self.assertEqual(fresh[1].priority, 'A')
+        self.assertIn('# held', fresh[2].text)
+        self.assertEqual(len(fresh), 4)
+
+        self.test_lib.prioritize_task(3, 'B')
+        with open(path, 'a') as fp:
+            fp.write('edited elsewhere\n')
+        self.assertEqual(self.test_lib.flush()[0], TASK_ERROR)
+        self.assertEqual(self.test_lib.end_session()[0], TASK_ERROR)
+        self.assertEqual(self.test_lib.flush(force=True)[0], TASK_OK)
+        self.assertEqual(self.test_lib.end_session(),
+                         (TASK_OK, 'Nothing to write'))
+        self.assertIsNone(self.test_lib.session)
+        self.assertEqual(self.test_lib.get_tasks(path)[3].priority, 'B')
+
+    def test_archive_in_session_checks_file_first(self):
+        path = TEST_CONFIG['Files']['task-path']
+        done = TEST_CONFIG['Files']['done-path']
+        for text in ['x first', 'second']:
+            self.test_lib.add_task(text)
+        self.test_lib.begin_session()
+        self.test_lib.prioritize_task(2, 'A')
+        with open(path, 'a') as fp:
+            fp.write('edited elsewhere\n')
+        self.assertEqual(self.test_lib.archive_tasks([1])[0], TASK_ERROR)
+        self.assertEqual(self.test_lib.count_tasks(done), 0)
+        self.test_lib.flush(force=True)
+        with open(path, 'a') as fp:
+            fp.write('x kept\n')
+        # a session with nothing held reads the file again
+        self.assertEqual(self.test_lib.archive_tasks([1]),
+                         (TASK_OK, 'Archived 1 tasks'))
+        self.assertEqual(self.test_lib.count_tasks(done), 1)
+        lines = [str(t) for t in self.test_lib.parse_tasks(path).values()]
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[0].startswith('(A) '))
+        self.assertIn(' kept ', lines[1])
+        self.test_lib.end_session()
+
+    @unittest.skipUnless(hasattr(os, 'symlink'), 'needs symbolic links')
+    def test_session_writes_through_symlink(self):
+        config = ConfigParser(interpolation=ExtendedInterpolation())
+        config.read_dict(TEST_CONFIG)
+        real = tmp_dir / 'real-todo.txt'
+        link = tmp_dir / 'linked-todo.txt'
+        real.write_text('first\nsecond\n')
+        real.chmod(0o640)
+        if link.exists() or link.is_symlink():
+            link.unlink()
+        link.symlink_to(real)
+        config['Files']['task-path'] = str(link)
+        lib = TaskLib(config)
+        lib.begin_session()
+        lib.prioritize_task(2, 'A')
+        self.assertEqual(lib.end_session()[0], TASK_OK)
+        self.assertTrue(link.is_symlink())
+        self.assertEqual(real.stat().st_mode & 0o777, 0o640)
+        self.assertTrue(real.read_text().splitlines()[1].startswith('(A) '))
+
+
+    def test_sort_tasks_query(self):
+        path = TEST_CONFIG['Files']['task-path']
+        for text in ['(A) call Bob +home @phone', 'buy milk @store',
+                     '(C) call the bank @phone', 'mow +home',
+                     '(B) plan +home {due:friday}',
+                     'x 2020-07-01T09:00:00 2020-07-02T09:00:00 old +home']:
+            self.test_lib.add_task(text)
+        tasks = self.test_lib.parse_tasks(path)
+        for text in ['+home', '+home AND pri:A-B', '+home OR @store',
+                     'NOT +home', 'call ~bank', '(+home OR @phone) pri:',
+                     'ext:due', 'ext:due=friday', '(C) OR milk',
+                     'end<2021-01-01', 'start>=today']:
+            expected = [k for k, t in tasks.items()
+                        if compile_query(text)(t)]
+            found = self.test_lib.sort_tasks(by_pri=False, query=text,
+                                             showcomplete=True)
+            self.assertEqual([k for k, t in found], expected, text)
+        self.assertEqual([k for k, t in self.test_lib.sort_tasks(
+            query='+home', filters=['plan'])], [5])
+        self.assertRaises(QueryError, self.test_lib.sort_tasks,
+                          query='(+home')
+
+
+    def test_sort_modes(self):
+        for text in ['(B) 2020-03-01T00:00:00 second +b @y',
+                     '2020-01-01T00:00:00 first +a',
+                     'x 2020-02-01T00:00:00 2020-02-02T00:00:00 done @x',
+                     '(A) 2020-04-01T00:00:00 newest']:
+            self.test_lib.add_task(text)
+
+        def order(sort):
+            return [k for k, t in self.test_lib.sort_tasks(
+                showcomplete=True, sort=sort)]
+
+        self.assertEqual(order('priority'), [4, 1, 2, 3])
+        self.assertEqual(order('number'), [1, 2, 3, 4])
+        self.assertEqual(order('start'), [2, 3, 1, 4])
+        self.assertEqual(order('end'), [3, 4, 1, 2])
+        self.assertEqual(order('project'), [2, 1, 4, 3])
+        self.assertEqual(order('context'), [3, 1, 4, 2])
+        self.assertEqual(order('age'), [2, 1, 4, 3])
+        self.assertEqual(self.test_lib.sort_tasks(sort='size')[0], TASK_ERROR)
+
+    def test_sort_key_cached(self):
+        task = Task.from_text('(A) 2020-01-01T00:00:00 cached key')
+        key = task.sort_key
+        self.assertIs(task.sort_key, key)
+        task.priority = 'B'
+        self.assertEqual(task.sort_key[2], 'B')
+        other = Task.from_text('(A) 2020-01-01T00:00:00 cached kez')
+        self.assertLess(other, task)
+        self.assertEqual(sorted([task, other], key=str),
+                         sorted([task, other]))
+        # the text only has whole seconds, so neither do the keys
+        late = Task.from_text('2020-01-01T00:00:00 a task')
+        late.start = late.start.replace(microsecond=900)
+        early = Task.from_text('2020-01-01T00:00:00 b task')
+        early.start = early.start.replace(microsecond=100)
+        self.assertEqual(sorted([early, late], key=str),
+                         sorted([early, late]))
+        # ( sorts before a digit, so prioritized tasks come first
+        tasks = [Task.from_text(text) for text in [
+            '2020-01-01T00:00:00 no priority', 'x 2020-01-02T00:00:00 done',
+            '(C) 2020-01-03T00:00:00 third', '(A) 2020-01-04T00:00:00 first']]
+        self.assertEqual([str(t) for t in sorted(tasks)],
+                         sorted(str(t) for t in tasks))
+
+    def test_reveal_index(self):
+        path = TEST_CONFIG['Files']['task-path']
+        today = datetime.date.today()
+        for days in [3, -1, 10, 0, 1]:
+            day = today + datetime.timedelta(days=days)
+            self.test_lib.add_task('task %d {hide:%s}' % (days, day))
+        self.test_lib.add_task('never hidden')
+        tasks = self.test_lib.get_tasks(path)
+        self.assertEqual([t.is_hidden for t in tasks.values()],
+                         [True, False, True, False, True, False])
+        self.assertEqual(tasks[1].hide_ordinal,
+                         (today + datetime.timedelta(days=3)).toordinal())
+        self.assertIsNone(tasks[6].hide_ordinal)
+
+        self.assertEqual([k for k, t in self.test_lib.sort_tasks(
+            by_pri=False)], [2, 4, 6])
+        index = self.test_lib.get_index(path)
+        self.assertEqual(index.revealing(today, today
+                                         + datetime.timedelta(days=7)),
+                         [5, 1])
+        self.assertEqual([k for k, t in self.test_lib.sort_tasks(
+            by_pri=False, hidedate=today + datetime.timedelta(days=3))],
+            [1, 2, 4, 5, 6])
+        self.assertEqual([k for k, t in self.test_lib.sort_tasks(
+            by_pri=False, revealing=7)], [1, 5])
+        self.test_lib.unhide_task(3)
+        self.assertEqual(index.hidden(today), {1, 5})
+
+
+    def test_task_table_matches_sort_tasks(self):
+        today = datetime.date.today()
+        for text in ['(A) call Bob +home @phone', 'buy milk @store',
+                     '(C) call the bank @phone', 'mow +home +yard',
+                     '(Z) someday +home', 'x done +home',
+                     '(B) later {hide:%s}' % (today
+                                              + datetime.timedelta(days=2))]:
+            self.test_lib.add_task(text)
+        self.test_lib.archive_tasks([6])
+        self.test_lib.add_task('x 2020-07-01T09:00:00 2020-07-02T09:00:00 '
+                               'old +home')
+        tasks = self.test_lib.build_task_dict(include_archive=True)
+        cases = [dict(), dict(showcomplete=True), dict(filters=['call']),
+                 dict(filters=['~call', '(A)'], filterop=any),
+                 dict(closedate=datetime.date(2020, 7, 2)),
+                 dict(hidedate=today + datetime.timedelta(days=5)),
+                 dict(by_pri=False, showcomplete=True)]
+        for use_numpy in (True, False):
+            table = TaskTable(tasks, use_numpy)
+            for case in cases:
+                expected = [k for k, t in self.test_lib.sort_tasks(**case)]
+                by_pri = case.pop('by_pri', True)
+                keys = table.order(table.select(**case), by_pri)
+                # sort_tasks only lists todo.txt
+                self.assertEqual([k for k in keys if isinstance(k, int)],
+                                 expected, (use_numpy, case))
+            self.assertEqual(table.counts('project'),
+                             self.test_lib.get_counts('project', True))
+            self.assertEqual(table.counts('context'),
+                             self.test_lib.get_counts('context', True))
+            self.assertEqual(table.rows(table.project('+home')), [0, 3, 4, 6, 7])
+        self.assertIs(self.test_lib.get_table(),
+                      self.test_lib.get_table())
+        TEST_CONFIG['Tasker']['use-table'] = 'true'
+        TEST_CONFIG['Tasker']['rollup-counts'] = 'false'
+        try:
+            lib = TaskLib(TEST_CONFIG)
+            for case in cases:
+                case.setdefault('limit', 3)
+                self.assertEqual(
+                    [k for k, t in lib.sort_tasks(**case)],
+                    [k for k, t in self.test_lib.sort_tasks(**case)], case)
+            self.assertEqual(lib.get_counts('project', True),
+                             self.test_lib.get_counts('project', True))
+            # the table picks the keys, so the task list is not scanned
+            lib.sort_tasks()
+            with mock.patch.object(lib, '_scan_tasks',
+                                   side_effect=AssertionError('scanned')), \
+                    mock.patch.object(LazyTask, 'copy', autospec=True,
+                                      side_effect=LazyTask.copy) as copy:
+                self.assertEqual(len(lib.sort_tasks(limit=2)), 2)
+            self.assertEqual(copy.call_count, 2)
+        finally:
+            TEST_CONFIG['Tasker'].pop('use-table')
+            TEST_CONFIG['Tasker'].pop('rollup-counts')
+
+    def test_library_import_skips_table(self):
+        code = ('import sys, taskshell.lib; '
+                'print("numpy" in sys.modules, "taskshell.table" in sys.modules)')
+        root = pathlib.Path(__file__).parent.parent
+        out = subprocess.run([sys.executable, '-c', code], cwd=str(root),
+                             capture_output=True, text=True, check=True)
+        self.assertEqual(out.stdout.split(), ['False', 'False'])
+
+    def test_snapshot_reloads_tasks(self):
+        path = TEST_CONFIG['Files']['task-path']
+        self.test_lib.add_task('(A) call Bob +home @phone {uid:1}')
+        self.test_lib.add_task('x 2020-07-01T09:00:00 2020-07-02T09:00:00 '
+                               'old +home')
+        tasks = self.test_lib.get_tasks(path)
+        tasks[1].text += ' today'  # decodes one of the lazy tasks
+        self.test_lib.save_task(1, tasks)
+        expected = [str(t) for t in self.test_lib.get_tasks(path).values()]
+        self.assertTrue(pathlib.Path(path + '.snap').exists())
+
+        fresh = TaskLib(TEST_CONFIG)
+        entry = fresh.cache.lookup(path)
+        self.assertIsNotNone(entry)
+        self.assertEqual([str(t) for t in entry.tasks.values()], expected)
+        self.assertEqual(entry.lines.span(2)[0], entry.lines.span(1)[1])
+        start = datetime.datetime(2020, 7, 1, 9)
+        state = Task('', '', start, None, 'plain', [], [], {}).to_state()
+        self.assertEqual(Task.from_state(state).start, start)
+
+        # the text file wins over a snapshot that no longer matches it
+        with open(path, 'a') as fp:
+            fp.write('third task\n')
+        self.assertIsNone(TaskLib(TEST_CONFIG).cache.lookup(path))
+        self.assertEqual(len(TaskLib(TEST_CONFIG).get_tasks(path)), 3)
+
+    def test_parallel_load_matches_serial(self):
+        path = TEST_CONFIG['Files']['done-path']
+        with open(path, 'w') as fp:
+            for idx in range(200):
+                fp.write('x (B) 2020-07-01T09:00:00 2020-07-02T09:00:00 '
+                         'task %d +proj%d\n' % (idx, idx % 7))
+                if idx % 50 == 0:
+                    fp.write('\n')
+        data = pathlib.Path(path).read_bytes()
+        ranges = chunk_ranges(data, 4)
+        self.assertEqual(ranges[0][0], 0)
+        self.assertEqual(ranges[-1][1], len(data))
+        for (__, end), (start, ___) in zip(ranges, ranges[1:]):
+            self.assertEqual(end, start)
+            self.assertEqual(data[end - 1:end], b'\n')
+
+        serial = load_tasks(path, LazyTask, 'utf-8', workers=1)
+        parallel = load_tasks(path, LazyTask, 'utf-8', workers=4,
+                              min_bytes=0, chunk_bytes=1)
+        self.assertEqual(serial[1], parallel[1])
+        self.assertEqual([str(t) for t in serial[2].values()],
+                         [str(t) for t in parallel[2].values()])
+        self.assertEqual(list(serial[2]), list(range(1, 201)))
+        self.assertEqual(serial[3].starts, parallel[3].starts)
+        self.assertEqual(serial[3].ends, parallel[3].ends)
+
+    def test_lazy_tasks_parse_on_one_core(self):
+        config = ConfigParser(interpolation=ExtendedInterpolation())
+        config.read_dict(TEST_CONFIG)
+        config['Tasker']['cache-tasks'] = 'false'
+        path = config['Files']['task-path']
+        for lazy, workers in (('true', 1), ('false', None)):
+            config['Tasker']['lazy-tasks'] = lazy
+            with mock.patch('taskshell.lib.load_tasks',
+                            wraps=load_tasks) as load:
+                TaskLib(config).get_tasks(path)
+            self.assertEqual(load.call_args[0][3], workers, lazy)
+
+    def test_rollup_counts_follow_writes(self):
+        lib = self.test_lib
+
+        def check():
+            rollups, lib.rollups = lib.rollups, None
+            for kind in ('project', 'context'):
+                for archive in (True, False):
+                    expected = lib.get_counts(kind, archive)
+                    lib.rollups = rollups
+                    self.assertEqual(lib.get_counts(kind, archive), expected)
+                    lib.rollups = None
+            lib.rollups = rollups
+
+        today = datetime.date.today()
+        for text in ['(A) call Bob +home @phone', 'buy milk @store',
+                     'mow +home +yard', 'read +books']:
+            lib.add_task(text)
+        check()
+        lib.complete_task(2)
+        lib.prioritize_task(3, 'B')
+        lib.hide_task(4, today + datetime.timedelta(days=3))
+        check()
+        self.assertEqual(lib.get_counts('project')['+home']['B'], 1)
+        lib.archive_tasks([2])
+        check()
+        # an edit behind the library's back is recounted
+        with open(TEST_CONFIG['Files']['task-path'], 'a') as fp:
+            fp.write('(C) paint +home\n')
+        check()
+        self.assertEqual(lib.rebuild_rollups()[0], TASK_OK)
+        check()
+        # a same-size rewrite that keeps the modification time is caught
+        # by the digest while the counts are racy
+        path = TEST_CONFIG['Files']['task-path']
+        lib.get_counts('project')
+        stat = os.stat(path)
+        data = pathlib.Path(path).read_bytes().replace(b'+home', b'+hose')
+        pathlib.Path(path).write_bytes(data)
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        self.assertIn('+hose', lib.get_counts('project'))
+        check()
+
+    def test_lazy_count_fields(self):
+        for text in ['x (B) 2020-07-01T09:00:00 2020-07-02T09:00:00 a +p @c'
+                     ' {uid:a}',
+                     '2020-07-01T09:00:00 b +p +q {hide:2030-01-02} @c'
+                     ' {uid:b} {hide:2031-01-01}',
+                     '2020-07-01T09:00:00 c {hide:soon}\t{hide:2030-01-01}'
+                     ' +r {uid:c}']:
+            lazy = LazyTask.from_text(text)
+            fields = lazy.count_fields()
+            self.assertFalse(lazy.decoded)
+            self.assertEqual(fields, Task.from_text(text).count_fields())
+
+
+class SQLiteStorageTestCase(unittest.TestCase):
+    def setUp(self):
+        self.config = ConfigParser(interpolation=ExtendedInterpolation())
+        self.config.read_dict(TEST_CONFIG)
+        self.config['Tasker']['storage'] = 'sqlite'
+        self.db_path = tmp_dir / 'tasks.db'
+        for suffix in ('', '-wal', '-shm'):
+            path = pathlib.Path(str(self.db_path) + suffix)
+            if path.exists():
+                path.unlink()
+        self.file_lib = TaskLib(TEST_CONFIG)
+        for key in ('task-path', 'done-path'):
+            with open(TEST_CONFIG['Files'][key], 'w') as fp:
+                fp.write('')
+        self.db_lib = TaskLib(self.config)
+
+    def tearDown(self):
+        self.db_lib.storage.close()
+
+    def test_storage_matches_files(self):
+        today = datetime.date.today()
+        for lib in (self.file_lib, self.db_lib):
+            for text in ['(A) call Bob +home @phone {uid:7}', 'buy milk @store',
+                         'mow +home +yard', 'read +books']:
+                lib.add_task(text)
+            lib.complete_task(2)
+            lib.prioritize_task(3, 'B')
+            lib.hide_task(4, today + datetime.timedelta(days=3))
+            lib.archive_tasks([2])
+            lib.add_task('(C) paint +home')
+            lib.add_task('(Z) Call twice +home @phone +home')
+        todo = TEST_CONFIG['Files']['task-path']
+        self.assertEqual(self.db_lib.count_tasks(todo),
+                         self.file_lib.count_tasks(todo))
+
+        def listed(lib, case):
+            # generated uids and timestamps differ between the two runs
+            return [(k, t.complete, t.priority, t.text.split(' {uid:')[0])
+                    for k, t in lib.sort_tasks(**case)]
+
+        for case in [dict(), dict(showcomplete=True),
+                     dict(filters=['+home']), dict(query='pri:A-B'),
+                     dict(filters=['CALL', '~bob']),
+                     dict(filters=['~milk', '(A)'], filterop=any),
+                     dict(opendate=today), dict(by_pri=False, limit=2),
+                     dict(hidedate=today + datetime.timedelta(days=5))]:
+            self.assertEqual(listed(self.db_lib, case),
+                             listed(self.file_lib, case), case)
+        # only the rows the query finds are returned to be checked
+        self.assertEqual(
+            sorted(self.db_lib.storage.select('todo', ['call'])),
+            sorted(k for k, t in self.file_lib.sort_tasks(filters=['call'])))
+        for kind in ('project', 'context'):
+            self.assertEqual(self.db_lib.get_counts(kind, True),
+                             self.file_lib.get_counts(kind, True))
+        (key, task), = self.db_lib.find_by_uid('7')
+        self.assertEqual(key, 1)
+        self.assertEqual(task.priority, 'A')
+        self.assertEqual(self.db_lib.duplicate_uids(), {})
+
+        # a second connection sees the changes
+        count = len(self.db_lib.get_tasks(todo)) + 1
+        other = TaskLib(self.config)
+        other.add_task('x from elsewhere +home')
+        self.assertEqual(len(self.db_lib.get_tasks(todo)), count)
+        other.storage.close()
+
+        res, msg = self.db_lib.export_tasks()
+        self.assertEqual(res, TASK_OK)
+        self.assertEqual(len(self.file_lib.parse_tasks(todo)), count)
+        self.db_lib.write_tasks({}, todo)
+        self.assertEqual(self.db_lib.import_tasks()[0], TASK_OK)
+        self.assertEqual(self.db_lib.count_tasks(todo), count)
+
+
+class LazyTaskTestCase(unittest.TestCase):
+    line = ('x (A) 2020-07-01T09:30:00 2020-07-02T10:00:00 '
+            'call Bob +Phone @office {uid:200701093000000000}')
+
+    def test_flags_parsed_without_decoding(self):
+        task = LazyTask.from_text(self.line)
+        self.assertTrue(task.complete)
+        self.assertEqual(task.priority, 'A')
+        self.assertFalse(task.decoded)
+
+    def test_fields_match_eager_task(self):
+        lazy = LazyTask.from_text(self.line)
+        eager = Task.from_text(self.line)
+        for field in ('start', 'end', 'text', 'contexts', 'projects',
+                      'extensions'):
+            self.assertEqual(getattr(lazy, field), getattr(eager, field))
+        self.assertTrue(lazy.decoded)
+        self.assertEqual(str(lazy), str(eager))
+
+    def test_generated_fields_shared_by_copies(self):
+        for text in ['no start or uid', '2020-07-01T09:30:00 no uid',
+                     'x 2020-07-01T09:30:00 no end {uid:a}',
+                     '{uid:b} no start']:
+            task = LazyTask.from_text(text)
+            first, second = task.copy(), task.copy()
+            time.sleep(0.001)
+            self.assertEqual(str(first), str(second))
+            self.assertEqual(first.extensions['uid'], task.extensions['uid'])
+
+
+class TimestampCodecTestCase(unittest.TestCase):
+    stamps = [datetime.datetime(2020, 7, 1, 9, 5, 3, 120),
+              datetime.datetime(1999, 12, 31, 23, 59, 59, 999999),
+              datetime.datetime(2024, 2, 29, 0, 0, 0)]
+
+    def test_matches_strftime(self):
+        for dt in self.stamps:
+            self.assertEqual(format_timestamp(dt), dt.strftime(TIMEFMT))
+            self.assertEqual(format_date(dt), dt.strftime(DATEFMT))
+            self.assertEqual(format_uid(dt), dt.strftime(IDFMT))
+
+    def test_round_trip(self):
+        for dt in self.stamps:
+            text = dt.strftime(TIMEFMT)
+            self.assertEqual(parse_timestamp(text),
+                             datetime.datetime.strptime(text, TIMEFMT))
+            self.assertEqual(format_timestamp(parse_timestamp(text)), text)
+            day = dt.strftime(DATEFMT)
+            self.assertEqual(format_date(parse_date(day)), day)
+
 
 if __name__ == '__main__':
     unittest.main()